@@ -0,0 +1,161 @@
+#!/usr/bin/env python3
+
+"""
+Account startup benchmark for the AccountManager.
+
+A SIPApplication is started with in-memory storage, no sound or video devices
+and the requested number of enabled accounts at 127.0.0.1, which by default do
+not register. The time it takes the AccountManager to start all the accounts
+is measured, along with the time until the last account was activated, the
+peak number of accounts being started at the same time and the memory used
+per 1000 accounts. The startup concurrency window and rate can be changed to
+compare different startup strategies.
+
+No network access or sound hardware is needed, unless registration is enabled,
+in which case a registrar must be listening on 127.0.0.1.
+"""
+
+import resource
+import sys
+
+from argparse import ArgumentParser
+from threading import Event
+from time import time
+
+from application.notification import IObserver, NotificationCenter
+from application.python import Null
+from zope.interface import implementer
+
+from sipsimple.account import Account, AccountManager, BonjourAccount
+from sipsimple.application import SIPApplication
+from sipsimple.configuration.datatypes import SIPTransportList
+from sipsimple.configuration.settings import SIPSimpleSettings
+from sipsimple.storage import MemoryStorage
+from sipsimple.threading import run_in_twisted_thread
+
+
+def current_rss():
+    # resident set size in bytes, as reported by the kernel for this process
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * resource.getpagesize()
+    except (OSError, IndexError, ValueError):
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+@implementer(IObserver)
+class StartupBenchmark(object):
+
+    def __init__(self, accounts, register, mwi, presence):
+        self.accounts = accounts
+        self.register = register
+        self.mwi = mwi
+        self.presence = presence
+        self.ended = Event()
+        self.results = None
+        self._start_time = None
+        self._start_rss = None
+        self._activated = 0
+        self._last_activation_time = None
+        self._starting = 0
+        self._max_starting = 0
+
+    def run(self):
+        notification_center = NotificationCenter()
+        notification_center.add_observer(self, sender=SIPApplication())
+        notification_center.add_observer(self, sender=AccountManager())
+        notification_center.add_observer(self, name='SIPAccountWillStart')
+        notification_center.add_observer(self, name='SIPAccountDidActivate')
+        SIPApplication().start(MemoryStorage())
+        self.ended.wait()
+        return self.results
+
+    @run_in_twisted_thread
+    def handle_notification(self, notification):
+        handler = getattr(self, '_NH_%s' % notification.name, Null)
+        handler(notification)
+
+    def _NH_SIPApplicationWillStart(self, notification):
+        settings = SIPSimpleSettings()
+        settings.audio.input_device = None
+        settings.audio.output_device = None
+        settings.audio.alert_device = None
+        settings.video.device = None
+        settings.sip.transport_list = SIPTransportList(['udp'])
+        settings.sip.udp_port = 0
+        settings.save()
+
+        bonjour_account = BonjourAccount()
+        if bonjour_account.enabled:
+            bonjour_account.enabled = False
+            bonjour_account.save()
+
+        for i in range(self.accounts):
+            account = Account('user%05d@127.0.0.1' % i)
+            account.enabled = True
+            account.sip.register = self.register
+            account.message_summary.enabled = self.mwi
+            account.presence.enabled = self.presence
+            account.save()
+
+    def _NH_SIPApplicationDidEnd(self, notification):
+        self.ended.set()
+
+    def _NH_SIPAccountManagerWillStart(self, notification):
+        self._start_rss = current_rss()
+        self._start_time = time()
+
+    def _NH_SIPAccountWillStart(self, notification):
+        self._starting += 1
+        self._max_starting = max(self._max_starting, self._starting)
+
+    def _NH_SIPAccountManagerDidStartAccount(self, notification):
+        self._starting -= 1
+
+    def _NH_SIPAccountDidActivate(self, notification):
+        self._activated += 1
+        self._last_activation_time = time()
+
+    def _NH_SIPAccountManagerDidStart(self, notification):
+        duration = time() - self._start_time
+        activated = self._activated
+        self.results = dict(accounts=self.accounts,
+                            activated=activated,
+                            duration=duration,
+                            activation_time=(self._last_activation_time or self._start_time) - self._start_time,
+                            rate=activated / duration if duration else 0.0,
+                            max_starting=self._max_starting,
+                            rss_per_1k=(current_rss() - self._start_rss) * 1000 / self.accounts if self.accounts else 0.0)
+        SIPApplication().stop()
+
+
+def main():
+    parser = ArgumentParser(description='Startup benchmark for the AccountManager')
+    parser.add_argument('-n', '--accounts', type=int, default=1000, help='the number of accounts to start (default: %(default)s)')
+    parser.add_argument('-c', '--concurrency', type=int, default=AccountManager.startup_concurrency, help='the maximum number of accounts being started at the same time (default: %(default)s)')
+    parser.add_argument('-r', '--rate', type=float, default=AccountManager.startup_rate, help='the maximum number of enabled accounts started per second, 0 for unlimited (default: %(default)s)')
+    parser.add_argument('--register', action='store_true', default=False, help='register the accounts with a registrar on 127.0.0.1')
+    parser.add_argument('--mwi', action='store_true', default=False, help='enable message summary subscriptions for the accounts')
+    parser.add_argument('--presence', action='store_true', default=False, help='enable presence for the accounts')
+    options = parser.parse_args()
+
+    AccountManager.startup_concurrency = options.concurrency
+    AccountManager.startup_rate = options.rate
+
+    benchmark = StartupBenchmark(options.accounts, options.register, options.mwi, options.presence)
+    results = benchmark.run()
+    if results is None:
+        print('The benchmark did not run, the application failed to start', file=sys.stderr)
+        return 1
+
+    print('Accounts:            %(activated)d/%(accounts)d activated' % results)
+    print('Startup duration:    %(duration).2f s' % results)
+    print('Last activation:     %(activation_time).2f s' % results)
+    print('Accounts per second: %(rate).1f' % results)
+    print('Peak starting:       %(max_starting)d' % results)
+    print('RSS per 1k accounts: %.2f MB' % (results['rss_per_1k'] / 1024 / 1024))
+    return 0 if results['activated'] == results['accounts'] else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
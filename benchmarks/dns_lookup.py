@@ -0,0 +1,272 @@
+#!/usr/bin/env python3
+
+"""
+DNS lookup load test for DNSLookup.
+
+A stub authoritative DNS server is started in-process on 127.0.0.1. It serves
+a synthetic zone with NAPTR, SRV and A records for the requested number of
+SIP domains, each of which has two proxies reachable over UDP, TCP and TLS
+and a STUN server and an MSRP relay. The server can delay its answers and
+drop a fraction of the queries. The DNSManager is pointed at the stub server
+and the requested number of lookup_sip_proxy and lookup_service lookups are
+made for randomly chosen domains, keeping a bounded number of them in
+progress. A fraction of the lookups can be made for domains that do not
+exist. The choice of the domains, the delays and the dropped queries are
+drawn from a random generator with a fixed seed, so that runs with the same
+options are comparable.
+
+At the end the lookup rate, the lookup latency percentiles, the effectiveness
+of the DNS and route caches, the number of queries which reached the server
+and the peak number of threads, lookups and queries in progress are printed.
+No network access is needed.
+"""
+
+import random
+import resource
+import sys
+import threading
+
+from argparse import ArgumentParser
+from time import time
+
+import dns.exception
+import dns.flags
+import dns.message
+import dns.rcode
+import dns.rdatatype
+import dns.rrset
+
+from eventlib import api, coros, proc
+from twisted.internet import reactor
+from twisted.internet.protocol import DatagramProtocol
+
+from sipsimple.core import SIPURI
+from sipsimple.lookup import DNSLookup, DNSLookupError, DNSManager, DNSMetrics, DNSQueryMultiplexer
+from sipsimple.threading.green import run_in_green_thread
+
+
+ZONE = 'test.'
+
+
+def percentile(values, fraction):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(int(len(values) * fraction), len(values) - 1)]
+
+
+def build_zone(domains, ttl):
+    # map (name, type) to the list of records of that type for each of the synthetic domains
+    records = {}
+    for i in range(domains):
+        domain = 'domain%05d.%s' % (i, ZONE)
+        address = '10.%d.%d.%%d' % (i // 256 % 256, i % 256)
+        records[(domain, 'NAPTR')] = ['10 10 "s" "SIPS+D2T" "" _sips._tcp.%s' % domain,
+                                      '20 10 "s" "SIP+D2T" "" _sip._tcp.%s' % domain,
+                                      '30 10 "s" "SIP+D2U" "" _sip._udp.%s' % domain]
+        for service, port in (('_sip._udp', 5060), ('_sip._tcp', 5060), ('_sips._tcp', 5061)):
+            records[('%s.%s' % (service, domain), 'SRV')] = ['10 60 %d proxy1.%s' % (port, domain), '10 40 %d proxy2.%s' % (port, domain)]
+        records[('_stun._udp.%s' % domain, 'SRV')] = ['0 0 3478 stun.%s' % domain]
+        records[('_msrps._tcp.%s' % domain, 'SRV')] = ['0 0 2855 relay.%s' % domain]
+        for index, host in enumerate(('proxy1', 'proxy2', 'stun', 'relay'), 1):
+            records[('%s.%s' % (host, domain), 'A')] = [address % index]
+    return {key: dns.rrset.from_text_list(key[0], ttl, 'IN', key[1], texts) for key, texts in records.items()}
+
+
+class StubDNSServer(DatagramProtocol):
+    """An authoritative DNS server for the synthetic zone, with configurable latency and loss"""
+
+    def __init__(self, zone, latency, jitter, loss, seed):
+        self.zone = zone
+        self.names = {name for name, _ in zone}
+        self.latency = latency
+        self.jitter = jitter
+        self.loss = loss
+        self.queries = 0
+        self.dropped = 0
+        self._random = random.Random(seed)
+        self._soa = dns.rrset.from_text(ZONE, 60, 'IN', 'SOA', 'ns.%s hostmaster.%s 1 3600 600 86400 60' % (ZONE, ZONE))
+
+    def datagramReceived(self, data, address):
+        try:
+            query = dns.message.from_wire(data)
+        except dns.exception.DNSException:
+            return
+        self.queries += 1
+        if self._random.random() < self.loss:
+            self.dropped += 1
+            return
+        response = dns.message.make_response(query)
+        response.flags |= dns.flags.AA
+        question = query.question[0]
+        name = question.name.to_text()
+        try:
+            response.answer.append(self.zone[(name, dns.rdatatype.to_text(question.rdtype))])
+        except KeyError:
+            if name not in self.names:
+                response.set_rcode(dns.rcode.NXDOMAIN)
+            response.authority.append(self._soa)
+        delay = max(self.latency + self._random.uniform(-self.jitter, self.jitter), 0)
+        if delay:
+            reactor.callLater(delay, self.transport.write, response.to_wire(), address)
+        else:
+            self.transport.write(response.to_wire(), address)
+
+
+class LookupBenchmark(object):
+
+    def __init__(self, lookups, concurrency, domains, service_ratio, nxdomain_ratio, timeout, lifetime, seed):
+        self.lookups = lookups
+        self.concurrency = concurrency
+        self.domains = domains
+        self.service_ratio = service_ratio
+        self.nxdomain_ratio = nxdomain_ratio
+        self.timeout = timeout
+        self.lifetime = lifetime
+        self.latencies = []
+        self.succeeded = 0
+        self.failed = 0
+        self.unexpected = 0
+        self.results = None
+        self._random = random.Random(seed)
+        self._semaphore = None
+        self._in_progress = 0
+        self._max_in_progress = 0
+        self._max_in_flight = 0
+        self._max_threads = 0
+        self._done = False
+
+    def run(self, server):
+        from eventlib.twistedutil import join_reactor; del join_reactor  # imported for the side effect of making the twisted reactor green
+
+        port = reactor.listenUDP(0, server, interface='127.0.0.1')
+        dns_manager = DNSManager()
+        dns_manager.nameservers = ['127.0.0.1']
+        dns_manager.port = port.getHost().port
+        DNSLookup.cache.flush()
+        DNSLookup.route_cache.flush()
+        DNSMetrics().reset()
+        reactor.callWhenRunning(self._drive, server)
+        reactor.run(installSignalHandlers=False)
+        return self.results
+
+    @run_in_green_thread
+    def _monitor(self):
+        multiplexer = DNSQueryMultiplexer()
+        while not self._done:
+            self._max_threads = max(self._max_threads, threading.active_count())
+            self._max_in_flight = max(self._max_in_flight, multiplexer.in_flight)
+            api.sleep(0.01)
+
+    def _lookup(self, lookup, uri, service, exists):
+        start_time = time()
+        try:
+            if service is not None:
+                lookup.lookup_service(uri, service, timeout=self.timeout, lifetime=self.lifetime).wait()
+            else:
+                lookup.lookup_sip_proxy(uri, ['udp', 'tcp', 'tls'], timeout=self.timeout, lifetime=self.lifetime).wait()
+        except DNSLookupError:
+            self.failed += 1
+            if exists:
+                self.unexpected += 1
+        else:
+            self.succeeded += 1
+            if not exists:
+                self.unexpected += 1
+        finally:
+            self.latencies.append(time() - start_time)
+            self._in_progress -= 1
+            self._semaphore.release()
+
+    @run_in_green_thread
+    def _drive(self, server):
+        lookup = DNSLookup()
+        self._semaphore = coros.Semaphore(self.concurrency)
+        self._monitor()
+        start_usage = resource.getrusage(resource.RUSAGE_SELF)
+        start_time = time()
+        procs = []
+        for i in range(self.lookups):
+            exists = self._random.random() >= self.nxdomain_ratio
+            if exists:
+                uri = SIPURI(host='domain%05d.%s' % (self._random.randrange(self.domains), ZONE.rstrip('.')))
+            else:
+                uri = SIPURI(host='missing%05d.%s' % (self._random.randrange(self.domains), ZONE.rstrip('.')))
+            service = self._random.choice(('stun', 'msrprelay')) if self._random.random() < self.service_ratio else None
+            self._semaphore.acquire()
+            self._in_progress += 1
+            self._max_in_progress = max(self._max_in_progress, self._in_progress)
+            procs.append(proc.spawn(self._lookup, lookup, uri, service, exists))
+        proc.waitall(procs)
+        duration = time() - start_time
+        end_usage = resource.getrusage(resource.RUSAGE_SELF)
+        self._done = True
+
+        cpu_time = (end_usage.ru_utime - start_usage.ru_utime) + (end_usage.ru_stime - start_usage.ru_stime)
+        dns_cache = DNSLookup.cache.statistics
+        route_cache = DNSLookup.route_cache.statistics
+        dns_cache_lookups = dns_cache['hits'] + dns_cache['misses']
+        route_cache_lookups = route_cache['hits'] + route_cache['misses']
+        self.results = dict(lookups=self.lookups,
+                            succeeded=self.succeeded,
+                            failed=self.failed,
+                            unexpected=self.unexpected,
+                            duration=duration,
+                            lps=self.lookups / duration if duration else 0.0,
+                            latency_p50=percentile(self.latencies, 0.50),
+                            latency_p90=percentile(self.latencies, 0.90),
+                            latency_p99=percentile(self.latencies, 0.99),
+                            latency_max=max(self.latencies or [0.0]),
+                            dns_cache_hit_ratio=dns_cache['hits'] / dns_cache_lookups if dns_cache_lookups else 0.0,
+                            dns_cache_size=dns_cache['size'],
+                            dns_cache_negative=dns_cache['negative'],
+                            route_cache_hit_ratio=route_cache['hits'] / route_cache_lookups if route_cache_lookups else 0.0,
+                            coalesced=DNSLookup.service_lookups.coalesced + DNSLookup.sip_proxy_lookups.coalesced,
+                            server_queries=server.queries,
+                            server_dropped=server.dropped,
+                            max_in_progress=self._max_in_progress,
+                            max_in_flight=self._max_in_flight,
+                            max_threads=self._max_threads,
+                            cpu_per_1k=cpu_time * 1000 / self.lookups if self.lookups else 0.0)
+        DNSQueryMultiplexer().stop()
+        reactor.stop()
+
+
+def main():
+    parser = ArgumentParser(description='Load test for DNSLookup against an in-process stub DNS server')
+    parser.add_argument('-n', '--lookups', type=int, default=10000, help='the number of lookups to make (default: %(default)s)')
+    parser.add_argument('-c', '--concurrency', type=int, default=1000, help='the maximum number of lookups in progress at the same time (default: %(default)s)')
+    parser.add_argument('-d', '--domains', type=int, default=1000, help='the number of domains in the zone served by the stub server (default: %(default)s)')
+    parser.add_argument('--service-ratio', type=float, default=0.2, help='the fraction of the lookups made with lookup_service instead of lookup_sip_proxy (default: %(default)s)')
+    parser.add_argument('--nxdomain-ratio', type=float, default=0.0, help='the fraction of the lookups made for domains which do not exist (default: %(default)s)')
+    parser.add_argument('--ttl', type=int, default=300, help='the TTL of the records served by the stub server (default: %(default)s)')
+    parser.add_argument('--latency', type=float, default=0.005, help='the delay in seconds of the answers of the stub server (default: %(default)s)')
+    parser.add_argument('--jitter', type=float, default=0.002, help='the maximum random variation in seconds of the delay of the answers (default: %(default)s)')
+    parser.add_argument('--loss', type=float, default=0.0, help='the fraction of the queries dropped by the stub server (default: %(default)s)')
+    parser.add_argument('--timeout', type=float, default=1.0, help='the timeout in seconds of each DNS query (default: %(default)s)')
+    parser.add_argument('--lifetime', type=float, default=5.0, help='the maximum duration in seconds of the DNS queries of a lookup (default: %(default)s)')
+    parser.add_argument('--seed', type=int, default=0, help='the seed of the random generator (default: %(default)s)')
+    options = parser.parse_args()
+
+    server = StubDNSServer(build_zone(options.domains, options.ttl), options.latency, options.jitter, options.loss, options.seed)
+    benchmark = LookupBenchmark(options.lookups, options.concurrency, options.domains, options.service_ratio, options.nxdomain_ratio, options.timeout, options.lifetime, options.seed)
+    results = benchmark.run(server)
+    if results is None:
+        print('The benchmark did not complete', file=sys.stderr)
+        return 1
+
+    print('Lookups:            %(succeeded)d succeeded, %(failed)d failed, %(unexpected)d unexpected results' % results)
+    print('Duration:           %(duration).2f s' % results)
+    print('Lookups per second: %(lps).1f' % results)
+    print('Lookup latency:     p50=%.1fms p90=%.1fms p99=%.1fms max=%.1fms' % tuple(1000 * results[key] for key in ('latency_p50', 'latency_p90', 'latency_p99', 'latency_max')))
+    print('DNS cache:          %.1f%% hits, %d entries (%d negative)' % (100 * results['dns_cache_hit_ratio'], results['dns_cache_size'], results['dns_cache_negative']))
+    print('Route cache:        %.1f%% hits' % (100 * results['route_cache_hit_ratio']))
+    print('Coalesced lookups:  %(coalesced)d' % results)
+    print('Server queries:     %(server_queries)d (%(server_dropped)d dropped)' % results)
+    print('Peak in progress:   %(max_in_progress)d lookups, %(max_in_flight)d queries, %(max_threads)d threads' % results)
+    print('CPU per 1k lookups: %(cpu_per_1k).2f s' % results)
+    return 0 if results['unexpected'] == 0 else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,238 @@
+#!/usr/bin/env python3
+
+"""
+Presence fan-out benchmark for incoming subscriptions.
+
+A SIPApplication is started with in-memory storage and no sound or video
+devices, and the engine is set up to accept incoming presence subscriptions.
+The requested number of watchers subscribe over 127.0.0.1 to a presentity
+served by the same engine, and every incoming subscription is accepted and
+added to an IncomingSubscriptionGroup. The presentity state is then changed a
+number of times and the time it takes until every watcher got the NOTIFY for
+each state is measured.
+
+With --per-subscription the state is pushed to every incoming subscription
+separately with IncomingSubscription.push_content instead, for comparison.
+
+At the end the NOTIFY rate, the per-update fan-out latency percentiles and
+the CPU time per 1000 NOTIFY requests are printed. No network access or sound
+hardware is needed.
+"""
+
+import resource
+import sys
+
+from argparse import ArgumentParser
+from threading import Event
+from time import time
+
+from application.notification import IObserver, NotificationCenter
+from application.python import Null
+from eventlib import api, coros
+from zope.interface import implementer
+
+from sipsimple.account import BonjourAccount
+from sipsimple.application import SIPApplication
+from sipsimple.configuration.datatypes import SIPTransportList
+from sipsimple.configuration.settings import SIPSimpleSettings
+from sipsimple.core import ContactHeader, Engine, FromHeader, IncomingSubscriptionGroup, RouteHeader, SIPURI, Subscription, ToHeader
+from sipsimple.storage import MemoryStorage
+from sipsimple.threading import run_in_twisted_thread
+from sipsimple.threading.green import run_in_green_thread
+
+
+PIDF_TEMPLATE = '''<?xml version="1.0" encoding="UTF-8"?>
+<presence xmlns="urn:ietf:params:xml:ns:pidf" entity="sip:presentity@127.0.0.1">
+  <tuple id="benchmark">
+    <status><basic>open</basic></status>
+    <note>update-%d</note>
+  </tuple>
+</presence>
+'''
+
+
+def percentile(values, fraction):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(int(len(values) * fraction), len(values) - 1)]
+
+
+@implementer(IObserver)
+class FanoutBenchmark(object):
+
+    def __init__(self, watchers, updates, concurrency, batch_size, per_subscription, timeout):
+        self.watchers = watchers
+        self.updates = updates
+        self.concurrency = concurrency
+        self.batch_size = batch_size
+        self.per_subscription = per_subscription
+        self.timeout = timeout
+        self.group = IncomingSubscriptionGroup(batch_size=batch_size) if batch_size else IncomingSubscriptionGroup()
+        self.incoming_subscriptions = []
+        self.subscriptions = set()
+        self.fanout_times = []
+        self.ended = Event()
+        self.results = None
+        self._subscribed = None
+        self._notified = None
+        self._semaphore = None
+        self._update = None
+        self._update_marker = None
+        self._notified_count = 0
+
+    def run(self):
+        notification_center = NotificationCenter()
+        notification_center.add_observer(self, sender=SIPApplication())
+        notification_center.add_observer(self, name='SIPIncomingSubscriptionGotSubscribe')
+        notification_center.add_observer(self, name='SIPSubscriptionDidStart')
+        notification_center.add_observer(self, name='SIPSubscriptionDidFail')
+        notification_center.add_observer(self, name='SIPSubscriptionGotNotify')
+        SIPApplication().start(MemoryStorage())
+        self.ended.wait()
+        return self.results
+
+    @run_in_twisted_thread
+    def handle_notification(self, notification):
+        handler = getattr(self, '_NH_%s' % notification.name, Null)
+        handler(notification)
+
+    def _NH_SIPApplicationWillStart(self, notification):
+        settings = SIPSimpleSettings()
+        settings.audio.input_device = None
+        settings.audio.output_device = None
+        settings.audio.alert_device = None
+        settings.video.device = None
+        settings.sip.transport_list = SIPTransportList(['udp'])
+        settings.sip.udp_port = 0
+        settings.save()
+
+        bonjour_account = BonjourAccount()
+        if bonjour_account.enabled:
+            bonjour_account.enabled = False
+            bonjour_account.save()
+
+    def _NH_SIPApplicationDidStart(self, notification):
+        Engine().add_incoming_event(b'presence')
+        self._drive()
+
+    def _NH_SIPApplicationDidEnd(self, notification):
+        self.ended.set()
+
+    def _NH_SIPIncomingSubscriptionGotSubscribe(self, notification):
+        subscription = notification.sender
+        subscription.accept('application/pidf+xml', PIDF_TEMPLATE % 0)
+        self.incoming_subscriptions.append(subscription)
+        self.group.add(subscription)
+
+    def _NH_SIPSubscriptionDidStart(self, notification):
+        if notification.sender in self.subscriptions:
+            self._semaphore.release()
+            if len(self.incoming_subscriptions) == self.watchers:
+                self._subscribed.send()
+
+    def _NH_SIPSubscriptionDidFail(self, notification):
+        if notification.sender in self.subscriptions:
+            self.subscriptions.discard(notification.sender)
+            self._semaphore.release()
+
+    def _NH_SIPSubscriptionGotNotify(self, notification):
+        if notification.sender not in self.subscriptions or self._update_marker is None:
+            return
+        body = notification.data.body or b''
+        if isinstance(body, str):
+            body = body.encode()
+        if self._update_marker in body:
+            self._notified_count += 1
+            if self._notified_count == len(self.subscriptions):
+                self._notified.send()
+
+    @run_in_green_thread
+    def _drive(self):
+        engine = Engine()
+        local_port = engine.udp_port
+        route = RouteHeader(SIPURI(host='127.0.0.1', port=local_port, parameters={'transport': 'udp'}))
+        presentity = SIPURI(user='presentity', host='127.0.0.1', port=local_port)
+
+        self._subscribed = coros.event()
+        self._semaphore = coros.Semaphore(self.concurrency)
+        try:
+            with api.timeout(self.timeout):
+                for i in range(self.watchers):
+                    self._semaphore.acquire()
+                    watcher = SIPURI(user='watcher%05d' % i, host='127.0.0.1', port=local_port)
+                    subscription = Subscription(presentity, FromHeader(watcher), ToHeader(presentity), ContactHeader(watcher), b'presence', route, refresh=3600)
+                    self.subscriptions.add(subscription)
+                    subscription.subscribe(timeout=30)
+                self._subscribed.wait()
+        except api.TimeoutError:
+            print('Only %d out of %d watchers subscribed in time' % (len(self.incoming_subscriptions), self.watchers), file=sys.stderr)
+            SIPApplication().stop()
+            return
+
+        start_usage = resource.getrusage(resource.RUSAGE_SELF)
+        start_time = time()
+        completed = 0
+        for update in range(1, self.updates + 1):
+            self._notified = coros.event()
+            self._notified_count = 0
+            self._update_marker = ('update-%d<' % update).encode()
+            content = PIDF_TEMPLATE % update
+            update_time = time()
+            if self.per_subscription:
+                for subscription in self.incoming_subscriptions:
+                    if subscription.state == 'ACTIVE':
+                        subscription.push_content('application/pidf+xml', content)
+            else:
+                self.group.push_content('application/pidf+xml', content)
+            try:
+                with api.timeout(self.timeout):
+                    self._notified.wait()
+            except api.TimeoutError:
+                break
+            self.fanout_times.append(time() - update_time)
+            completed += 1
+        duration = time() - start_time
+        end_usage = resource.getrusage(resource.RUSAGE_SELF)
+
+        notify_count = completed * len(self.subscriptions)
+        cpu_time = (end_usage.ru_utime - start_usage.ru_utime) + (end_usage.ru_stime - start_usage.ru_stime)
+        self.results = dict(watchers=len(self.subscriptions),
+                            updates=self.updates,
+                            completed=completed,
+                            duration=duration,
+                            nps=notify_count / duration if duration else 0.0,
+                            fanout_p50=percentile(self.fanout_times, 0.50),
+                            fanout_p90=percentile(self.fanout_times, 0.90),
+                            fanout_max=max(self.fanout_times or [0.0]),
+                            cpu_per_1k=cpu_time * 1000 / notify_count if notify_count else 0.0)
+        SIPApplication().stop()
+
+
+def main():
+    parser = ArgumentParser(description='Presence fan-out benchmark for incoming subscriptions')
+    parser.add_argument('-n', '--watchers', type=int, default=10000, help='the number of watchers subscribing to the presentity (default: %(default)s)')
+    parser.add_argument('-u', '--updates', type=int, default=10, help='the number of presence state updates (default: %(default)s)')
+    parser.add_argument('-c', '--concurrency', type=int, default=100, help='the maximum number of watchers subscribing at the same time (default: %(default)s)')
+    parser.add_argument('-b', '--batch-size', type=int, default=0, help='the number of NOTIFY requests the group sends at a time, 0 for the default')
+    parser.add_argument('--per-subscription', action='store_true', default=False, help='push the state to each incoming subscription separately')
+    parser.add_argument('--timeout', type=float, default=600, help='maximum duration of each phase in seconds (default: %(default)s)')
+    options = parser.parse_args()
+
+    benchmark = FanoutBenchmark(options.watchers, options.updates, options.concurrency, options.batch_size, options.per_subscription, options.timeout)
+    results = benchmark.run()
+    if results is None:
+        print('The benchmark did not complete', file=sys.stderr)
+        return 1
+
+    print('Watchers:          %(watchers)d' % results)
+    print('Updates:           %(completed)d/%(updates)d fanned out' % results)
+    print('Duration:          %(duration).2f s' % results)
+    print('NOTIFY per second: %(nps).1f' % results)
+    print('Fan-out latency:   p50=%.1fms p90=%.1fms max=%.1fms' % tuple(1000 * results[key] for key in ('fanout_p50', 'fanout_p90', 'fanout_max')))
+    print('CPU per 1k NOTIFY: %(cpu_per_1k).2f s' % results)
+    return 0 if results['completed'] == results['updates'] else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,229 @@
+#!/usr/bin/env python3
+
+"""
+Loopback calls-per-second benchmark for the SIP signaling and session layers.
+
+A SIPApplication is started with in-memory storage, no sound or video devices
+and two accounts (a caller and a callee) that do not register. The caller
+places calls with an audio stream to the callee over 127.0.0.1 using the
+selected transport, keeping a bounded number of calls in progress. The callee
+accepts every call and the caller ends it after the configured hold time.
+
+At the end the call rate, the setup latency percentiles and the CPU time and
+memory growth per 1000 calls are printed. No network access or sound hardware
+is needed.
+"""
+
+import resource
+import sys
+
+from argparse import ArgumentParser
+from threading import Event
+from time import time
+
+from application.notification import IObserver, NotificationCenter
+from application.python import Null
+from eventlib import api, coros
+from zope.interface import implementer
+
+from sipsimple.account import Account, BonjourAccount
+from sipsimple.application import SIPApplication
+from sipsimple.configuration.datatypes import PortRange, SIPTransportList
+from sipsimple.configuration.settings import SIPSimpleSettings
+from sipsimple.core import Engine, Route, SIPURI, ToHeader
+from sipsimple.session import Session
+from sipsimple.storage import MemoryStorage
+from sipsimple.streams import MediaStreamRegistry
+from sipsimple.threading import run_in_twisted_thread
+from sipsimple.threading.green import run_in_green_thread
+
+
+def percentile(values, fraction):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(int(len(values) * fraction), len(values) - 1)]
+
+
+def current_rss():
+    # resident set size in bytes, as reported by the kernel for this process
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * resource.getpagesize()
+    except (OSError, IndexError, ValueError):
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+@implementer(IObserver)
+class SessionBenchmark(object):
+
+    def __init__(self, calls, concurrency, transport, port, hold_time, timeout):
+        self.calls = calls
+        self.concurrency = concurrency
+        self.transport = transport
+        self.port = port
+        self.hold_time = hold_time
+        self.timeout = timeout
+        self.caller = None
+        self.callee = None
+        self.setup_times = []
+        self.failed = 0
+        self.ended = Event()
+        self.results = None
+        self._call_times = {}
+        self._done = None
+        self._semaphore = None
+        self._completed = 0
+
+    def run(self):
+        notification_center = NotificationCenter()
+        notification_center.add_observer(self, sender=SIPApplication())
+        notification_center.add_observer(self, name='SIPSessionNewIncoming')
+        notification_center.add_observer(self, name='SIPSessionDidStart')
+        notification_center.add_observer(self, name='SIPSessionDidEnd')
+        notification_center.add_observer(self, name='SIPSessionDidFail')
+        SIPApplication().start(MemoryStorage())
+        self.ended.wait()
+        return self.results
+
+    @run_in_twisted_thread
+    def handle_notification(self, notification):
+        handler = getattr(self, '_NH_%s' % notification.name, Null)
+        handler(notification)
+
+    def _NH_SIPApplicationWillStart(self, notification):
+        settings = SIPSimpleSettings()
+        settings.audio.input_device = None
+        settings.audio.output_device = None
+        settings.audio.alert_device = None
+        settings.video.device = None
+        settings.sip.transport_list = SIPTransportList([self.transport])
+        settings.sip.udp_port = self.port
+        settings.sip.tcp_port = self.port
+        settings.rtp.port_range = PortRange(40000, 60000)
+        settings.save()
+
+        bonjour_account = BonjourAccount()
+        if bonjour_account.enabled:
+            bonjour_account.enabled = False
+            bonjour_account.save()
+
+        for name in ('caller', 'callee'):
+            account = Account('%s@127.0.0.1' % name)
+            account.enabled = True
+            account.sip.register = False
+            account.rtp.encryption.enabled = False
+            account.nat_traversal.use_ice = False
+            account.save()
+            setattr(self, name, account)
+
+    def _NH_SIPApplicationDidStart(self, notification):
+        self._drive()
+
+    def _NH_SIPApplicationDidEnd(self, notification):
+        self.ended.set()
+
+    def _NH_SIPSessionNewIncoming(self, notification):
+        session = notification.sender
+        if session.account is self.callee:
+            session.accept(notification.data.streams)
+
+    def _NH_SIPSessionDidStart(self, notification):
+        session = notification.sender
+        if session in self._call_times:
+            self.setup_times.append(time() - self._call_times[session])
+            self._end_session(session)
+
+    def _NH_SIPSessionDidEnd(self, notification):
+        self._finish_call(notification.sender)
+
+    def _NH_SIPSessionDidFail(self, notification):
+        if notification.sender in self._call_times:
+            self.failed += 1
+        self._finish_call(notification.sender)
+
+    @run_in_green_thread
+    def _end_session(self, session):
+        if self.hold_time:
+            api.sleep(self.hold_time)
+        session.end()
+
+    def _finish_call(self, session):
+        if self._call_times.pop(session, None) is None:
+            return
+        self._completed += 1
+        self._semaphore.release()
+        if self._completed == self.calls:
+            self._done.send()
+
+    @run_in_green_thread
+    def _drive(self):
+        engine = Engine()
+        local_port = engine.udp_port if self.transport == 'udp' else engine.tcp_port
+        target = SIPURI(user='callee', host='127.0.0.1', port=local_port, parameters={'transport': self.transport})
+        route = Route('127.0.0.1', port=local_port, transport=self.transport)
+
+        self._done = coros.event()
+        self._semaphore = coros.Semaphore(self.concurrency)
+
+        start_usage = resource.getrusage(resource.RUSAGE_SELF)
+        start_rss = current_rss()
+        start_time = time()
+        try:
+            with api.timeout(self.timeout):
+                for i in range(self.calls):
+                    self._semaphore.acquire()
+                    session = Session(self.caller)
+                    self._call_times[session] = time()
+                    session.connect(ToHeader(target), [route], [MediaStreamRegistry.AudioStream()])
+                self._done.wait()
+        except api.TimeoutError:
+            pass
+        duration = time() - start_time
+        end_usage = resource.getrusage(resource.RUSAGE_SELF)
+        end_rss = current_rss()
+
+        completed = self._completed
+        cpu_time = (end_usage.ru_utime - start_usage.ru_utime) + (end_usage.ru_stime - start_usage.ru_stime)
+        self.results = dict(calls=self.calls,
+                            completed=completed,
+                            failed=self.failed,
+                            duration=duration,
+                            cps=completed / duration if duration else 0.0,
+                            setup_p50=percentile(self.setup_times, 0.50),
+                            setup_p90=percentile(self.setup_times, 0.90),
+                            setup_p99=percentile(self.setup_times, 0.99),
+                            setup_max=max(self.setup_times or [0.0]),
+                            cpu_per_1k=cpu_time * 1000 / completed if completed else 0.0,
+                            rss_per_1k=(end_rss - start_rss) * 1000 / completed if completed else 0.0)
+        SIPApplication().stop()
+
+
+def main():
+    parser = ArgumentParser(description='Loopback calls-per-second benchmark for the SIP session layer')
+    parser.add_argument('-n', '--calls', type=int, default=1000, help='the number of calls to place (default: %(default)s)')
+    parser.add_argument('-c', '--concurrency', type=int, default=50, help='the maximum number of calls in progress (default: %(default)s)')
+    parser.add_argument('-t', '--transport', choices=('udp', 'tcp'), default='udp', help='the SIP transport to use (default: %(default)s)')
+    parser.add_argument('-p', '--port', type=int, default=0, help='the local SIP port, 0 for a random one (default: %(default)s)')
+    parser.add_argument('--hold-time', type=float, default=0, help='seconds to keep each call established (default: %(default)s)')
+    parser.add_argument('--timeout', type=float, default=600, help='maximum duration of the run in seconds (default: %(default)s)')
+    options = parser.parse_args()
+
+    benchmark = SessionBenchmark(options.calls, options.concurrency, options.transport, options.port, options.hold_time, options.timeout)
+    results = benchmark.run()
+    if results is None:
+        print('The benchmark did not run, the application failed to start', file=sys.stderr)
+        return 1
+
+    print('Calls:            %(completed)d/%(calls)d completed, %(failed)d failed' % results)
+    print('Duration:         %(duration).2f s' % results)
+    print('Calls per second: %(cps).1f' % results)
+    print('Setup latency:    p50=%.1fms p90=%.1fms p99=%.1fms max=%.1fms' % tuple(1000 * results[key] for key in ('setup_p50', 'setup_p90', 'setup_p99', 'setup_max')))
+    print('CPU per 1k calls: %(cpu_per_1k).2f s' % results)
+    print('RSS per 1k calls: %.2f MB' % (results['rss_per_1k'] / 1024 / 1024))
+    return 0 if results['completed'] == results['calls'] else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
+
@@ -6,15 +6,18 @@ multiple SIP accounts and their properties.
 
 __all__ = ['Account', 'BonjourAccount', 'AccountManager']
 
+import os
+
 from itertools import chain
 from threading import Lock
+from time import time
 
 from application.notification import IObserver, NotificationCenter, NotificationData
 from application.python import Null
 from application.python.descriptor import classproperty
 from application.python.types import Singleton
 from application.system import host as Host
-from eventlib import coros, proc
+from eventlib import api, coros, proc
 from gnutls.crypto import X509Certificate, X509PrivateKey
 from gnutls.errors import GNUTLSError
 from gnutls.interfaces.twisted import X509Credentials
@@ -30,6 +33,7 @@ from sipsimple.configuration import ConfigurationManager, Setting, SettingsGroup
 from sipsimple.configuration.datatypes import AudioCodecList, MSRPConnectionModel, MSRPRelayAddress, MSRPTransport, NonNegativeInteger, Path, SIPAddress, SIPProxyAddress, SRTPKeyNegotiation, SIPTransport, STUNServerAddressList, VideoCodecList, XCAPRoot
 from sipsimple.configuration.settings import SIPSimpleSettings
 from sipsimple.payloads import ParserError
+from sipsimple.payloads.dialoginfo import DialogInfoDocument
 from sipsimple.payloads.messagesummary import MessageSummary
 from sipsimple.payloads.pidf import PIDFDocument
 from sipsimple.payloads.rlsnotify import RLSNotify
@@ -99,6 +103,96 @@ class MSRPSettings(SettingsGroup):
     connection_model = Setting(type=MSRPConnectionModel, default='relay')
 
 
+@implementer(IObserver)
+class TLSCredentialsCache(object, metaclass=Singleton):
+    """
+    Process wide cache for the certificate, private key and trusted CAs that
+    are loaded from the files configured in the tls.certificate and the
+    tls.ca_list settings. Each file is parsed only once and is parsed again
+    only after its modification time, size or inode changed or after the TLS
+    settings were modified.
+    """
+
+    def __init__(self):
+        self._lock = Lock()
+        self._entries = {}
+        notification_center = NotificationCenter()
+        notification_center.add_observer(self, name='CFGSettingsObjectDidChange', sender=SIPSimpleSettings())
+
+    def get_certificate(self, path):
+        """Return the (certificate, private_key) tuple loaded from the given Path"""
+        if path is None:
+            return None, None
+        return self._get('certificate', path.normalized, self._load_certificate, (None, None))
+
+    def get_ca_list(self, path):
+        """Return the list of trusted CA certificates loaded from the given Path"""
+        if path is None:
+            return []
+        return list(self._get('ca_list', path.normalized, self._load_ca_list, []))
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def _get(self, kind, filename, loader, default):
+        try:
+            file_stat = os.stat(filename)
+        except OSError:
+            with self._lock:
+                self._entries.pop((kind, filename), None)
+            return default
+        file_key = (file_stat.st_mtime_ns, file_stat.st_size, file_stat.st_ino)
+        with self._lock:
+            entry = self._entries.get((kind, filename))
+            if entry is not None and entry[0] == file_key:
+                return entry[1]
+        value = loader(filename)
+        with self._lock:
+            self._entries[(kind, filename)] = file_key, value
+        return value
+
+    @staticmethod
+    def _load_certificate(filename):
+        try:
+            with open(filename) as f:
+                certificate_data = f.read()
+            return X509Certificate(certificate_data), X509PrivateKey(certificate_data)
+        except (OSError, GNUTLSError, UnicodeDecodeError):
+            return None, None
+
+    @staticmethod
+    def _load_ca_list(filename):
+        try:
+            with open(filename) as f:
+                ca_text = f.read()
+        except (OSError, UnicodeDecodeError):
+            return []
+        trusted_cas = []
+        certificate_lines = None
+        for line in ca_text.split('\n'):
+            if 'BEGIN CERT' in line:
+                certificate_lines = [line]
+            elif 'END CERT' in line and certificate_lines is not None:
+                certificate_lines.append(line)
+                try:
+                    trusted_cas.append(X509Certificate('\n'.join(certificate_lines) + '\n'))
+                except (GNUTLSError, ValueError):
+                    pass
+                certificate_lines = None
+            elif certificate_lines is not None:
+                certificate_lines.append(line)
+        return trusted_cas
+
+    def handle_notification(self, notification):
+        handler = getattr(self, '_NH_%s' % notification.name, Null)
+        handler(notification)
+
+    def _NH_CFGSettingsObjectDidChange(self, notification):
+        if {'tls.certificate', 'tls.ca_list'}.intersection(notification.data.modified):
+            self.clear()
+
+
 @implementer(IObserver)
 class Account(SettingsObject):
     """
@@ -149,27 +243,29 @@ class Account(SettingsObject):
 
     def __init__(self, id):
         self.contact = ContactURIFactory()
-        self.xcap_manager = XCAPManager(self)
+        # The XCAP manager and the subscribers and publishers are only created for the features that are in use,
+        # as they are expensive to keep around for large numbers of accounts that do not need them.
+        self.xcap_manager = XCAPManager(self) if self.xcap.enabled or self.xcap.discovered else None
         self._started = False
         self._deleted = False
         self._active = False
         self._activation_lock = coros.Semaphore(1)
         self._registrar = Registrar(self)
-        self._mwi_subscriber = MWISubscriber(self)
-        self._pwi_subscriber = PresenceWinfoSubscriber(self)
-        self._dwi_subscriber = DialogWinfoSubscriber(self)
-        self._presence_subscriber = PresenceSubscriber(self)
-        self._self_presence_subscriber = SelfPresenceSubscriber(self)
-        self._dialog_subscriber = DialogSubscriber(self)
-        self._presence_publisher = PresencePublisher(self)
-        self._dialog_publisher = DialogPublisher(self)
+        self._mwi_subscriber = None
+        self._pwi_subscriber = None
+        self._dwi_subscriber = None
+        self._presence_subscriber = None
+        self._self_presence_subscriber = None
+        self._dialog_subscriber = None
+        self._presence_publisher = None
+        self._dialog_publisher = None
+        self._presence_state = None
+        self._dialog_state = None
         self._mwi_voicemail_uri = None
         self._pwi_version = None
         self._dwi_version = None
         self._presence_version = None
         self._dialog_version = None
-        self.trusted_cas = []
-        self.ca_list = None
 
     def start(self):
         if self._started or self._deleted:
@@ -180,15 +276,12 @@ class Account(SettingsObject):
         notification_center.post_notification('SIPAccountWillStart', sender=self)
         notification_center.add_observer(self, name='CFGSettingsObjectDidChange', sender=self)
         notification_center.add_observer(self, name='CFGSettingsObjectDidChange', sender=SIPSimpleSettings())
-        notification_center.add_observer(self, name='XCAPManagerDidDiscoverServerCapabilities', sender=self.xcap_manager)
-        notification_center.add_observer(self, sender=self._mwi_subscriber)
-        notification_center.add_observer(self, sender=self._pwi_subscriber)
-        notification_center.add_observer(self, sender=self._dwi_subscriber)
-        notification_center.add_observer(self, sender=self._presence_subscriber)
-        notification_center.add_observer(self, sender=self._self_presence_subscriber)
-        notification_center.add_observer(self, sender=self._dialog_subscriber)
 
-        self.xcap_manager.init()
+        if self.xcap_manager is None and self.xcap.enabled:
+            self.xcap_manager = XCAPManager(self)
+        if self.xcap_manager is not None:
+            notification_center.add_observer(self, name='XCAPManagerDidDiscoverServerCapabilities', sender=self.xcap_manager)
+            self.xcap_manager.init()
         if self.enabled:
             self._activate()
 
@@ -197,19 +290,15 @@ class Account(SettingsObject):
             return
         self._started = False
 
-        self._deactivate()
+        # a registration that is persisted is kept at the registrar while the account is stopped, unless the account is deleted
+        self._deactivate(keep_registration=not self._deleted)
 
         notification_center = NotificationCenter()
         notification_center.post_notification('SIPAccountWillStop', sender=self)
         notification_center.remove_observer(self, name='CFGSettingsObjectDidChange', sender=self)
         notification_center.remove_observer(self, name='CFGSettingsObjectDidChange', sender=SIPSimpleSettings())
-        notification_center.remove_observer(self, name='XCAPManagerDidDiscoverServerCapabilities', sender=self.xcap_manager)
-        notification_center.remove_observer(self, sender=self._mwi_subscriber)
-        notification_center.remove_observer(self, sender=self._pwi_subscriber)
-        notification_center.remove_observer(self, sender=self._dwi_subscriber)
-        notification_center.remove_observer(self, sender=self._presence_subscriber)
-        notification_center.remove_observer(self, sender=self._self_presence_subscriber)
-        notification_center.remove_observer(self, sender=self._dialog_subscriber)
+        if self.xcap_manager is not None:
+            notification_center.remove_observer(self, name='XCAPManagerDidDiscoverServerCapabilities', sender=self.xcap_manager)
 
     @run_in_green_thread
     def delete(self):
@@ -218,14 +307,6 @@ class Account(SettingsObject):
         self._deleted = True
         self.stop()
         self._registrar = None
-        self._mwi_subscriber = None
-        self._pwi_subscriber = None
-        self._dwi_subscriber = None
-        self._presence_subscriber = None
-        self._self_presence_subscriber = None
-        self._dialog_subscriber = None
-        self._presence_publisher = None
-        self._dialog_publisher = None
         self.xcap_manager = None
         SettingsObject.delete(self)
 
@@ -237,12 +318,8 @@ class Account(SettingsObject):
     @run_in_green_thread
     def resubscribe(self):
         if self._started:
-            self._mwi_subscriber.resubscribe()
-            self._pwi_subscriber.resubscribe()
-            self._dwi_subscriber.resubscribe()
-            self._presence_subscriber.resubscribe()
-            self._self_presence_subscriber.resubscribe()
-            self._dialog_subscriber.resubscribe()
+            for subscriber in self._subscribers:
+                subscriber.resubscribe()
 
     @property
     def credentials(self):
@@ -267,56 +344,10 @@ class Account(SettingsObject):
 
     @property
     def tls_credentials(self):
-        # This property can be optimized to cache the credentials it loads from disk,
-        # however this is not a time consuming operation (~ 3000 req/sec). -Luci
-
         settings = SIPSimpleSettings()
-        tls_certificate  = settings.tls.certificate
-
-        certificate = None
-        private_key = None
-
-        if tls_certificate is not None:
-            try:
-                certificate_data = open(tls_certificate.normalized).read()
-                certificate = X509Certificate(certificate_data)
-                private_key = X509PrivateKey(certificate_data)
-            except (FileNotFoundError, GNUTLSError, UnicodeDecodeError):
-                pass
-                
-        trusted_cas = []
-        ca_list  = settings.tls.ca_list
-
-        if ca_list is not None:
-            if len(self.trusted_cas) > 0:
-                trusted_cas = self.trusted_cas
-            else:
-                crt = None
-                start = False
-                try:
-                    ca_text = open(ca_list.normalized).read()
-                except (FileNotFoundError, GNUTLSError, UnicodeDecodeError):
-                    ca_text = ''
-            
-                for line in ca_text.split("\n"):
-                   if "BEGIN CERT" in line:
-                      start = True
-                      crt = line + "\n"
-                   elif "END CERT" in line:
-                      crt = crt + line + "\n"
-                      end = True
-                      start = False
-                      try:
-                          trusted_cas.append(X509Certificate(crt))
-                      except (GNUTLSError, ValueError) as e:
-                          continue
-      
-                   elif start:
-                      crt = crt + line + "\n"
-
-                self.trusted_cas = trusted_cas
-                self.ca_list = ca_list
-
+        credentials_cache = TLSCredentialsCache()
+        certificate, private_key = credentials_cache.get_certificate(settings.tls.certificate)
+        trusted_cas = credentials_cache.get_ca_list(settings.tls.ca_list)
         credentials = X509Credentials(certificate, private_key, trusted_cas)
         credentials.verify_peer = settings.tls.verify_server
         return credentials
@@ -331,31 +362,36 @@ class Account(SettingsObject):
 
     @property
     def presence_state(self):
-        try:
-            return self._presence_publisher.state
-        except AttributeError:
-            return None
+        return self._presence_state
 
     @presence_state.setter
     def presence_state(self, state):
-        try:
+        if state is not None and not isinstance(state, PIDFDocument.root_element):
+            raise ValueError("state must be a %s document or None" % PIDFDocument.root_element.__name__)
+        self._presence_state = state
+        if self._presence_publisher is not None:
             self._presence_publisher.state = state
-        except AttributeError:
-            pass
 
     @property
     def dialog_state(self):
-        try:
-            return self._dialog_publisher.state
-        except AttributeError:
-            return None
+        return self._dialog_state
 
     @dialog_state.setter
     def dialog_state(self, state):
-        try:
+        if state is not None and not isinstance(state, DialogInfoDocument.root_element):
+            raise ValueError("state must be a %s document or None" % DialogInfoDocument.root_element.__name__)
+        self._dialog_state = state
+        if self._dialog_publisher is not None:
             self._dialog_publisher.state = state
-        except AttributeError:
-            pass
+
+    @property
+    def _subscribers(self):
+        subscribers = (self._mwi_subscriber, self._pwi_subscriber, self._dwi_subscriber, self._presence_subscriber, self._self_presence_subscriber, self._dialog_subscriber)
+        return [subscriber for subscriber in subscribers if subscriber is not None]
+
+    @property
+    def _publishers(self):
+        return [publisher for publisher in (self._presence_publisher, self._dialog_publisher) if publisher is not None]
 
     def handle_notification(self, notification):
         handler = getattr(self, '_NH_%s' % notification.name, Null)
@@ -363,11 +399,28 @@ class Account(SettingsObject):
 
     @run_in_green_thread
     def _NH_CFGSettingsObjectDidChange(self, notification):
-        if self._started and 'enabled' in notification.data.modified:
+        if not self._started or notification.sender is not self:
+            return
+        if 'enabled' in notification.data.modified:
             if self.enabled:
                 self._activate()
             else:
                 self._deactivate()
+            return
+        if 'xcap.enabled' in notification.data.modified and self.xcap.enabled and self.xcap_manager is None:
+            self._create_xcap_manager()
+        if not self._active:
+            return
+        if 'message_summary.enabled' in notification.data.modified:
+            if self.message_summary.enabled:
+                self._start_message_summary()
+            else:
+                self._stop_message_summary()
+        if 'presence.enabled' in notification.data.modified:
+            if self.presence.enabled:
+                self._start_presence()
+            else:
+                self._stop_presence()
 
     def _NH_XCAPManagerDidDiscoverServerCapabilities(self, notification):
         if self._started and self.xcap.discovered is False:
@@ -511,6 +564,65 @@ class Account(SettingsObject):
     def _NH_DialogSubscriptionDidFail(self, notification):
         self._dialog_version = None
 
+    def _create_xcap_manager(self):
+        self.xcap_manager = XCAPManager(self)
+        notification_center = NotificationCenter()
+        notification_center.add_observer(self, name='XCAPManagerDidDiscoverServerCapabilities', sender=self.xcap_manager)
+        self.xcap_manager.init()
+        if self._active:
+            self.xcap_manager.start()
+
+    def _start_message_summary(self):
+        if self._mwi_subscriber is not None:
+            return
+        self._mwi_subscriber = MWISubscriber(self)
+        notification_center = NotificationCenter()
+        notification_center.add_observer(self, sender=self._mwi_subscriber)
+        self._mwi_subscriber.start()
+
+    def _stop_message_summary(self):
+        subscriber, self._mwi_subscriber = self._mwi_subscriber, None
+        if subscriber is None:
+            return
+        subscriber.stop()
+        notification_center = NotificationCenter()
+        notification_center.remove_observer(self, sender=subscriber)
+
+    def _start_presence(self):
+        if self._presence_publisher is not None:
+            return
+        notification_center = NotificationCenter()
+        self._pwi_subscriber = PresenceWinfoSubscriber(self)
+        self._dwi_subscriber = DialogWinfoSubscriber(self)
+        self._presence_subscriber = PresenceSubscriber(self)
+        self._self_presence_subscriber = SelfPresenceSubscriber(self)
+        self._dialog_subscriber = DialogSubscriber(self)
+        self._presence_publisher = PresencePublisher(self)
+        self._presence_publisher.state = self._presence_state
+        self._dialog_publisher = DialogPublisher(self)
+        self._dialog_publisher.state = self._dialog_state
+        for subscriber in self._subscribers:
+            if subscriber is not self._mwi_subscriber:
+                notification_center.add_observer(self, sender=subscriber)
+                subscriber.start()
+        for publisher in self._publishers:
+            publisher.start()
+
+    def _stop_presence(self):
+        subscribers = [subscriber for subscriber in self._subscribers if subscriber is not self._mwi_subscriber]
+        publishers = self._publishers
+        self._pwi_subscriber = None
+        self._dwi_subscriber = None
+        self._presence_subscriber = None
+        self._self_presence_subscriber = None
+        self._dialog_subscriber = None
+        self._presence_publisher = None
+        self._dialog_publisher = None
+        proc.waitall([proc.spawn(handler.stop) for handler in subscribers + publishers])
+        notification_center = NotificationCenter()
+        for subscriber in subscribers:
+            notification_center.remove_observer(self, sender=subscriber)
+
     def _activate(self):
         with self._activation_lock:
             if self._active:
@@ -519,29 +631,25 @@ class Account(SettingsObject):
             notification_center.post_notification('SIPAccountWillActivate', sender=self)
             self._active = True
             self._registrar.start()
-            self._mwi_subscriber.start()
-            self._pwi_subscriber.start()
-            self._dwi_subscriber.start()
-            self._presence_subscriber.start()
-            self._self_presence_subscriber.start()
-            self._dialog_subscriber.start()
-            self._presence_publisher.start()
-            self._dialog_publisher.start()
+            if self.message_summary.enabled:
+                self._start_message_summary()
+            if self.presence.enabled:
+                self._start_presence()
             if self.xcap.enabled:
                 self.xcap_manager.start()
             notification_center.post_notification('SIPAccountDidActivate', sender=self)
 
-    def _deactivate(self):
+    def _deactivate(self, keep_registration=False):
         with self._activation_lock:
             if not self._active:
                 return
             notification_center = NotificationCenter()
             notification_center.post_notification('SIPAccountWillDeactivate', sender=self)
             self._active = False
-            handlers = [self._registrar, self._mwi_subscriber, self._pwi_subscriber, self._dwi_subscriber,
-                        self._presence_subscriber, self._self_presence_subscriber, self._dialog_subscriber,
-                        self._presence_publisher, self._dialog_publisher, self.xcap_manager]
-            proc.waitall([proc.spawn(handler.stop) for handler in handlers])
+            handlers = [proc.spawn(self._stop_message_summary), proc.spawn(self._stop_presence), proc.spawn(self._registrar.stop, keep_registration=keep_registration)]
+            if self.xcap_manager is not None:
+                handlers.append(proc.spawn(self.xcap_manager.stop))
+            proc.waitall(handlers)
             notification_center.post_notification('SIPAccountDidDeactivate', sender=self)
 
     def __repr__(self):
@@ -678,18 +786,8 @@ class BonjourAccount(SettingsObject):
 
     @property
     def tls_credentials(self):
-        # This property can be optimized to cache the credentials it loads from disk,
-        # however this is not a time consuming operation (~ 3000 req/sec). -Luci
         settings = SIPSimpleSettings()
-        tls_certificate  = settings.tls.certificate
-        if tls_certificate is not None:
-            certificate_data = open(tls_certificate.normalized).read()
-            certificate = X509Certificate(certificate_data)
-            private_key = X509PrivateKey(certificate_data)
-        else:
-            certificate = None
-            private_key = None
-
+        certificate, private_key = TLSCredentialsCache().get_certificate(settings.tls.certificate)
         credentials = X509Credentials(certificate, private_key, [])
         credentials.verify_peer = False
         return credentials
@@ -760,11 +858,29 @@ class AccountManager(object, metaclass=Singleton):
      * SIPAccountManagerDidRemoveAccount
      * SIPAccountManagerDidAddAccount
      * SIPAccountManagerDidChangeDefaultAccount
+     * SIPAccountManagerDidStartAccount
+
+    The accounts are started in stages from a green thread of its own when
+    the start method is called, which returns right away: the default account
+    first, followed by the other enabled accounts and the disabled ones. At
+    most startup_concurrency accounts are started at the same time, where an account which registers is considered to be starting
+    until its first registration attempt ended (or startup_timeout seconds
+    passed), so that a large number of accounts does not flood the DNS
+    servers and the registrars when the application starts. The enabled
+    accounts can also be started at a rate of at most startup_rate accounts
+    per second (0 means unlimited), though the pace of the registrations is
+    normally left to the RegistrationScheduler.
     """
 
+    startup_concurrency = 50
+    startup_rate = 0
+    startup_timeout = 30
+
     def __init__(self):
         self._lock = Lock()
         self.accounts = {}
+        self._startup_waiters = {}
+        self._startup_proc = None
         notification_center = NotificationCenter()
         notification_center.add_observer(self, name='CFGSettingsObjectWasActivated')
         notification_center.add_observer(self, name='CFGSettingsObjectWasCreated')
@@ -791,19 +907,68 @@ class AccountManager(object, metaclass=Singleton):
     def start(self):
         """
         Start the accounts, which will determine the ones with the enabled flag
-        set to activate.
+        set to activate. The accounts are started in the background and the
+        SIPAccountManagerDidStart notification is posted once all of them were
+        started.
         """
+        self._startup_proc = proc.spawn(self._start_accounts)
+
+    def _start_accounts(self):
         notification_center = NotificationCenter()
         notification_center.post_notification('SIPAccountManagerWillStart', sender=self, data=NotificationData(bonjour_available=_bonjour.available, accounts=list(a.id for a in self.accounts.values())))
-        proc.waitall([proc.spawn(account.start) for account in list(self.accounts.values())])
+        default_account = self.default_account
+        accounts = sorted(self.accounts.values(), key=lambda account: (account is not default_account, not account.enabled))
+        semaphore = coros.Semaphore(max(self.startup_concurrency, 1))
+        progress = NotificationData(started=0, total=len(accounts))
+        interval = 1.0 / self.startup_rate if self.startup_rate > 0 else 0
+        next_start = time()
+        procs = []
+        for account in accounts:
+            semaphore.acquire()
+            if account.enabled and interval:
+                delay = next_start - time()
+                if delay > 0:
+                    api.sleep(delay)
+                next_start = max(next_start, time()) + interval
+            procs.append(proc.spawn(self._start_account, account, semaphore, progress))
+        proc.waitall(procs)
+        self._startup_proc = None
         notification_center.post_notification('SIPAccountManagerDidStart', sender=self)
 
+    def _start_account(self, account, semaphore, progress):
+        notification_center = NotificationCenter()
+        waiter = None
+        if isinstance(account, Account) and account.enabled and account.sip.register:
+            waiter = self._startup_waiters[account] = coros.event()
+            notification_center.add_observer(self, sender=account, name='SIPAccountRegistrationDidSucceed')
+            notification_center.add_observer(self, sender=account, name='SIPAccountRegistrationDidFail')
+        try:
+            account.start()
+            if waiter is not None:
+                # the account keeps its place in the startup window until its first registration attempt ended
+                try:
+                    with api.timeout(self.startup_timeout):
+                        waiter.wait()
+                except api.TimeoutError:
+                    pass
+        finally:
+            if waiter is not None:
+                del self._startup_waiters[account]
+                notification_center.remove_observer(self, sender=account, name='SIPAccountRegistrationDidSucceed')
+                notification_center.remove_observer(self, sender=account, name='SIPAccountRegistrationDidFail')
+            semaphore.release()
+            progress.started += 1
+            notification_center.post_notification('SIPAccountManagerDidStartAccount', sender=self, data=NotificationData(account=account, started=progress.started, total=progress.total))
+
     def stop(self):
         """
         Stop the accounts, which will determine the ones that were enabled to
         deactivate. This method returns only once the accounts were stopped
         successfully or they timed out trying.
         """
+        if self._startup_proc is not None:
+            self._startup_proc.kill()
+            self._startup_proc = None
         notification_center = NotificationCenter()
         notification_center.post_notification('SIPAccountManagerWillEnd', sender=self)
         proc.waitall([proc.spawn(account.stop) for account in list(self.accounts.values())])
@@ -844,6 +1009,13 @@ class AccountManager(object, metaclass=Singleton):
             if SIPApplication.running:
                 call_in_green_thread(account.start)
 
+    def _NH_SIPAccountRegistrationDidSucceed(self, notification):
+        waiter = self._startup_waiters.get(notification.sender)
+        if waiter is not None and not waiter.ready():
+            waiter.send()
+
+    _NH_SIPAccountRegistrationDidFail = _NH_SIPAccountRegistrationDidSucceed
+
     def _NH_CFGSettingsObjectWasCreated(self, notification):
         if isinstance(notification.sender, Account):
             account = notification.sender
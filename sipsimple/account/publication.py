@@ -27,7 +27,7 @@ from sipsimple.threading.green import Command, run_in_green_thread
 
 
 
-Command.register_defaults('publish', refresh_interval=None)
+Command.register_defaults('publish', refresh_interval=None, body=None)
 
 
 class SameState(metaclass=MarkerType): pass
@@ -66,6 +66,8 @@ class Publisher(object, metaclass=ABCMeta):
     __nickname__  = PublisherNickname()
     __transports__ = frozenset(['tls', 'tcp', 'udp'])
 
+    publish_delay = 0.5             # seconds during which state changes are coalesced into a single PUBLISH
+    min_publish_interval = 2        # minimum number of seconds between the PUBLISH requests sent for state changes
 
     def __init__(self, account):
         self.account = account
@@ -80,6 +82,10 @@ class Publisher(object, metaclass=ABCMeta):
         self._dns_wait = 1
         self._publish_wait = 1
         self._publication_timer = None
+        self._pending_state = None
+        self._pending_timer = None
+        self._last_publish_time = 0
+        self._published_body = None
         self.__dict__['state'] = None
 
     @abstractproperty
@@ -163,9 +169,33 @@ class Publisher(object, metaclass=ABCMeta):
         if not self.active:
             return
         if state is None:
+            self._cancel_pending_publish()
             self._command_channel.send(Command('unpublish'))
-        else:
+        elif state is SameState:
             self._command_channel.send(Command('publish', state=state))
+        else:
+            # State changes are debounced and rate limited, only the latest state is published
+            self._pending_state = state
+            if self._pending_timer is None:
+                delay = max(self.publish_delay, self._last_publish_time + self.min_publish_interval - time())
+                self._pending_timer = reactor.callLater(delay, self._publish_pending)
+
+    def _publish_pending(self):
+        state, self._pending_state = self._pending_state, None
+        self._pending_timer = None
+        if not self.active or state is None:
+            return
+        body = state.toxml()
+        if self.publishing and body == self._published_body:
+            return
+        self._last_publish_time = time()
+        self._command_channel.send(Command('publish', state=state, body=body))
+
+    def _cancel_pending_publish(self):
+        if self._pending_timer is not None and self._pending_timer.active():
+            self._pending_timer.cancel()
+        self._pending_timer = None
+        self._pending_state = None
 
     def _run(self):
         while True:
@@ -216,7 +246,10 @@ class Publisher(object, metaclass=ABCMeta):
             else:
                 self._dns_wait = 1
 
-            body = None if command.state is SameState else command.state.toxml()
+            if command.state is SameState:
+                body = None
+            else:
+                body = command.body if command.body is not None else command.state.toxml()
 
             # Publish by trying each route in turn
             publish_timeout = time() + 30
@@ -234,7 +267,8 @@ class Publisher(object, metaclass=ABCMeta):
                         except PublicationETagError:
                             state = self.state # access self.state only once to avoid race conditions
                             if state is not None:
-                                self._publication.publish(state.toxml(), RouteHeader(route.uri), timeout=limit(remaining_time, min=1, max=10))
+                                body = state.toxml()
+                                self._publication.publish(body, RouteHeader(route.uri), timeout=limit(remaining_time, min=1, max=10))
                             else:
                                 command.signal()
                                 return
@@ -269,6 +303,8 @@ class Publisher(object, metaclass=ABCMeta):
                     else:
                         self.publishing = True
                         self._publish_wait = 1
+                        if body is not None:
+                            self._published_body = body
                         command.signal()
                         break
             else:
@@ -278,6 +314,7 @@ class Publisher(object, metaclass=ABCMeta):
                 raise PublicationError('No more routes to try', retry_after=retry_after)
         except PublicationError as e:
             self.publishing = False
+            self._published_body = None
             notification_center.discard_observer(self, sender=self._publication)
             def publish(e):
                 if self.active:
@@ -296,8 +333,10 @@ class Publisher(object, metaclass=ABCMeta):
         if self._publication_timer is not None and self._publication_timer.active():
             self._publication_timer.cancel()
         self._publication_timer = None
+        self._cancel_pending_publish()
         publishing = self.publishing
         self.publishing = False
+        self._published_body = None
         if self._publication is not None:
             notification_center = NotificationCenter()
             if publishing:
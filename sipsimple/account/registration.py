@@ -1,28 +1,37 @@
 
 """Implements the registration handler"""
 
-__all__ = ['Registrar']
+__all__ = ['Registrar', 'RegistrationScheduler', 'RegistrationSnapshot', 'RegistrationSnapshotStorage']
 
+import json
+import os
+import platform
 import random
 
+from collections import deque
+from heapq import heappop, heappush
+from itertools import count
 from time import time
 
 from application.notification import IObserver, NotificationCenter, NotificationData
 from application.python import Null, limit
-from application.system import host as Host
+from application.python.types import Singleton
+from application.system import host as Host, makedirs, openfile, unlink
 from eventlib import coros, proc
 from twisted.internet import reactor
 from zope.interface import implementer
 
-from sipsimple.core import ContactHeader, FromHeader, Header, Registration, RouteHeader, SIPURI, SIPCoreError, NoGRUU
+from sipsimple.core import ContactHeader, FromHeader, Header, Registration, Route, RouteHeader, SIPURI, SIPCoreError, NoGRUU
 from sipsimple.configuration.settings import SIPSimpleSettings
 from sipsimple.lookup import DNSLookup, DNSLookupError
-from sipsimple.threading import run_in_twisted_thread
+from sipsimple.threading import run_in_thread, run_in_twisted_thread
 from sipsimple.threading.green import Command, run_in_green_thread
 
 
 
 Command.register_defaults('register', refresh_interval=None)
+Command.register_defaults('resume', snapshot=None)
+Command.register_defaults('terminate', keep_registration=False)
 
 
 class SIPRegistrationDidFail(Exception):
@@ -40,8 +49,219 @@ class RegistrationError(Exception):
         self.refresh_interval = refresh_interval
 
 
+class ScheduledRegistration(object):
+    __slots__ = ('registrar', 'commands', 'deadline', 'initial', 'cancelled')
+
+    def __init__(self, registrar, commands, deadline, initial):
+        self.registrar = registrar
+        self.commands = commands
+        self.deadline = deadline
+        self.initial = initial
+        self.cancelled = False
+
+
+class RegistrationScheduler(object, metaclass=Singleton):
+    """
+    Owns the refresh and retry deadlines of all registrars. Refreshes are
+    spread with a random jitter and the registrations which are due are
+    started at no more than `rate` REGISTER requests per second, initial
+    registrations (and re-registrations) before refreshes.
+    """
+
+    rate = 20                       # maximum number of REGISTER requests started per second
+    jitter = 0.1                    # fraction of the refresh interval over which the refreshes are spread
+    network_change_spread = 5       # seconds over which the re-registrations triggered by a network change are spread
+
+    def __init__(self):
+        self.dispatched = 0
+        self.max_lag = 0.0
+        self._total_lag = 0.0
+        self._entries = {}
+        self._heap = []
+        self._initial = deque()
+        self._refresh = deque()
+        self._sequence = count()
+        self._tokens = self.rate
+        self._last_update = time()
+        self._timer = None
+
+    @property
+    def statistics(self):
+        """The number of scheduled registrations, how many of them are due and waiting for the rate limit and how late they run"""
+        now = time()
+        waiting = [entry for entry in self._initial + self._refresh if not entry.cancelled]
+        return dict(queue_depth=len(self._entries),
+                    waiting=len(waiting),
+                    dispatched=self.dispatched,
+                    current_lag=max((now - entry.deadline for entry in waiting), default=0.0),
+                    average_lag=self._total_lag / self.dispatched if self.dispatched else 0.0,
+                    max_lag=self.max_lag)
+
+    def refresh_delay(self, expires):
+        """The delay after which a registration which expires in the given number of seconds is refreshed"""
+        delay = max(1, expires - 30, expires / 2)
+        return delay * random.uniform(1 - self.jitter, 1)
+
+    @run_in_twisted_thread
+    def schedule(self, registrar, commands, delay=0, initial=False, replace=True):
+        """
+        Send the commands to the registrar after the given delay, subject to
+        the rate limit. Any registration scheduled earlier for the registrar is
+        replaced, unless replace is False, in which case nothing is done if a
+        registration is already scheduled.
+        """
+        entry = self._entries.get(registrar)
+        if entry is not None:
+            if not replace:
+                return
+            entry.cancelled = True
+        entry = self._entries[registrar] = ScheduledRegistration(registrar, commands, time() + delay, initial)
+        heappush(self._heap, (entry.deadline, next(self._sequence), entry))
+        if self._timer is None or entry.deadline < self._timer.getTime():
+            self._process()
+
+    @run_in_twisted_thread
+    def cancel(self, registrar):
+        entry = self._entries.pop(registrar, None)
+        if entry is not None:
+            entry.cancelled = True
+
+    def _ready_queue(self):
+        for queue in (self._initial, self._refresh):
+            while queue and queue[0].cancelled:
+                queue.popleft()
+            if queue:
+                return queue
+        return None
+
+    def _cost(self, entry):
+        # a registration never needs more tokens than the bucket can hold, or it would never be sent
+        return limit(len(entry.commands), min=1, max=self.rate)
+
+    def _process(self):
+        if self._timer is not None and self._timer.active():
+            self._timer.cancel()
+        self._timer = None
+        now = time()
+        while self._heap and self._heap[0][0] <= now:
+            entry = heappop(self._heap)[2]
+            if not entry.cancelled:
+                (self._initial if entry.initial else self._refresh).append(entry)
+        self._tokens = min(self.rate, self._tokens + (now - self._last_update) * self.rate)
+        self._last_update = now
+        while True:
+            queue = self._ready_queue()
+            if queue is None or self._tokens < self._cost(queue[0]):
+                break
+            entry = queue.popleft()
+            del self._entries[entry.registrar]
+            self._tokens -= self._cost(entry)
+            lag = now - entry.deadline
+            self.dispatched += 1
+            self._total_lag += lag
+            self.max_lag = max(self.max_lag, lag)
+            if entry.registrar.active:
+                for command in entry.commands:
+                    entry.registrar._command_channel.send(command)
+        queue = self._ready_queue()
+        if queue is not None:
+            delay = (self._cost(queue[0]) - self._tokens) / self.rate
+        elif self._heap:
+            delay = self._heap[0][0] - now
+        else:
+            return
+        self._timer = reactor.callLater(max(delay, 0), self._process)
+
+
+class RegistrationSnapshot(object):
+    """The state of a registration which is needed to continue it after the application is restarted"""
+
+    __slots__ = ('contact', 'route', 'call_id', 'cseq', 'expires', 'refresh', 'public_gruu', 'temporary_gruu')
+
+    def __init__(self, contact, route, call_id, cseq, expires, refresh, public_gruu=None, temporary_gruu=None):
+        self.contact = contact
+        self.route = route
+        self.call_id = call_id
+        self.cseq = cseq
+        self.expires = expires
+        self.refresh = refresh
+        self.public_gruu = public_gruu
+        self.temporary_gruu = temporary_gruu
+
+    def __getstate__(self):
+        state = {name: getattr(self, name) for name in self.__slots__}
+        state['route'] = dict(address=self.route.address, port=self.route.port, transport=self.route.transport, tls_name=self.route.tls_name)
+        return state
+
+    def __setstate__(self, state):
+        for name in self.__slots__:
+            setattr(self, name, state[name])
+        self.route = Route(**state['route'])
+
+
+class RegistrationSnapshotStorage(object, metaclass=Singleton):
+    """
+    Keeps a snapshot of the registration of each account in a file in the
+    application data directory, so that a registration which is still valid
+    when the application is restarted is resumed instead of being sent again.
+    Snapshots are only kept if the sip.persist_registrations setting is
+    enabled and the application storage has a data directory.
+    """
+
+    @property
+    def directory(self):
+        from sipsimple.application import SIPApplication
+        from sipsimple.storage import ISIPSimpleApplicationDataStorage
+        settings = SIPSimpleSettings()
+        if not settings.sip.persist_registrations or not ISIPSimpleApplicationDataStorage.providedBy(SIPApplication.storage):
+            return None
+        return os.path.join(SIPApplication.storage.directory, 'registrations')
+
+    def load(self, account_id):
+        directory = self.directory
+        if directory is None:
+            return None
+        try:
+            with open(os.path.join(directory, account_id)) as f:
+                snapshot = RegistrationSnapshot.__new__(RegistrationSnapshot)
+                snapshot.__setstate__(json.load(f))
+        except (OSError, ValueError, KeyError, TypeError):
+            return None
+        return snapshot
+
+    def save(self, account_id, snapshot):
+        directory = self.directory
+        if directory is not None:
+            self._write(directory, account_id, json.dumps(snapshot.__getstate__()))
+
+    def discard(self, account_id):
+        directory = self.directory
+        if directory is not None:
+            self._write(directory, account_id, None)
+
+    @run_in_thread('file-io')
+    def _write(self, directory, account_id, data):
+        filename = os.path.join(directory, account_id)
+        try:
+            if data is None:
+                unlink(filename)
+                return
+            tmp_filename = '%s.%d.%08X' % (filename, os.getpid(), random.getrandbits(32))
+            makedirs(directory)
+            file = openfile(tmp_filename, 'w', permissions=0o600)
+            file.write(data)
+            file.close()
+            if platform.system() == 'Windows':
+                # os.rename does not work on Windows if the destination file already exists.
+                unlink(filename)
+            os.rename(tmp_filename, filename)
+        except (IOError, OSError):
+            pass
+
+
 @implementer(IObserver)
 class Registrar(object):
+    resume_margin = 30              # minimum number of seconds a persisted registration must still be valid for to be resumed
 
     def __init__(self, account):
         self.account = account
@@ -54,7 +274,6 @@ class Registrar(object):
         self._registration = None
         self._dns_wait = 1
         self._register_wait = 1
-        self._registration_timer = None
 
     def start(self):
         if self.started:
@@ -68,7 +287,12 @@ class Registrar(object):
         if self.account.sip.register:
             self.activate()
 
-    def stop(self):
+    def stop(self, keep_registration=False):
+        """
+        Stop the registrar. If keep_registration is True and registrations are
+        persisted, the binding is left in place at the registrar so that it
+        can be resumed when the account is started again.
+        """
         if not self.started:
             return
         self.started = False
@@ -77,7 +301,7 @@ class Registrar(object):
         notification_center.remove_observer(self, name='CFGSettingsObjectDidChange', sender=self.account)
         notification_center.remove_observer(self, name='CFGSettingsObjectDidChange', sender=SIPSimpleSettings())
         notification_center.remove_observer(self, name='NetworkConditionsDidChange')
-        command = Command('terminate')
+        command = Command('terminate', keep_registration=keep_registration)
         self._command_channel.send(command)
         command.wait()
         self._command_proc = None
@@ -86,18 +310,22 @@ class Registrar(object):
         if not self.started:
             raise RuntimeError("not started")
         self.active = True
-        self._command_channel.send(Command('register'))
+        snapshot = self._load_snapshot()
+        if snapshot is not None:
+            self._command_channel.send(Command('resume', snapshot=snapshot))
+        else:
+            RegistrationScheduler().schedule(self, [Command('register')], initial=True)
 
     def deactivate(self):
         if not self.started:
             raise RuntimeError("not started")
         self.active = False
+        RegistrationScheduler().cancel(self)
         self._command_channel.send(Command('unregister'))
 
     def reregister(self):
         if self.active:
-            self._command_channel.send(Command('unregister'))
-            self._command_channel.send(Command('register'))
+            RegistrationScheduler().schedule(self, [Command('unregister'), Command('register')], initial=True)
 
     def _run(self):
         while True:
@@ -109,10 +337,9 @@ class Registrar(object):
     def _CH_register(self, command):
         notification_center = NotificationCenter()
         settings = SIPSimpleSettings()
+        scheduler = RegistrationScheduler()
 
-        if self._registration_timer is not None and self._registration_timer.active():
-            self._registration_timer.cancel()
-        self._registration_timer = None
+        scheduler.cancel(self)
 
         try:
             if Host.default_ip is None:
@@ -160,12 +387,7 @@ class Registrar(object):
                         contact_uri = self.account.contact[NoGRUU, route]
                     except KeyError:
                         continue
-                    contact_header = ContactHeader(contact_uri)
-                    instance_id = '"<%s>"' % settings.instance_id
-                    
-                    contact_header.parameters[b"+sip.instance"] = instance_id.encode()
-                    if self.account.nat_traversal.use_ice:
-                        contact_header.parameters[b"+sip.ice"] = None
+                    contact_header = self._make_contact_header(contact_uri)
                     route_header = RouteHeader(route.uri)
                     try:
                         self._registration.register(contact_header, route_header, timeout=limit(remaining_time, min=1, max=10))
@@ -226,6 +448,10 @@ class Registrar(object):
                                                              expires=notification.data.expires_in, registrar=route)
                         notification_center.post_notification('SIPAccountRegistrationDidSucceed', sender=self.account, data=notification_data)
                         self._register_wait = 1
+                        if notification.data.expires_in:
+                            refresh_delay = scheduler.refresh_delay(notification.data.expires_in)
+                            scheduler.schedule(self, [Command('register')], delay=refresh_delay)
+                            self._save_snapshot(contact_uri, route, notification.data.expires_in, refresh_delay)
                         command.signal()
                         break
             else:
@@ -235,24 +461,20 @@ class Registrar(object):
                 raise RegistrationError('No more routes to try', retry_after=retry_after)
         except RegistrationError as e:
             self.registered = False
+            RegistrationSnapshotStorage().discard(self.account.id)
             notification_center.discard_observer(self, sender=self._registration)
             notification_center.post_notification('SIPAccountRegistrationDidFail', sender=self.account, data=NotificationData(error=e.error, retry_after=e.retry_after))
-            def register(e):
-                if self.active:
-                    self._command_channel.send(Command('register', command.event, refresh_interval=e.refresh_interval))
-                self._registration_timer = None
-            self._registration_timer = reactor.callLater(e.retry_after, register, e)
+            scheduler.schedule(self, [Command('register', command.event, refresh_interval=e.refresh_interval)], delay=e.retry_after, initial=True)
             self._registration = None
             self.account.contact.public_gruu = None
             self.account.contact.temporary_gruu = None
 
     def _CH_unregister(self, command):
-        # Cancel any timer which would restart the registration process
-        if self._registration_timer is not None and self._registration_timer.active():
-            self._registration_timer.cancel()
-        self._registration_timer = None
+        # Cancel any scheduled registration which would restart the registration process
+        RegistrationScheduler().cancel(self)
         registered = self.registered
         self.registered = False
+        RegistrationSnapshotStorage().discard(self.account.id)
         if self._registration is not None:
             notification_center = NotificationCenter()
             if registered:
@@ -273,10 +495,93 @@ class Registrar(object):
             self.account.contact.temporary_gruu = None
         command.signal()
 
+    def _CH_resume(self, command):
+        notification_center = NotificationCenter()
+        scheduler = RegistrationScheduler()
+        snapshot = command.snapshot
+        remaining = snapshot.expires - time()
+        if self._registration is not None or remaining < self.resume_margin:
+            scheduler.schedule(self, [Command('register')], initial=True)
+            command.signal()
+            return
+        try:
+            contact_header = self._make_contact_header(self.account.contact[NoGRUU, snapshot.route])
+            self._registration = Registration(FromHeader(self.account.uri, self.account.display_name),
+                                              credentials=self.account.credentials,
+                                              duration=self.account.sip.register_interval,
+                                              extra_headers=[Header('Supported', 'gruu')])
+            self._registration.resume(contact_header, RouteHeader(snapshot.route.uri), snapshot.call_id, snapshot.cseq)
+        except (KeyError, SIPCoreError):
+            self._registration = None
+            scheduler.schedule(self, [Command('register')], initial=True)
+            command.signal()
+            return
+        notification_center.add_observer(self, sender=self._registration)
+        self.registered = True
+        for name in ('public_gruu', 'temporary_gruu'):
+            try:
+                setattr(self.account.contact, name, SIPURI.parse(getattr(snapshot, name)))
+            except (TypeError, SIPCoreError):
+                setattr(self.account.contact, name, None)
+        notification_data = NotificationData(contact_header=contact_header, contact_header_list=[contact_header], expires=int(remaining), registrar=snapshot.route)
+        notification_center.post_notification('SIPAccountRegistrationDidSucceed', sender=self.account, data=notification_data)
+        scheduler.schedule(self, [Command('register')], delay=max(0, snapshot.refresh - time()))
+        command.signal()
+
     def _CH_terminate(self, command):
-        self._CH_unregister(command)
+        if command.keep_registration and self.registered and RegistrationSnapshotStorage().directory is not None:
+            # Leave the binding in place, it is resumed from the snapshot when the account is started again
+            RegistrationScheduler().cancel(self)
+            self.registered = False
+            NotificationCenter().remove_observer(self, sender=self._registration)
+            self._registration = None
+            command.signal()
+        else:
+            self._CH_unregister(command)
         raise proc.ProcExit
 
+    def _make_contact_header(self, contact_uri):
+        settings = SIPSimpleSettings()
+        contact_header = ContactHeader(contact_uri)
+        instance_id = '"<%s>"' % settings.instance_id
+        contact_header.parameters[b"+sip.instance"] = instance_id.encode()
+        if self.account.nat_traversal.use_ice:
+            contact_header.parameters[b"+sip.ice"] = None
+        return contact_header
+
+    def _load_snapshot(self):
+        """
+        Return the persisted snapshot of the registration of the account if it
+        can be resumed, which is the case if it is valid for long enough and
+        it is for a contact at the address and port the account uses now. The
+        contact username of the account is set to the one in the snapshot.
+        """
+        snapshot = RegistrationSnapshotStorage().load(self.account.id)
+        if snapshot is None or snapshot.expires - time() < self.resume_margin:
+            return None
+        try:
+            snapshot_contact = SIPURI.parse(snapshot.contact)
+            contact = self.account.contact[NoGRUU, snapshot.route]
+        except (KeyError, SIPCoreError):
+            return None
+        if (snapshot_contact.host, snapshot_contact.port, snapshot_contact.transport) != (contact.host, contact.port, contact.transport):
+            return None
+        self.account.contact.username = snapshot_contact.user
+        return snapshot
+
+    def _save_snapshot(self, contact_uri, route, expires, refresh_delay):
+        call_id = self._registration.call_id
+        now = time()
+        snapshot = RegistrationSnapshot(contact=str(contact_uri),
+                                        route=route,
+                                        call_id=call_id.decode() if isinstance(call_id, bytes) else call_id,
+                                        cseq=self._registration.cseq,
+                                        expires=now + expires,
+                                        refresh=now + refresh_delay,
+                                        public_gruu=None if self.account.contact.public_gruu is None else str(self.account.contact.public_gruu),
+                                        temporary_gruu=None if self.account.contact.temporary_gruu is None else str(self.account.contact.temporary_gruu))
+        RegistrationSnapshotStorage().save(self.account.id, snapshot)
+
     @run_in_twisted_thread
     def handle_notification(self, notification):
         handler = getattr(self, '_NH_%s' % notification.name, Null)
@@ -299,8 +604,9 @@ class Registrar(object):
             self._data_channel.send_exception(SIPRegistrationDidNotEnd(notification.data))
 
     def _NH_SIPRegistrationWillExpire(self, notification):
+        # The refresh is normally scheduled before this point, only refresh now if it is not already pending
         if self.active:
-            self._command_channel.send(Command('register'))
+            RegistrationScheduler().schedule(self, [Command('register')], replace=False)
 
     @run_in_green_thread
     def _NH_CFGSettingsObjectDidChange(self, notification):
@@ -319,6 +625,6 @@ class Registrar(object):
 
     def _NH_NetworkConditionsDidChange(self, notification):
         if self.active:
-            self._command_channel.send(Command('unregister'))
-            self._command_channel.send(Command('register'))
+            scheduler = RegistrationScheduler()
+            scheduler.schedule(self, [Command('unregister'), Command('register')], delay=random.uniform(0, scheduler.network_change_spread), initial=True)
 
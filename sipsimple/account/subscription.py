@@ -62,6 +62,7 @@ class Subscriber(object, metaclass=ABCMeta):
     __nickname__   = SubscriberNickname()
     __transports__ = frozenset(['tls', 'tcp', 'udp'])
 
+    network_change_spread = 5       # seconds over which the re-subscriptions triggered by a network change are spread
 
     def __init__(self, account):
         self.account = account
@@ -317,6 +318,15 @@ class Subscriber(object, metaclass=ABCMeta):
             self._subscription = None
             self._subscription_proc = None
 
+    def _resubscribe_later(self, delay):
+        def subscribe():
+            self._subscription_timer = None
+            if self.active:
+                self._command_channel.send(Command('subscribe'))
+        if self._subscription_timer is not None and self._subscription_timer.active():
+            self._subscription_timer.cancel()
+        self._subscription_timer = reactor.callLater(delay, subscribe)
+
     @run_in_twisted_thread
     def handle_notification(self, notification):
         handler = getattr(self, '_NH_%s' % notification.name, Null)
@@ -340,7 +350,8 @@ class Subscriber(object, metaclass=ABCMeta):
 
     def _NH_NetworkConditionsDidChange(self, notification):
         if self.active:
-            self._command_channel.send(Command('subscribe'))
+            # Spread the re-subscriptions, as all the subscribers of all the accounts get this notification at the same time
+            self._resubscribe_later(random.uniform(0, self.network_change_spread))
 
 
 class MWISubscriber(Subscriber):
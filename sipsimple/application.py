@@ -27,6 +27,7 @@ from zope.interface import implementer
 from sipsimple.account import AccountManager
 from sipsimple.addressbook import AddressbookManager
 from sipsimple.audio import AudioDevice, RootAudioBridge
+from sipsimple.cdr import CDRManager
 from sipsimple.configuration import ConfigurationManager
 from sipsimple.configuration.settings import SIPSimpleSettings
 from sipsimple.core import AudioMixer, Engine, SIPCoreError, PJSIPError
@@ -206,6 +207,7 @@ class SIPApplication(object, metaclass=Singleton):
 
         account_manager = AccountManager()
         addressbook_manager = AddressbookManager()
+        cdr_manager = CDRManager()
         dns_manager = DNSManager()
         session_manager = SessionManager()
         settings = SIPSimpleSettings()
@@ -261,6 +263,12 @@ class SIPApplication(object, metaclass=Singleton):
         # initialize path for ZRTP cache file
         if ISIPSimpleApplicationDataStorage.providedBy(self.storage):
             self.engine.zrtp_cache = os.path.join(self.storage.directory, 'zrtp.db')
+            cdr_manager.default_directory = os.path.join(self.storage.directory, 'cdr')
+            dns_manager.cache_filename = os.path.join(self.storage.directory, 'dns_cache.json') if settings.sip.persist_dns_cache else None
+
+        # initialize the DNS probes
+        dns_manager.probed_domain = settings.sip.dns_probed_domain
+        dns_manager.fallback_nameservers = list(settings.sip.dns_fallback_nameservers)
 
         # save settings in case something was modified during startup
         settings.save()
@@ -270,6 +278,7 @@ class SIPApplication(object, metaclass=Singleton):
         account_manager.start()
         addressbook_manager.start()
         session_manager.start()
+        cdr_manager.start()
 
         notification_center.add_observer(self, name='CFGSettingsObjectDidChange')
         notification_center.add_observer(self, name='DNSNameserversDidChange')
@@ -300,6 +309,9 @@ class SIPApplication(object, metaclass=Singleton):
         procs = [proc.spawn(dns_manager.stop), proc.spawn(account_manager.stop), proc.spawn(addressbook_manager.stop), proc.spawn(session_manager.stop)]
         proc.waitall(procs)
 
+        # flush the call detail records of the sessions ended above
+        CDRManager().stop()
+
         # stop video device
         self.video_device.producer.close()
 
@@ -447,6 +459,10 @@ class SIPApplication(object, metaclass=Singleton):
                     self.engine.set_tcp_port(settings.sip.tcp_port)
                 if {'sip.tls_port', 'tls.ca_list', 'default_account', 'tls.verify_server', 'tls.certificate'}.intersection(notification.data.modified):
                     self._initialize_tls()
+                if {'sip.dns_probed_domain', 'sip.dns_fallback_nameservers'}.intersection(notification.data.modified):
+                    dns_manager = DNSManager()
+                    dns_manager.probed_domain = settings.sip.dns_probed_domain
+                    dns_manager.fallback_nameservers = list(settings.sip.dns_fallback_nameservers)
                 if 'rtp.port_range' in notification.data.modified:
                     self.engine.rtp_port_range = (settings.rtp.port_range.start, settings.rtp.port_range.end)
                 if 'rtp.audio_codec_list' in notification.data.modified:
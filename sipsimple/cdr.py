@@ -0,0 +1,208 @@
+"""Call detail records for SIP sessions"""
+
+
+__all__ = ['CDRManager']
+
+import csv
+import json
+import os
+
+from application.notification import IObserver, NotificationCenter
+from application.python import Null
+from application.python.types import Singleton
+from twisted.internet import reactor
+from zope.interface import implementer
+
+from sipsimple import log
+from sipsimple.configuration.settings import SIPSimpleSettings
+from sipsimple.threading import run_in_thread, run_in_twisted_thread
+from sipsimple.util import ISOTimestamp
+
+
+@implementer(IObserver)
+class CDRManager(object, metaclass=Singleton):
+    """
+    Collects a call detail record for every session and writes the records
+    to a rotating file in the cdr.directory (or in the default directory if
+    that is not set), as JSON lines or as CSV. The notification handlers only
+    take a snapshot of the session, the records are accumulated and written
+    in batches from the 'cdr-io' thread.
+    """
+
+    batch_size = 100
+    flush_interval = 5
+
+    fields = ('call_id', 'direction', 'account', 'local_identity', 'remote_identity', 'remote_user_agent', 'start_time', 'answer_time', 'end_time', 'duration', 'originator', 'end_reason', 'code', 'reason', 'streams')
+
+    def __init__(self):
+        self.default_directory = None
+        self._records = {}
+        self._pending = []
+        self._timer = None
+
+    def start(self):
+        notification_center = NotificationCenter()
+        notification_center.add_observer(self, name='SIPSessionNewIncoming')
+        notification_center.add_observer(self, name='SIPSessionNewOutgoing')
+        notification_center.add_observer(self, name='SIPSessionDidStart')
+        notification_center.add_observer(self, name='SIPSessionWillEnd')
+        notification_center.add_observer(self, name='SIPSessionDidEnd')
+        notification_center.add_observer(self, name='SIPSessionDidFail')
+
+    def stop(self):
+        notification_center = NotificationCenter()
+        notification_center.remove_observer(self, name='SIPSessionNewIncoming')
+        notification_center.remove_observer(self, name='SIPSessionNewOutgoing')
+        notification_center.remove_observer(self, name='SIPSessionDidStart')
+        notification_center.remove_observer(self, name='SIPSessionWillEnd')
+        notification_center.remove_observer(self, name='SIPSessionDidEnd')
+        notification_center.remove_observer(self, name='SIPSessionDidFail')
+        self._close_records('application shutdown')
+        self.flush()
+
+    @run_in_twisted_thread
+    def _close_records(self, end_reason):
+        # the sessions still in progress are recorded as ending now, so that their records are not lost
+        records, self._records = self._records, {}
+        for session, record in records.items():
+            if session.streams:
+                record['streams'] = self._stream_info(session.streams, include_statistics=True)
+            record['originator'] = 'local'
+            record['end_reason'] = end_reason
+            self._finish_record(session, record)
+
+    @run_in_twisted_thread
+    def flush(self):
+        if self._timer is not None and self._timer.active():
+            self._timer.cancel()
+        self._timer = None
+        if not self._pending:
+            return
+        records, self._pending = self._pending, []
+        settings = SIPSimpleSettings()
+        directory = settings.cdr.directory.normalized if settings.cdr.directory else self.default_directory
+        if directory is None:
+            log.warning('Discarding %d call detail records: no CDR directory is configured' % len(records))
+            return
+        self._write_records(records, directory, settings.cdr.format, settings.cdr.max_file_size, settings.cdr.rotate_count)
+
+    @run_in_thread('cdr-io')
+    def _write_records(self, records, directory, format, max_file_size, rotate_count):
+        filename = os.path.join(directory, 'cdr.jsonl' if format == 'json' else 'cdr.csv')
+        try:
+            os.makedirs(directory, exist_ok=True)
+            self._rotate(filename, max_file_size, rotate_count)
+            with open(filename, 'a', newline='') as f:
+                if format == 'json':
+                    f.writelines(json.dumps(record, default=str) + '\n' for record in records)
+                else:
+                    writer = csv.DictWriter(f, fieldnames=self.fields)
+                    if f.tell() == 0:
+                        writer.writeheader()
+                    writer.writerows(dict(record, streams=json.dumps(record['streams'], default=str)) for record in records)
+        except (OSError, ValueError) as e:
+            log.error('Failed to write %d call detail records to %s: %s' % (len(records), filename, e))
+
+    @staticmethod
+    def _rotate(filename, max_file_size, rotate_count):
+        try:
+            if os.path.getsize(filename) < max_file_size:
+                return
+        except OSError:
+            return
+        if rotate_count == 0:
+            os.unlink(filename)
+            return
+        for index in range(rotate_count - 1, 0, -1):
+            if os.path.exists('%s.%d' % (filename, index)):
+                os.replace('%s.%d' % (filename, index), '%s.%d' % (filename, index + 1))
+        os.replace(filename, '%s.1' % filename)
+
+    def _add_record(self, record):
+        self._pending.append(record)
+        if len(self._pending) >= self.batch_size:
+            self.flush()
+        elif self._timer is None:
+            self._timer = reactor.callLater(self.flush_interval, self.flush)
+
+    @staticmethod
+    def _stream_info(streams, include_statistics=False):
+        info = []
+        for stream in streams or []:
+            stream_info = dict(type=stream.type, codec=getattr(stream, 'codec', None), sample_rate=getattr(stream, 'sample_rate', None))
+            if include_statistics:
+                stream_info['statistics'] = getattr(stream, 'statistics', None)
+            info.append(stream_info)
+        return info
+
+    @run_in_twisted_thread
+    def handle_notification(self, notification):
+        if not SIPSimpleSettings().cdr.enabled and notification.sender not in self._records:
+            return
+        handler = getattr(self, '_NH_%s' % notification.name, Null)
+        handler(notification)
+
+    def _NH_SIPSessionNewIncoming(self, notification):
+        self._new_record(notification.sender)
+
+    def _NH_SIPSessionNewOutgoing(self, notification):
+        self._new_record(notification.sender)
+
+    def _new_record(self, session):
+        record = dict.fromkeys(self.fields)
+        record['direction'] = session.direction
+        record['account'] = str(session.account.id)
+        record['start_time'] = ISOTimestamp.now()
+        record['streams'] = []
+        self._records[session] = record
+
+    def _NH_SIPSessionDidStart(self, notification):
+        try:
+            record = self._records[notification.sender]
+        except KeyError:
+            return
+        record['answer_time'] = notification.sender.start_time or ISOTimestamp.now()
+        record['streams'] = self._stream_info(notification.data.streams)
+
+    def _NH_SIPSessionWillEnd(self, notification):
+        # the streams are still running at this point, so their statistics are available
+        try:
+            record = self._records[notification.sender]
+        except KeyError:
+            return
+        record['streams'] = self._stream_info(notification.sender.streams, include_statistics=True)
+
+    def _NH_SIPSessionDidEnd(self, notification):
+        try:
+            record = self._records.pop(notification.sender)
+        except KeyError:
+            return
+        record['originator'] = notification.data.originator
+        record['end_reason'] = notification.data.end_reason
+        self._finish_record(notification.sender, record)
+
+    def _NH_SIPSessionDidFail(self, notification):
+        try:
+            record = self._records.pop(notification.sender)
+        except KeyError:
+            return
+        record['originator'] = notification.data.originator
+        record['end_reason'] = notification.data.failure_reason
+        record['code'] = notification.data.code
+        record['reason'] = notification.data.reason
+        self._finish_record(notification.sender, record)
+
+    def _finish_record(self, session, record):
+        record['end_time'] = session.end_time or ISOTimestamp.now()
+        if record['answer_time'] is not None:
+            record['duration'] = round((record['end_time'] - record['answer_time']).total_seconds(), 3)
+        dialog_id = session.dialog_id
+        record['call_id'] = dialog_id.call_id if dialog_id is not None else None
+        record['local_identity'] = str(session.local_identity.uri) if session.local_identity is not None else None
+        record['remote_identity'] = str(session.remote_identity.uri) if session.remote_identity is not None else None
+        record['remote_user_agent'] = session.remote_user_agent
+        for key in ('start_time', 'answer_time', 'end_time'):
+            if record[key] is not None:
+                record[key] = str(record[key])
+        self._add_record(record)
+
@@ -7,13 +7,13 @@ __all__ = [
            # Generic datatypes
            'ContentType', 'ContentTypeList', 'CountryCode', 'NonNegativeInteger', 'PositiveInteger', 'SIPAddress',
            # Custom datatypes
-           'PJSIPLogLevel',
+           'PJSIPLogLevel', 'CDRFormat',
            # Audio datatypes
            'AudioCodecList', 'SampleRate',
            # Video datatypes
            'H264Profile', 'VideoResolution', 'VideoCodecList',
            # Address and transport datatypes
-           'Port', 'PortRange', 'Hostname', 'DomainList', 'EndpointAddress', 'EndpointIPAddress', 'MSRPRelayAddress',
+           'Port', 'PortRange', 'Hostname', 'IPAddressList', 'DomainList', 'EndpointAddress', 'EndpointIPAddress', 'MSRPRelayAddress',
            'SIPProxyAddress', 'STUNServerAddress', 'STUNServerAddressList', 'XCAPRoot',
            'MSRPConnectionModel', 'MSRPTransport', 'SIPTransport', 'SIPTransportList',
            # SRTP encryption
@@ -203,6 +203,16 @@ class PJSIPLogLevel(int):
         return value
 
 
+class CDRFormat(str):
+    available_values = ('json', 'csv')
+
+    def __new__(cls, value):
+        value = str(value)
+        if value not in cls.available_values:
+            raise ValueError("illegal value for CDR format: %s" % value)
+        return value
+
+
 class CodecList(List):
     type = str
     available_values = None    # to be defined in a subclass
@@ -341,6 +351,10 @@ class IPAddress(str):
         return value
 
 
+class IPAddressList(List):
+    type = IPAddress
+
+
 class DomainList(List):
     type = str
     _domain_re = re.compile(r"^[a-zA-Z0-9\-_]+(\.[a-zA-Z0-9\-_]+)*$")
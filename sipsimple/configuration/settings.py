@@ -7,9 +7,9 @@ Definition of general (non-account related) settings.
 
 from sipsimple import __version__
 from sipsimple.configuration import CorrelatedSetting, RuntimeSetting, Setting, SettingsGroup, SettingsObject
-from sipsimple.configuration.datatypes import NonNegativeInteger, PJSIPLogLevel
+from sipsimple.configuration.datatypes import CDRFormat, NonNegativeInteger, PJSIPLogLevel, PositiveInteger
 from sipsimple.configuration.datatypes import AudioCodecList, SampleRate, VideoCodecList
-from sipsimple.configuration.datatypes import Port, PortRange, SIPTransportList
+from sipsimple.configuration.datatypes import Hostname, IPAddressList, Port, PortRange, SIPTransportList
 from sipsimple.configuration.datatypes import Path
 from sipsimple.configuration.datatypes import H264Profile, VideoResolution
 
@@ -65,6 +65,14 @@ class LogsSettings(SettingsGroup):
     pjsip_level = Setting(type=PJSIPLogLevel, default=5)
 
 
+class CDRSettings(SettingsGroup):
+    enabled = Setting(type=bool, default=False)
+    directory = Setting(type=Path, default=None, nillable=True)
+    format = Setting(type=CDRFormat, default='json')
+    max_file_size = Setting(type=PositiveInteger, default=10*1024*1024)
+    rotate_count = Setting(type=NonNegativeInteger, default=5)
+
+
 class RTPSettings(SettingsGroup):
     port_range = Setting(type=PortRange, default=PortRange(50000, 50500))
     timeout = Setting(type=NonNegativeInteger, default=30)
@@ -82,6 +90,10 @@ class SIPSettings(SettingsGroup):
     tcp_port = CorrelatedSetting(type=Port, sibling='tls_port', validator=sip_port_validator, default=0)
     tls_port = CorrelatedSetting(type=Port, sibling='tcp_port', validator=sip_port_validator, default=0)
     transport_list = Setting(type=SIPTransportList, default=SIPTransportList(('tls', 'tcp', 'udp')))
+    persist_registrations = Setting(type=bool, default=False)
+    persist_dns_cache = Setting(type=bool, default=False)
+    dns_probed_domain = Setting(type=Hostname, default='sip2sip.info', nillable=True)
+    dns_fallback_nameservers = Setting(type=IPAddressList, default=IPAddressList(['8.8.8.8', '8.8.4.4']))
 
 
 class TLSSettings(SettingsGroup):
@@ -102,6 +114,7 @@ class SIPSimpleSettings(SettingsObject):
     screen_sharing = ScreenSharingSettings
     file_transfer = FileTransferSettings
     logs = LogsSettings
+    cdr = CDRSettings
     rtp = RTPSettings
     sip = SIPSettings
     tls = TLSSettings
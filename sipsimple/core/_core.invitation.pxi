@@ -702,8 +702,17 @@ cdef class Invitation:
 
             if self.state == "disconnected":
                 return
+            if timeout is not None and timeout <= 0:
+                raise ValueError("Timeout value cannot be negative")
             if self.state == "disconnecting":
-                raise SIPCoreError('INVITE session is already in the "disconnecting" state')
+                if timeout is None:
+                    raise SIPCoreError('INVITE session is already in the "disconnecting" state')
+                # Only change the time after which the INVITE session is terminated without waiting for the answer
+                if self._timer is not None:
+                    self._timer.cancel()
+                self._timer = Timer()
+                self._timer.schedule(timeout, <timer_callback>self._cb_timer_disconnect, self)
+                return
             if self._invite_session == NULL:
                 raise SIPCoreError("INVITE session is not active")
             if self.state not in ("outgoing", "early", "connecting", "connected"):
@@ -711,8 +720,6 @@ cdef class Invitation:
                                    'current in the "%s" state.' % self.state)
             if self.state == "early" and self.direction != "outgoing":
                 raise SIPCoreError('Cannot end incoming INVITE dialog while in the "early" state')
-            if timeout is not None and timeout <= 0:
-                raise ValueError("Timeout value cannot be negative")
 
             # End ongoing transfer
             self._terminate_transfer()
@@ -215,6 +215,7 @@ cdef class PJSIPEndpoint:
 cdef class PJMEDIAEndpoint:
     def __cinit__(self, PJCachingPool caching_pool):
         cdef int status
+        self._sdp_templates = {}
         status = pjmedia_endpt_create(&caching_pool._obj.factory, NULL, 1, &self._obj)
         if status != 0:
             raise PJSIPError("Could not create PJMEDIA endpoint", status)
@@ -445,6 +446,9 @@ cdef class PJMEDIAEndpoint:
         cdef PJSTR h264_profile_level_id_value
         cdef PJSTR h264_packetization_mode_value = PJSTR(b"1")    # TODO; make it configurable?
 
+        # the generated video SDP depends on the codec parameters
+        self._sdp_templates.clear()
+
         try:
             profile_n = h264_profiles_map[profile]
         except KeyError:
@@ -481,6 +485,9 @@ cdef class PJMEDIAEndpoint:
         cdef unsigned int prio[PJMEDIA_VID_CODEC_MGR_MAX_CODECS]
         cdef int status
 
+        # the generated video SDP depends on the codec parameters
+        self._sdp_templates.clear()
+
         max_width, max_height = max_resolution
 
         status = pjmedia_vid_codec_mgr_enum_codecs(NULL, &count, info, prio)
@@ -973,6 +973,8 @@ cdef class AudioTransport:
         cdef pj_sockaddr *addr
         cdef pjmedia_transport_info info
         cdef list global_codecs
+        cdef object template
+        cdef tuple template_key
         cdef SDPMediaStream local_media
         cdef SDPSession local_sdp
         cdef PJSIPUA ua
@@ -999,24 +1001,32 @@ cdef class AudioTransport:
         global_codecs = ua._pjmedia_endpoint._get_current_codecs()
         if codecs is None:
             codecs = global_codecs
-        try:
-            ua._pjmedia_endpoint._set_codecs(codecs)
-            addr = &info.sock_info.rtp_addr_name
-            with nogil:
-                status = pjmedia_endpt_create_base_sdp(media_endpoint, pool, NULL, addr, &local_sdp_c)
-            if status != 0:
-                raise PJSIPError("Could not generate base SDP", status)
-            with nogil:
-                status = pjmedia_endpt_create_audio_sdp(media_endpoint, pool, &info.sock_info, 0, &local_media_c)
-            if status != 0:
-                raise PJSIPError("Could not generate SDP audio stream", status)
-            # Create a 'fake' SDP, which only contains the audio stream, then the m line is extracted because the full
-            # SDP is built by the Session
-            local_sdp_c.media_count = 1
-            local_sdp_c.media[0] = local_media_c
-        finally:
-            ua._pjmedia_endpoint._set_codecs(global_codecs)
-        local_sdp = SDPSession_create(local_sdp_c)
+        template_key = (b"audio", tuple(codecs), tuple(global_codecs), info.sock_info.rtp_addr_name.addr.sa_family)
+        template = ua._pjmedia_endpoint._sdp_templates.get(template_key)
+        if template is not None:
+            local_sdp = _create_local_sdp_from_template(template, &info.sock_info)
+        else:
+            try:
+                ua._pjmedia_endpoint._set_codecs(codecs)
+                addr = &info.sock_info.rtp_addr_name
+                with nogil:
+                    status = pjmedia_endpt_create_base_sdp(media_endpoint, pool, NULL, addr, &local_sdp_c)
+                if status != 0:
+                    raise PJSIPError("Could not generate base SDP", status)
+                with nogil:
+                    status = pjmedia_endpt_create_audio_sdp(media_endpoint, pool, &info.sock_info, 0, &local_media_c)
+                if status != 0:
+                    raise PJSIPError("Could not generate SDP audio stream", status)
+                # Create a 'fake' SDP, which only contains the audio stream, then the m line is extracted because the full
+                # SDP is built by the Session
+                local_sdp_c.media_count = 1
+                local_sdp_c.media[0] = local_media_c
+            finally:
+                ua._pjmedia_endpoint._set_codecs(global_codecs)
+            local_sdp = SDPSession_create(local_sdp_c)
+            template = _make_local_sdp_template(local_sdp)
+            if template is not None:
+                ua._pjmedia_endpoint._sdp_templates[template_key] = template
         local_media = local_sdp.media[0]
         if remote_sdp is None:
             self._is_offer = 1
@@ -1495,6 +1505,8 @@ cdef class VideoTransport:
         cdef pjmedia_transport_info info
         cdef pj_sockaddr *addr
         cdef list global_codecs
+        cdef object template
+        cdef tuple template_key
         cdef SDPMediaStream local_media
         cdef SDPSession local_sdp
         cdef PJSIPUA ua
@@ -1516,24 +1528,32 @@ cdef class VideoTransport:
         global_codecs = ua._pjmedia_endpoint._get_current_video_codecs()
         if codecs is None:
             codecs = global_codecs
-        try:
-            ua._pjmedia_endpoint._set_video_codecs(codecs)
-            addr = &(info.sock_info.rtp_addr_name)
-            with nogil:
-                status = pjmedia_endpt_create_base_sdp(media_endpoint, pool, NULL, addr, &local_sdp_c)
-            if status != 0:
-                raise PJSIPError("Could not generate base SDP", status)
-            with nogil:
-                status = pjmedia_endpt_create_video_sdp(media_endpoint, pool, &info.sock_info, 0, &local_media_c)
-            if status != 0:
-                raise PJSIPError("Could not generate SDP video stream", status)
-            # Create a 'fake' SDP, which only contains the video stream, then the m line is extracted because the full
-            # SDP is built by the Session
-            local_sdp_c.media_count = 1
-            local_sdp_c.media[0] = local_media_c
-        finally:
-            ua._pjmedia_endpoint._set_video_codecs(global_codecs)
-        local_sdp = SDPSession_create(local_sdp_c)
+        template_key = (b"video", tuple(codecs), tuple(global_codecs), info.sock_info.rtp_addr_name.addr.sa_family)
+        template = ua._pjmedia_endpoint._sdp_templates.get(template_key)
+        if template is not None:
+            local_sdp = _create_local_sdp_from_template(template, &info.sock_info)
+        else:
+            try:
+                ua._pjmedia_endpoint._set_video_codecs(codecs)
+                addr = &(info.sock_info.rtp_addr_name)
+                with nogil:
+                    status = pjmedia_endpt_create_base_sdp(media_endpoint, pool, NULL, addr, &local_sdp_c)
+                if status != 0:
+                    raise PJSIPError("Could not generate base SDP", status)
+                with nogil:
+                    status = pjmedia_endpt_create_video_sdp(media_endpoint, pool, &info.sock_info, 0, &local_media_c)
+                if status != 0:
+                    raise PJSIPError("Could not generate SDP video stream", status)
+                # Create a 'fake' SDP, which only contains the video stream, then the m line is extracted because the full
+                # SDP is built by the Session
+                local_sdp_c.media_count = 1
+                local_sdp_c.media[0] = local_media_c
+            finally:
+                ua._pjmedia_endpoint._set_video_codecs(global_codecs)
+            local_sdp = SDPSession_create(local_sdp_c)
+            template = _make_local_sdp_template(local_sdp)
+            if template is not None:
+                ua._pjmedia_endpoint._sdp_templates[template_key] = template
         local_media = local_sdp.media[0]
         if remote_sdp is None:
             self._is_offer = 1
@@ -2122,6 +2142,58 @@ cdef dict _pjmedia_rtcp_stream_stat_to_dict(pjmedia_rtcp_stream_stat *stream_sta
     retval["jitter"] = _pj_math_stat_to_dict(&stream_stat.jitter)
     return retval
 
+cdef object _make_local_sdp_template(SDPSession local_sdp):
+    # Keep the parts of a generated SDP which do not depend on the media transport (codecs and static attributes), the
+    # rest is filled in for every call by _create_local_sdp_from_template. Returns None if the SDP contains attributes
+    # which cannot be regenerated that way, in which case the SDP will be generated by pjmedia every time.
+    global sdp_template_attributes
+    cdef SDPMediaStream local_media = local_sdp.media[0]
+    cdef SDPMediaStream media
+    cdef list attributes = []
+    cdef int has_rtcp = 0
+
+    for attr in local_media.attributes:
+        if attr.name == b"rtcp":
+            has_rtcp = 1
+        elif attr.name in sdp_template_attributes:
+            attributes.append(SDPAttribute.new(attr))
+        else:
+            return None
+    media = SDPMediaStream(local_media.media, 0, local_media.transport, local_media.port_count, list(local_media.formats),
+                           SDPConnection.new(local_media.connection) if local_media.connection is not None else None,
+                           attributes, [SDPBandwidthInfo.new(info) for info in local_media.bandwidth_info])
+    template = SDPSession(local_sdp.address, 0, 0, local_sdp.user, local_sdp.net_type, local_sdp.address_type, local_sdp.name,
+                          SDPConnection.new(local_sdp.connection) if local_sdp.connection is not None else None,
+                          local_sdp.start_time, local_sdp.stop_time, [SDPAttribute.new(attr) for attr in local_sdp.attributes],
+                          [SDPBandwidthInfo.new(info) for info in local_sdp.bandwidth_info], [media])
+    return (template, has_rtcp)
+
+cdef SDPSession _create_local_sdp_from_template(tuple template_info, pjmedia_sock_info *sock_info):
+    cdef char buf[PJ_INET6_ADDRSTRLEN]
+    cdef SDPSession template
+    cdef SDPMediaStream template_media
+    cdef SDPConnection connection
+    cdef SDPConnection media_connection
+    cdef list attributes
+    cdef bytes address
+    cdef bytes rtcp_address
+
+    template, has_rtcp = template_info
+    template_media = template.media[0]
+    address = pj_sockaddr_print(&sock_info.rtp_addr_name, buf, PJ_INET6_ADDRSTRLEN, 0)
+    connection = SDPConnection(address, template.connection.net_type, template.connection.address_type) if template.connection is not None else None
+    media_connection = SDPConnection(address, template_media.connection.net_type, template_media.connection.address_type) if template_media.connection is not None else None
+    attributes = [SDPAttribute.new(attr) for attr in template_media.attributes]
+    if has_rtcp:
+        rtcp_address = pj_sockaddr_print(&sock_info.rtcp_addr_name, buf, PJ_INET6_ADDRSTRLEN, 0)
+        address_type = media_connection.address_type if media_connection is not None else template.address_type
+        attributes.insert(0, SDPAttribute(b"rtcp", b"%d IN %s %s" % (pj_sockaddr_get_port(&sock_info.rtcp_addr_name), address_type, rtcp_address)))
+    media = SDPMediaStream(template_media.media, pj_sockaddr_get_port(&sock_info.rtp_addr_name), template_media.transport, template_media.port_count,
+                           list(template_media.formats), media_connection, attributes, [SDPBandwidthInfo.new(info) for info in template_media.bandwidth_info])
+    return SDPSession(address, None, None, template.user, template.net_type, template.address_type, template.name, connection,
+                      template.start_time, template.stop_time, [SDPAttribute.new(attr) for attr in template.attributes],
+                      [SDPBandwidthInfo.new(info) for info in template.bandwidth_info], [media])
+
 cdef str _ice_state_to_str(int state):
     if state == PJ_ICE_STRANS_STATE_NULL:
         return 'NULL'
@@ -2478,6 +2550,7 @@ _ice_cb.on_ice_state = _RTPTransport_cb_ice_state
 _ice_cb.on_ice_stop = _RTPTransport_cb_ice_stop
 
 valid_sdp_directions = (b"sendrecv", b"sendonly", b"recvonly", b"inactive")
+sdp_template_attributes = (b"rtpmap", b"fmtp", b"rtcp-fb", b"ptime", b"maxptime", b"framerate", b"imageattr") + valid_sdp_directions
 
 # ZRTP
 
@@ -708,6 +708,7 @@ cdef extern from "pjmedia.h":
         PJMEDIA_TRANSPORT_TYPE_ZRTP
     struct pjmedia_sock_info:
         pj_sockaddr rtp_addr_name
+        pj_sockaddr rtcp_addr_name
     ctypedef pjmedia_sock_info *pjmedia_sock_info_ptr_const "const pjmedia_sock_info *"
     struct pjmedia_transport:
         char *name
@@ -1457,6 +1458,7 @@ cdef class PJMEDIAEndpoint(object):
     cdef int _has_video
     cdef int _has_ffmpeg_video
     cdef int _has_vpx
+    cdef dict _sdp_templates
 
     # private methods
     cdef list _get_codecs(self)
@@ -2239,6 +2241,7 @@ cdef class IncomingSubscription(object):
 
     # methods
     cdef int _set_state(self, str state) except -1
+    cdef int _push_shared_content(self, PJSTR content_type, PJSTR content_subtype, PJSTR content) except -1
     cdef PJSIPUA _get_ua(self, int raise_exception)
     cdef int init(self, PJSIPUA ua, pjsip_rx_data *rdata, object event) except -1
     cdef int _send_initial_response(self, int code) except -1
@@ -2248,10 +2251,31 @@ cdef class IncomingSubscription(object):
     cdef int _cb_server_timeout(self, PJSIPUA ua) except -1
     cdef int _cb_tsx(self, PJSIPUA ua, pjsip_event *event) except -1
 
+cdef class IncomingSubscriptionGroup(object):
+    # attributes
+    cdef pj_mutex_t *_lock
+    cdef pj_timer_entry _timer
+    cdef int _timer_active
+    cdef PJSTR _content_type
+    cdef PJSTR _content_subtype
+    cdef PJSTR _content
+    cdef dict _subscriptions
+    cdef list _pending
+    cdef readonly int batch_size
+    cdef readonly int batch_interval
+    cdef readonly unsigned long notify_count
+
+    # methods
+    cdef int _prune(self) except -1
+    cdef int _send_pending(self, PJSIPUA ua) except -1
+    cdef int _schedule_timer(self, PJSIPUA ua, int delay) except -1
+    cdef int _cancel_timer(self, PJSIPUA ua) except -1
+
 cdef void _Subscription_cb_state(pjsip_evsub *sub, pjsip_event *event) with gil
 cdef void _Subscription_cb_notify(pjsip_evsub *sub, pjsip_rx_data *rdata, int *p_st_code,
                                     pj_str_t **p_st_text, pjsip_hdr *res_hdr, pjsip_msg_body **p_body) with gil
 cdef void _Subscription_cb_refresh(pjsip_evsub *sub) with gil
+cdef void _IncomingSubscriptionGroup_cb_timer(pj_timer_heap_t *timer_heap, pj_timer_entry *entry) with gil
 cdef void _IncomingSubscription_cb_rx_refresh(pjsip_evsub *sub, pjsip_rx_data *rdata,
                                               int *p_st_code, pj_str_t **p_st_text,
                                               pjsip_hdr *res_hdr, pjsip_msg_body **p_body) with gil
@@ -2640,6 +2664,8 @@ cdef ICECandidate ICECandidate_create(pj_ice_sess_cand *cand)
 cdef ICECheck ICECheck_create(pj_ice_sess_check *check)
 cdef str _ice_state_to_str(int state)
 cdef dict _extract_ice_session_data(pj_ice_sess *ice_sess)
+cdef object _make_local_sdp_template(SDPSession local_sdp)
+cdef SDPSession _create_local_sdp_from_template(tuple template_info, pjmedia_sock_info *sock_info)
 cdef object _extract_rtp_transport(pjmedia_transport *tp)
 cdef dict _pj_math_stat_to_dict(pj_math_stat *stat)
 cdef dict _pjmedia_rtcp_stream_stat_to_dict(pjmedia_rtcp_stream_stat *stream_stat)
@@ -45,7 +45,7 @@ __all__ = ["PJ_VERSION", "PJ_SVN_REVISION", "CORE_REVISION",
            "Request",
            "Referral",
            "sipfrag_re",
-           "Subscription",
+           "Subscription", "IncomingSubscriptionGroup",
            "Invitation",
            "DialogID",
            "SDPSession", "FrozenSDPSession", "SDPMediaStream", "FrozenSDPMediaStream", "SDPConnection", "FrozenSDPConnection", "SDPAttribute", "FrozenSDPAttribute", "SDPNegotiator",
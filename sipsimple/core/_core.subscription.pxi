@@ -1,9 +1,11 @@
 
+import random
 import re
 
 
 cdef class Subscription:
     expire_warning_time = 30
+    refresh_jitter = 0.1 # fraction of the refresh interval by which refreshes are randomly advanced, to spread them out
 
     #public methods
 
@@ -310,7 +312,7 @@ cdef class Subscription:
                 return 0
         if self.state != "TERMINATED" and not self._want_end:
             self._cancel_timers(ua, 1, 0)
-            refresh.sec = max(1, expires - self.expire_warning_time, expires/2)
+            refresh.sec = max(1, int(max(1, expires - self.expire_warning_time, expires/2) * random.uniform(1 - self.refresh_jitter, 1)))
             refresh.msec = 0
             status = pjsip_endpt_schedule_timer(ua._pjsip_endpoint._obj, &self._refresh_timer, &refresh)
             if status == 0:
@@ -588,6 +590,24 @@ cdef class IncomingSubscription:
         if prev_state != state and prev_state is not None:
             _add_event("SIPIncomingSubscriptionChangedState", dict(obj=self, prev_state=prev_state, state=state))
 
+    cdef int _push_shared_content(self, PJSTR content_type, PJSTR content_subtype, PJSTR content) except -1:
+        # Same as push_content, but with content which was already converted and which is shared with other subscriptions
+        if self._obj == NULL:
+            return 0
+        with nogil:
+            pjsip_dlg_inc_lock(self._dlg)
+        try:
+            if self.state != "ACTIVE":
+                return 0
+            self._content_type = content_type
+            self._content_subtype = content_subtype
+            self._content = content
+            self._send_notify()
+        finally:
+            with nogil:
+                pjsip_dlg_dec_lock(self._dlg)
+        return 0
+
     cdef PJSIPUA _get_ua(self, int raise_exception):
         cdef PJSIPUA ua
         try:
@@ -768,6 +788,211 @@ cdef class IncomingSubscription:
                 pjsip_evsub_set_mod_data(self._obj, ua._event_module.id, NULL)
                 self._obj = NULL
 
+cdef class IncomingSubscriptionGroup:
+    """
+    A group of incoming subscriptions which share the same content, such as
+    the watchers of a presentity. The content pushed to the group is
+    converted only once and it is sent in a NOTIFY to every active
+    subscription in the group. At most batch_size NOTIFY requests are sent
+    at a time, the rest are sent from the PJSIP thread every batch_interval
+    milliseconds. When new content is pushed before all the subscriptions
+    were notified, the ones that are still waiting will only get the new
+    content. Subscriptions which are terminated are removed from the group
+    automatically.
+    """
+
+    # properties
+
+    property content_type:
+
+        def __get__(self):
+            if self._content_type is None:
+                return None
+            return "%s/%s" % (self._content_type.str, self._content_subtype.str)
+
+    property content:
+
+        def __get__(self):
+            if self._content is None:
+                return None
+            return self._content.str
+
+    property pending:
+
+        def __get__(self):
+            return len(self._pending)
+
+    def __cinit__(self, *args, **kwargs):
+        cdef int status
+
+        status = pj_mutex_create_recursive(_get_ua()._pjsip_endpoint._pool, "subscription_group_lock", &self._lock)
+        if status != 0:
+            raise PJSIPError("failed to create lock", status)
+        pj_timer_entry_init(&self._timer, 0, <void *> self, _IncomingSubscriptionGroup_cb_timer)
+        self._timer_active = 0
+        self._subscriptions = dict()
+        self._pending = list()
+        self.notify_count = 0
+
+    def __init__(self, int batch_size=100, int batch_interval=10):
+        if batch_size <= 0:
+            raise ValueError("batch_size argument needs to be a positive integer")
+        if batch_interval < 0:
+            raise ValueError("batch_interval argument needs to be a non-negative integer")
+        self.batch_size = batch_size
+        self.batch_interval = batch_interval
+
+    def __dealloc__(self):
+        cdef PJSIPUA ua
+        try:
+            ua = _get_ua()
+        except SIPCoreError:
+            pass
+        else:
+            self._cancel_timer(ua)
+        if self._lock != NULL:
+            pj_mutex_destroy(self._lock)
+
+    def __len__(self):
+        cdef int status
+        cdef pj_mutex_t *lock = self._lock
+
+        with nogil:
+            status = pj_mutex_lock(lock)
+        if status != 0:
+            raise PJSIPError("failed to acquire lock", status)
+        try:
+            self._prune()
+            return len(self._subscriptions)
+        finally:
+            with nogil:
+                pj_mutex_unlock(lock)
+
+    def __contains__(self, subscription):
+        return subscription in self._subscriptions
+
+    def __iter__(self):
+        cdef int status
+        cdef pj_mutex_t *lock = self._lock
+
+        with nogil:
+            status = pj_mutex_lock(lock)
+        if status != 0:
+            raise PJSIPError("failed to acquire lock", status)
+        try:
+            self._prune()
+            return iter(list(self._subscriptions))
+        finally:
+            with nogil:
+                pj_mutex_unlock(lock)
+
+    def add(self, IncomingSubscription subscription not None):
+        cdef int status
+        cdef pj_mutex_t *lock = self._lock
+        cdef PJSIPUA ua = _get_ua()
+
+        with nogil:
+            status = pj_mutex_lock(lock)
+        if status != 0:
+            raise PJSIPError("failed to acquire lock", status)
+        try:
+            if subscription in self._subscriptions:
+                return
+            self._subscriptions[subscription] = None
+            if self._content is not None and subscription.state == "ACTIVE":
+                self._pending.append(subscription)
+                self._schedule_timer(ua, 0)
+        finally:
+            with nogil:
+                pj_mutex_unlock(lock)
+
+    def remove(self, IncomingSubscription subscription not None):
+        cdef int status
+        cdef pj_mutex_t *lock = self._lock
+
+        with nogil:
+            status = pj_mutex_lock(lock)
+        if status != 0:
+            raise PJSIPError("failed to acquire lock", status)
+        try:
+            self._subscriptions.pop(subscription, None)
+        finally:
+            with nogil:
+                pj_mutex_unlock(lock)
+
+    def push_content(self, str content_type not None, object content not None):
+        global _re_content_type
+        cdef int status
+        cdef object content_type_match
+        cdef pj_mutex_t *lock = self._lock
+        cdef PJSIPUA ua = _get_ua()
+
+        content_type_match = _re_content_type.match(content_type)
+        if content_type_match is None:
+            raise ValueError("content_type parameter is not properly formatted")
+
+        with nogil:
+            status = pj_mutex_lock(lock)
+        if status != 0:
+            raise PJSIPError("failed to acquire lock", status)
+        try:
+            self._content_type = PJSTR(content_type_match.group(1).encode())
+            self._content_subtype = PJSTR(content_type_match.group(2).encode())
+            self._content = PJSTR(content if isinstance(content, bytes) else content.encode())
+            self._pending = list(self._subscriptions)
+            self._cancel_timer(ua)
+            self._send_pending(ua)
+        finally:
+            with nogil:
+                pj_mutex_unlock(lock)
+
+    cdef int _prune(self) except -1:
+        cdef IncomingSubscription subscription
+        for subscription in [subscription for subscription in self._subscriptions if subscription.state == "TERMINATED"]:
+            del self._subscriptions[subscription]
+        return 0
+
+    cdef int _send_pending(self, PJSIPUA ua) except -1:
+        # must be called with the lock held
+        cdef IncomingSubscription subscription
+        cdef list batch = self._pending[:self.batch_size]
+        del self._pending[:self.batch_size]
+        for subscription in batch:
+            if subscription.state == "TERMINATED":
+                self._subscriptions.pop(subscription, None)
+                continue
+            if subscription not in self._subscriptions:
+                continue
+            try:
+                subscription._push_shared_content(self._content_type, self._content_subtype, self._content)
+            except SIPCoreError, e:
+                _add_event("SIPIncomingSubscriptionNotifyDidFail", dict(obj=subscription, code=0, reason=e.args[0]))
+            else:
+                self.notify_count += 1
+        if self._pending:
+            self._schedule_timer(ua, self.batch_interval)
+        return 0
+
+    cdef int _schedule_timer(self, PJSIPUA ua, int delay) except -1:
+        cdef pj_time_val timer_delay
+        cdef int status
+        if self._timer_active:
+            return 0
+        timer_delay.sec = delay // 1000
+        timer_delay.msec = delay % 1000
+        status = pjsip_endpt_schedule_timer(ua._pjsip_endpoint._obj, &self._timer, &timer_delay)
+        if status != 0:
+            raise PJSIPError("Could not schedule timer", status)
+        self._timer_active = 1
+        return 0
+
+    cdef int _cancel_timer(self, PJSIPUA ua) except -1:
+        if self._timer_active:
+            pjsip_endpt_cancel_timer(ua._pjsip_endpoint._obj, &self._timer)
+            self._timer_active = 0
+        return 0
+
+
 # callback functions
 
 cdef void _Subscription_cb_state(pjsip_evsub *sub, pjsip_event *event) with gil:
@@ -891,6 +1116,32 @@ cdef void _Subscription_cb_timer(pj_timer_heap_t *timer_heap, pj_timer_entry *en
     except:
         ua._handle_exception(1)
 
+cdef void _IncomingSubscriptionGroup_cb_timer(pj_timer_heap_t *timer_heap, pj_timer_entry *entry) with gil:
+    cdef IncomingSubscriptionGroup group
+    cdef int status
+    cdef pj_mutex_t *lock
+    cdef PJSIPUA ua
+    try:
+        ua = _get_ua()
+    except:
+        return
+    try:
+        if entry.user_data != NULL:
+            group = <object> entry.user_data
+            lock = group._lock
+            with nogil:
+                status = pj_mutex_lock(lock)
+            if status != 0:
+                raise PJSIPError("failed to acquire lock", status)
+            try:
+                group._timer_active = 0
+                group._send_pending(ua)
+            finally:
+                with nogil:
+                    pj_mutex_unlock(lock)
+    except:
+        ua._handle_exception(1)
+
 cdef void _IncomingSubscription_cb_rx_refresh(pjsip_evsub *sub, pjsip_rx_data *rdata,
                                               int *p_st_code, pj_str_t **p_st_text,
                                               pjsip_hdr *res_hdr, pjsip_msg_body **p_body) with gil:
@@ -26,6 +26,7 @@ class Registration(object):
         self.extra_headers = extra_headers or []
         self._current_request = None
         self._last_request = None
+        self._resumed_binding = None
         self._unregistering = False
         self._lock = RLock()
 
@@ -33,6 +34,20 @@ class Registration(object):
     contact_uri = property(lambda self: None if self._last_request is None else self._last_request.contact_uri)
     expires_in = property(lambda self: 0 if self._last_request is None else self._last_request.expires_in)
     peer_address = property(lambda self: None if self._last_request is None else self._last_request.peer_address)
+    call_id = property(lambda self: None if self._last_request is None else self._last_request.call_id)
+    cseq = property(lambda self: None if self._last_request is None else self._last_request.cseq)
+
+    def resume(self, contact_header, route_header, call_id, cseq):
+        """
+        Continue a binding registered earlier by another Registration (for
+        example before the application was restarted). The next request uses
+        the same Call-ID and the next CSeq and end() removes the binding even
+        if it was not refreshed yet.
+        """
+        with self._lock:
+            if self._current_request is not None or self._last_request is not None:
+                raise SIPCoreError("Registration is already in progress")
+            self._resumed_binding = [contact_header, route_header, call_id, cseq]
 
     def register(self, contact_header, route_header, timeout=None):
         with self._lock:
@@ -44,12 +59,17 @@ class Registration(object):
 
     def end(self, timeout=None):
         with self._lock:
-            if self._last_request is None:
+            if self._last_request is not None:
+                contact_header = ContactHeader.new(self._last_request.contact_header)
+                route_header = RouteHeader.new(self._last_request.route_header)
+            elif self._resumed_binding is not None:
+                contact_header, route_header = self._resumed_binding[:2]
+            else:
                 return
             notification_center = NotificationCenter()
             notification_center.post_notification('SIPRegistrationWillEnd', sender=self)
             try:
-                self._make_and_send_request(ContactHeader.new(self._last_request.contact_header), RouteHeader.new(self._last_request.route_header), timeout, False)
+                self._make_and_send_request(contact_header, route_header, timeout, False)
             except SIPCoreError as e:
                 notification_center.post_notification('SIPRegistrationDidNotEnd', sender=self, data=NotificationData(code=0, reason=e.args[0]))
 
@@ -63,6 +83,7 @@ class Registration(object):
             if request is not self._current_request:
                 return
             self._current_request = None
+            self._resumed_binding = None
             if self._unregistering:
                 if self._last_request is not None:
                     self._last_request.end()
@@ -118,6 +139,9 @@ class Registration(object):
         if prev_request is not None:
             call_id = prev_request.call_id
             cseq = prev_request.cseq + 1
+        elif self._resumed_binding is not None:
+            call_id = self._resumed_binding[2]
+            cseq = self._resumed_binding[3] + 1
         else:
             call_id = None
             cseq = 1
@@ -139,6 +163,8 @@ class Registration(object):
         except:
             notification_center.remove_observer(self, sender=request)
             raise
+        if self._resumed_binding is not None:
+            self._resumed_binding[3] = request.cseq
         self._unregistering = not do_register
         self._current_request = request
 
@@ -8,8 +8,18 @@ resources prior the starting of a SIP session.
 
 
 
+import base64
+import json
+import os
+import platform
+import random
 import re
-from itertools import chain
+from collections import OrderedDict
+from copy import copy
+from bisect import bisect_left
+from itertools import chain, count, groupby
+from operator import itemgetter
+from threading import Lock
 from time import time
 from urllib.parse import urlparse
 
@@ -30,10 +40,13 @@ sys.modules['dns.entropy'] = dns.entropy
 del partial, randint, randrange, sys
 
 # replace standard select and socket modules with versions from eventlib
-from eventlib import coros, proc
+from eventlib import api, coros, proc
 from eventlib.green import select
 from eventlib.green import socket
+import dns.flags
+import dns.message
 import dns.name
+import dns.rcode
 import dns.resolver
 import dns.query
 dns.resolver.socket = socket
@@ -44,17 +57,19 @@ dns.query.select = select
 if ('_set_polling_backend' in dir(dns.query)):
     dns.query._set_polling_backend(dns.query._select_for)
 
-from application.notification import IObserver, NotificationCenter, NotificationData
+from application.notification import Any, IObserver, NotificationCenter, NotificationData
 from application.python import Null, limit
 from application.python.decorator import decorator, preserve_signature
-from application.python.types import Singleton
-from dns import exception, rdatatype
+from application.python.types import MarkerType, Singleton
+from application.system import makedirs, openfile, unlink
+from dns import exception, rdataclass, rdatatype
 from twisted.internet import reactor
+from twisted.internet.protocol import DatagramProtocol
 from zope.interface import implementer
 
 from sipsimple.core import Route
-from sipsimple.threading import run_in_twisted_thread
-from sipsimple.threading.green import Command, InterruptCommand, run_in_waitable_green_thread
+from sipsimple.threading import run_in_thread, run_in_twisted_thread
+from sipsimple.threading.green import Command, InterruptCommand, run_in_green_thread, run_in_waitable_green_thread
 
 
 def domain_iterator(domain):
@@ -66,6 +81,46 @@ def domain_iterator(domain):
         domain = (domain.split('.', 1)+[''])[1]
 
 
+def concurrent_map(func, items):
+    """
+    Call func for each item in a separate green thread and return the list of
+    the results, in the order of the items. The result for an item is either
+    the value returned by func or the exception it raised.
+    """
+    def call(item):
+        try:
+            return func(item)
+        except Exception as e:
+            return e
+    items = list(items)
+    if len(items) < 2:
+        return [call(item) for item in items]
+    return [p.wait() for p in [proc.spawn(call, item) for item in items]]
+
+
+def weighted_order(entries):
+    """
+    Return the routes from a list of (group, weight, route) tuples, ordered by
+    group and, within a group, by the weighted random selection described in
+    RFC 2782. The routes with no weight keep their order.
+    """
+    routes = []
+    for _, items in groupby(sorted(entries, key=itemgetter(0)), key=itemgetter(0)):
+        items = list(items)
+        while items:
+            total_weight = sum(weight for _, weight, _ in items)
+            if total_weight == 0:
+                routes.extend(route for _, _, route in items)
+                break
+            selection = random.uniform(0, total_weight)
+            for index, (_, weight, _) in enumerate(items):
+                selection -= weight
+                if weight and selection <= 0:
+                    break
+            routes.append(items.pop(index)[2])
+    return routes
+
+
 @decorator
 def post_dns_lookup_notifications(func):
     @preserve_signature(func)
@@ -82,34 +137,497 @@ def post_dns_lookup_notifications(func):
     return wrapper
 
 
+@decorator
+def singleflight(flight):
+    def singleflight_decorator(func):
+        @preserve_signature(func)
+        def wrapper(obj, *args, **kwargs):
+            key = (func.__name__,) + tuple(SingleFlight.hashable(arg) for arg in args) + tuple(sorted((name, SingleFlight.hashable(value)) for name, value in kwargs.items()))
+            return flight.call(key, func, obj, *args, **kwargs)
+        return wrapper
+    return singleflight_decorator
+
+
 class DNSLookupError(Exception):
     """
     The error raised by DNSLookup when a lookup cannot be performed.
     """
 
 
+class SingleFlight(object):
+    """
+    Shares the result of a lookup among all the identical lookups made while
+    it is in progress, so that only one of them queries the DNS servers. The
+    queries made by that lookup are posted again as DNSLookupTrace
+    notifications on behalf of each lookup which waited for its result. If
+    the lookup is killed before it finished, the lookups which waited for it
+    are made again. The in_flight and coalesced attributes count the lookups
+    in progress and the lookups which waited for the result of another one.
+    """
+
+    def __init__(self):
+        self.coalesced = 0
+        self._calls = {}
+
+    @property
+    def in_flight(self):
+        return len(self._calls)
+
+    @staticmethod
+    def hashable(value):
+        if isinstance(value, (list, tuple)):
+            return tuple(SingleFlight.hashable(item) for item in value)
+        elif value is None or isinstance(value, (str, bytes, int, float)):
+            return value
+        else:
+            return str(value)  # URIs and other objects are compared by their string representation
+
+    def call(self, key, func, obj, *args, **kwargs):
+        if key in self._calls:
+            self.coalesced += 1
+        while key in self._calls:
+            outcome = self._calls[key].wait()
+            if outcome is None:
+                continue  # the lookup was killed, the first one to get here makes it again
+            result, error, traces = outcome
+            for trace in traces:
+                obj._post_trace(*trace)
+            if error is not None:
+                raise error
+            return list(result)
+        event = self._calls[key] = coros.event()
+        traces = []
+        try:
+            result = func(obj._recorder(traces), *args, **kwargs)
+        except Exception as e:
+            event.send((None, e, traces))
+            raise
+        except BaseException:
+            event.send(None)
+            raise
+        else:
+            event.send((result, None, traces))
+            return result
+        finally:
+            del self._calls[key]
+
+
+class NegativeAnswer(metaclass=MarkerType): pass
+
+
+class DNSCacheEntry(object):
+    __slots__ = ('value', 'ttl', 'expiration', 'stale_expiration', 'hits')
+
+    def __init__(self, value, ttl, stale_ttl=0):
+        self.value = value
+        self.ttl = ttl
+        self.expiration = time() + ttl
+        self.stale_expiration = self.expiration + stale_ttl
+        self.hits = 0
+
+
 class DNSCache(object):
     """
-    A simple DNS cache which uses twisted's timers to invalidate its expired
-    data.
+    A size bounded LRU cache for the answers of DNS queries. Negative answers
+    (NXDOMAIN and no data) are cached for the time given by the SOA record in
+    the answer as described in RFC 2308, up to max_negative_ttl, and queries
+    which timed out are cached for failure_ttl seconds, so that lookups for
+    dead domains do not query the DNS servers every time.
+
+    An answer which expired less than stale_ttl seconds ago is still returned
+    while it is refreshed in the background, and an answer which was used at
+    least prefetch_hits times is refreshed shortly before it expires, so that
+    the lookups for busy domains do not wait for the DNS servers. The expired
+    entries are removed by a single periodic sweep. The cache is thread safe.
     """
+
+    max_size = 10000                # maximum number of entries in the cache
+    max_ttl = 3600                  # maximum number of seconds for which an answer is cached
+    max_negative_ttl = 900          # maximum number of seconds for which a negative answer is cached
+    default_negative_ttl = 60       # seconds for which a negative answer without a SOA record is cached
+    failure_ttl = 5                 # seconds for which a query that timed out is cached
+    stale_ttl = 300                 # seconds after it expired for which an answer is returned while it is being refreshed
+    prefetch_hits = 3               # number of times an answer must be used before it is refreshed ahead of its expiration
+    prefetch_fraction = 0.1         # fraction of the TTL before the expiration during which a busy answer is refreshed
+    refresh_timeout = 3.0           # timeout for each query that refreshes an answer in the background
+    refresh_lifetime = 10.0         # maximum duration of the queries that refresh an answer in the background
+    sweep_interval = 60             # seconds between the sweeps which remove the expired entries
+
     def __init__(self):
-        self.data = {}
+        self.hits = 0
+        self.misses = 0
+        self.stale_hits = 0
+        self.prefetches = 0
+        self.evictions = 0
+        self.data = OrderedDict()
+        self._lock = Lock()
+        self._refreshing = set()
+        self._sweep_timer = None
+
+    @property
+    def statistics(self):
+        """The number of cached entries, how many of them are negative, the hit, miss and eviction counters and the number of background refreshes"""
+        with self._lock:
+            negative = sum(1 for key in self.data if key[0] is NegativeAnswer)
+            return dict(size=len(self.data), negative=negative, hits=self.hits, misses=self.misses, stale_hits=self.stale_hits,
+                        prefetches=self.prefetches, refreshing=len(self._refreshing), evictions=self.evictions)
 
     def get(self, key):
-        return self.data.get(key, None)
+        now = time()
+        with self._lock:
+            try:
+                entry = self.data[key]
+            except KeyError:
+                self.misses += 1
+                return None
+            if entry.stale_expiration <= now:
+                del self.data[key]
+                self.misses += 1
+                return None
+            self.data.move_to_end(key)
+            self.hits += 1
+            entry.hits += 1
+            stale = entry.expiration <= now
+            if stale:
+                self.stale_hits += 1
+            refresh = key not in self._refreshing and (stale or entry.hits >= self.prefetch_hits and entry.expiration - now <= entry.ttl * self.prefetch_fraction)
+            if refresh:
+                if not stale:
+                    self.prefetches += 1
+                self._refreshing.add(key)
+        if refresh:
+            self._refresh(key)
+        return entry.value
 
     def put(self, key, value):
-        expiration = value.expiration-time()
-        if expiration > 0:
-            self.data[key] = value
-            reactor.callLater(limit(expiration, max=3600), self.data.pop, key, None)
+        self._put(key, DNSCacheEntry(value, limit(value.expiration-time(), max=self.max_ttl), self.stale_ttl))
+
+    @staticmethod
+    def make_key(qname, rdtype, rdclass=rdataclass.IN):
+        """The key under which the answers to a query are cached, positive and negative alike"""
+        if isinstance(qname, str):
+            qname = dns.name.from_text(qname)
+        if isinstance(rdtype, str):
+            rdtype = rdatatype.from_text(rdtype)
+        if isinstance(rdclass, str):
+            rdclass = rdataclass.from_text(rdclass)
+        return qname, rdtype, rdclass
+
+    def get_negative(self, key):
+        """Return the error cached for the query identified by key and the time until which it is valid, or None"""
+        key = (NegativeAnswer,) + key
+        now = time()
+        with self._lock:
+            entry = self.data.get(key)
+            if entry is None or entry.expiration <= now:
+                self.data.pop(key, None)
+                return None
+            self.data.move_to_end(key)
+            return entry.value, entry.expiration
+
+    def put_negative(self, key, error, ttl=None):
+        """Cache the error of a query which got a negative answer or timed out, for the given TTL or the default one"""
+        if isinstance(error, dns.resolver.Timeout):
+            ttl = self.failure_ttl
+        elif ttl is None:
+            ttl = self.default_negative_ttl
+        self._put((NegativeAnswer,) + key, DNSCacheEntry(error, limit(ttl, max=self.max_negative_ttl)))
 
     def flush(self, key=None):
-        if key is not None:
-            self.data.pop(key, None)
+        with self._lock:
+            if key is not None:
+                self.data.pop(key, None)
+                self.data.pop((NegativeAnswer,) + key, None)
+            else:
+                self.data.clear()
+
+    def save(self, filename):
+        """Write the answers in the cache which can still be used to the file, from the file-io thread"""
+        now = time()
+        with self._lock:
+            entries = [(key, entry) for key, entry in self.data.items() if key[0] is not NegativeAnswer and entry.stale_expiration > now]
+        self._write(filename, entries)
+
+    def load(self, filename):
+        """Add the answers saved in the file with save() which can still be used to the cache"""
+        try:
+            with open(filename) as f:
+                records = json.load(f)
+        except (OSError, ValueError):
+            return
+        now = time()
+        for record in records:
+            try:
+                key = self.make_key(record['name'], record['rdtype'], record['rdclass'])
+                response = dns.message.from_wire(base64.b64decode(record['response']))
+                answer = dns.resolver.Answer(key[0], key[1], key[2], response)
+                answer.expiration = record['expiration']
+                entry = DNSCacheEntry(answer, record['ttl'], self.stale_ttl)
+            except (KeyError, TypeError, ValueError, exception.DNSException):
+                continue
+            entry.expiration = record['expiration']
+            entry.stale_expiration = entry.expiration + self.stale_ttl
+            if entry.stale_expiration > now:
+                self._put(key, entry)
+
+    @run_in_thread('file-io')
+    def _write(self, filename, entries):
+        records = []
+        for (qname, rdtype, rdclass), entry in entries:
+            try:
+                response = base64.b64encode(entry.value.response.to_wire()).decode()
+            except (AttributeError, exception.DNSException):
+                continue
+            records.append(dict(name=qname.to_text(), rdtype=int(rdtype), rdclass=int(rdclass), response=response, expiration=entry.expiration, ttl=entry.ttl))
+        tmp_filename = '%s.%d.%08X' % (filename, os.getpid(), random.getrandbits(32))
+        try:
+            makedirs(os.path.dirname(filename))
+            file = openfile(tmp_filename, 'w', permissions=0o600)
+            json.dump(records, file)
+            file.close()
+            if platform.system() == 'Windows':
+                # os.rename does not work on Windows if the destination file already exists.
+                unlink(filename)
+            os.rename(tmp_filename, filename)
+        except (IOError, OSError):
+            pass
+
+    def _put(self, key, entry):
+        if entry.ttl <= 0:
+            return
+        with self._lock:
+            self.data[key] = entry
+            self.data.move_to_end(key)
+            while len(self.data) > self.max_size:
+                self.data.popitem(last=False)
+                self.evictions += 1
+        if self._sweep_timer is None:
+            self._schedule_sweep()
+
+    @run_in_green_thread
+    def _refresh(self, key):
+        qname, rdtype, rdclass = key
+        resolver = DNSResolver(timeout=self.refresh_timeout, lifetime=self.refresh_lifetime)
+        try:
+            answer = resolver.query(qname, rdtype, rdclass)
+        except (dns.resolver.NXDOMAIN, dns.resolver.NoAnswer):
+            # the name or the records no longer exist, the old answer must not be used anymore
+            self.flush(key)
+        except exception.DNSException:
+            pass  # keep using the old answer until it is refreshed or it is too old
         else:
-            self.data = {}
+            self.put(key, answer)
+        finally:
+            with self._lock:
+                self._refreshing.discard(key)
+
+    @run_in_twisted_thread
+    def _schedule_sweep(self):
+        if self._sweep_timer is None:
+            self._sweep_timer = reactor.callLater(self.sweep_interval, self._sweep)
+
+    def _sweep(self):
+        now = time()
+        with self._lock:
+            for key in [key for key, entry in self.data.items() if entry.stale_expiration <= now]:
+                del self.data[key]
+            self._sweep_timer = reactor.callLater(self.sweep_interval, self._sweep) if self.data else None
+
+
+class SIPRouteCache(object):
+    """
+    Keeps the routes found by DNSLookup.lookup_sip_proxy until the first of
+    the DNS records they were built from expires. The cache holds at most
+    max_size entries, the least recently used ones are dropped first.
+    """
+
+    max_size = 1000                 # maximum number of route lists in the cache
+
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        self.data = OrderedDict()
+        self._lock = Lock()
+
+    @property
+    def statistics(self):
+        """The number of cached route lists and the hit and miss counters"""
+        with self._lock:
+            return dict(size=len(self.data), hits=self.hits, misses=self.misses)
+
+    def get(self, key):
+        with self._lock:
+            try:
+                expiration, entries = self.data[key]
+            except KeyError:
+                self.misses += 1
+                return None
+            if expiration <= time():
+                del self.data[key]
+                self.misses += 1
+                return None
+            self.data.move_to_end(key)
+            self.hits += 1
+            return entries
+
+    def put(self, key, entries, expiration):
+        if expiration <= time():
+            return
+        with self._lock:
+            self.data[key] = (expiration, entries)
+            self.data.move_to_end(key)
+            while len(self.data) > self.max_size:
+                self.data.popitem(last=False)
+
+    def flush(self):
+        with self._lock:
+            self.data.clear()
+
+
+class DNSQueryProtocol(DatagramProtocol):
+    def __init__(self, multiplexer):
+        self.multiplexer = multiplexer
+
+    def datagramReceived(self, data, address):
+        self.multiplexer._got_response(data, address)
+
+
+class DNSQueryMultiplexer(object, metaclass=Singleton):
+    """
+    Sends DNS queries over UDP from a single socket handled by the reactor and
+    matches the responses with the queries using their ID, the address they
+    came from and their question, so that the lookups which wait for answers
+    do not hold a socket each. The socket is replaced with one on a new random
+    port after port_queries queries, to make responses harder to spoof.
+    """
+
+    port_queries = 1000             # number of queries sent from a socket before a new one is used
+    port_linger = 30                # seconds for which the responses to the queries sent from a replaced socket are still received
+
+    def __init__(self):
+        self.queries = 0
+        self.responses = 0
+        self.in_flight = 0
+        self._port = None
+        self._port_queries = 0
+        self._pending = {}
+
+    def query(self, request, nameserver, port, timeout):
+        """
+        Send the query to the nameserver and return its response. Raises
+        dns.exception.Timeout if no response is received in time. This must
+        be called from a green thread.
+        """
+        if self._port is None or self._port_queries >= self.port_queries:
+            if self._port is not None:
+                reactor.callLater(self.port_linger, self._port.stopListening)
+            self._port = reactor.listenUDP(0, DNSQueryProtocol(self))
+            self._port_queries = 0
+        while (request.id, nameserver, port) in self._pending:
+            request.id = random.getrandbits(16)
+        key = (request.id, nameserver, port)
+        waiter = coros.event()
+        self._pending[key] = (request, waiter)
+        self._port.write(request.to_wire(), (nameserver, port))
+        self._port_queries += 1
+        self.queries += 1
+        self.in_flight += 1
+        try:
+            with api.timeout(timeout, exception.Timeout()):
+                return waiter.wait()
+        finally:
+            self.in_flight -= 1
+            del self._pending[key]
+
+    def stop(self):
+        if self._port is not None:
+            self._port.stopListening()
+            self._port = None
+
+    def _got_response(self, data, address):
+        try:
+            response = dns.message.from_wire(data)
+        except exception.DNSException:
+            return
+        request, waiter = self._pending.get((response.id,) + tuple(address[:2]), (None, None))
+        if request is not None and not waiter.ready() and request.is_response(response):
+            self.responses += 1
+            waiter.send(response)
+
+
+class DNSMetrics(object, metaclass=Singleton):
+    """
+    Aggregated metrics of the DNS queries made by DNSLookup: the number of
+    queries and of their NXDOMAIN, no data, timeout and error outcomes per
+    query type, a latency histogram of the responses from each nameserver,
+    the hit ratio of the DNS cache and the slowest names queried. Updating
+    them only takes a few counter increments per query.
+    """
+
+    latency_buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)   # upper bounds in seconds of the latency histogram buckets
+    slow_names = 10                 # number of slowest names which are reported
+
+    outcomes = ('answer', 'nxdomain', 'no_answer', 'timeout', 'error')
+
+    def __init__(self):
+        self._lock = Lock()
+        self.reset()
+
+    @property
+    def statistics(self):
+        """A snapshot of the metrics, as a dictionary"""
+        cache_statistics = DNSLookup.cache.statistics
+        cache_lookups = cache_statistics['hits'] + cache_statistics['misses']
+        with self._lock:
+            return dict(queries={query_type: dict(counters) for query_type, counters in self._queries.items()},
+                        nameservers={nameserver: dict(histogram, buckets=list(zip(self.latency_buckets + (None,), histogram['buckets'])))
+                                     for nameserver, histogram in self._nameservers.items()},
+                        cache_hit_ratio=cache_statistics['hits'] / cache_lookups if cache_lookups else 0.0,
+                        slowest=[dict(name=name, type=query_type, latency=latency) for (name, query_type), latency in sorted(self._slowest.items(), key=itemgetter(1), reverse=True)])
+
+    def reset(self):
+        with self._lock:
+            self._queries = {}
+            self._nameservers = {}
+            self._slowest = {}
+
+    def record_query(self, rdtype, qname, latency, outcome):
+        query_type = rdatatype.to_text(rdtype)
+        name = str(qname)
+        with self._lock:
+            try:
+                counters = self._queries[query_type]
+            except KeyError:
+                counters = self._queries[query_type] = dict.fromkeys(self.outcomes, 0)
+            counters[outcome] += 1
+            key = (name, query_type)
+            if key in self._slowest:
+                self._slowest[key] = max(self._slowest[key], latency)
+            elif len(self._slowest) < self.slow_names:
+                self._slowest[key] = latency
+            else:
+                fastest_key = min(self._slowest, key=self._slowest.get)
+                if latency > self._slowest[fastest_key]:
+                    del self._slowest[fastest_key]
+                    self._slowest[key] = latency
+
+    def record_response(self, nameserver, latency):
+        with self._lock:
+            histogram = self._get_histogram(nameserver)
+            histogram['responses'] += 1
+            histogram['total_latency'] += latency
+            histogram['buckets'][bisect_left(self.latency_buckets, latency)] += 1
+
+    def record_timeout(self, nameserver):
+        with self._lock:
+            self._get_histogram(nameserver)['timeouts'] += 1
+
+    def _get_histogram(self, nameserver):
+        try:
+            return self._nameservers[nameserver]
+        except KeyError:
+            histogram = self._nameservers[nameserver] = dict(responses=0, timeouts=0, total_latency=0.0, buckets=[0] * (len(self.latency_buckets) + 1))
+            return histogram
 
 
 class InternalResolver(dns.resolver.Resolver):
@@ -120,28 +638,236 @@ class InternalResolver(dns.resolver.Resolver):
         self.search = [item for item in self.search if not item.to_text().endswith('local.')]
 
 
-class DNSResolver(dns.resolver.Resolver):
+class ResolverConfiguration(object):
+    """
+    The nameservers, search list, domain and port used by the DNS lookups.
+    It cannot be changed: the DNSManager replaces it with a new one with a
+    higher version when any of them changes, so that a lookup uses the same
+    configuration for all its queries.
     """
-    The resolver used by DNSLookup.
 
-    The lifetime setting on it applies to all the queries made on this resolver.
-    Each time a query is performed, its duration is subtracted from the lifetime
-    value.
+    __slots__ = ('version', 'nameservers', 'search', 'domain', 'port')
+
+    def __init__(self, version, nameservers, search, domain, port):
+        object.__setattr__(self, 'version', version)
+        object.__setattr__(self, 'nameservers', tuple(nameservers))
+        object.__setattr__(self, 'search', tuple(search))
+        object.__setattr__(self, 'domain', domain)
+        object.__setattr__(self, 'port', port)
+
+    def __setattr__(self, name, value):
+        raise AttributeError("%s objects are immutable" % self.__class__.__name__)
+
+    __delattr__ = __setattr__
+
+    def __repr__(self):
+        return '%s(%r, %r, %r, %r, %r)' % (self.__class__.__name__, self.version, self.nameservers, self.search, self.domain, self.port)
+
+
+class DNSResolver(object):
     """
+    The resolver used by DNSLookup for the queries of a lookup. It only holds
+    the state of the lookup and uses the current ResolverConfiguration of the
+    DNSManager, so creating one is cheap.
 
-    def __init__(self):
-        dns.resolver.Resolver.__init__(self, configure=False)
+    The lifetime applies to all the queries made on this resolver, which end
+    when the lifetime has passed since the first one started. Queries can be
+    made concurrently from different green threads, in which case at most
+    max_concurrent_queries of them are sent at the same time.
+
+    The expiration attribute is the time until which all the answers returned
+    by the resolver are valid (None if it returned none) and timed_out is True
+    if any of its queries timed out.
+
+    If multiplexed is True, the queries are sent through the
+    DNSQueryMultiplexer, so that waiting for an answer does not hold a socket.
+    """
+
+    __slots__ = ('configuration', 'cache', 'timeout', 'lifetime', 'expiration', 'timed_out', '_deadline', '_semaphore')
+
+    max_concurrent_queries = 8      # maximum number of queries made at the same time on a resolver
+    multiplexed = True              # send the UDP queries through the DNSQueryMultiplexer instead of a socket for each query
+
+    def __init__(self, cache=None, timeout=2.0, lifetime=30.0):
+        self.configuration = DNSManager().configuration
+        self.cache = cache
+        self.timeout = timeout
+        self.lifetime = lifetime
+        self.expiration = None
+        self.timed_out = False
+        self._deadline = None
+        self._semaphore = coros.Semaphore(self.max_concurrent_queries)
+
+    @property
+    def nameservers(self):
+        return list(self.configuration.nameservers)
+
+    def query(self, qname, rdtype=rdatatype.A, rdclass=rdataclass.IN):
+        if self._deadline is None:
+            self._deadline = time() + self.lifetime
+        if isinstance(rdtype, str):
+            rdtype = rdatatype.from_text(rdtype)
+        if isinstance(rdclass, str):
+            rdclass = rdataclass.from_text(rdclass)
+        # a relative name is tried with the search list in the same way dnspython does, whether the query is multiplexed or not
+        qnames = self._qnames(qname)
+        for qname in qnames[:-1]:
+            try:
+                return self._query_name(qname, rdtype, rdclass)
+            except dns.resolver.NXDOMAIN:
+                continue
+        return self._query_name(qnames[-1], rdtype, rdclass)
+
+    def _qnames(self, qname):
+        if isinstance(qname, str):
+            qname = dns.name.from_text(qname, None)
+        if qname.is_absolute():
+            return [qname]
+        configuration = self.configuration
+        qnames = [qname.concatenate(dns.name.root)] if len(qname) > 1 else []
+        if configuration.search:
+            qnames.extend(qname.concatenate(suffix) for suffix in configuration.search)
+        elif isinstance(configuration.domain, dns.name.Name):
+            qnames.append(qname.concatenate(configuration.domain))
+        else:
+            qnames.append(qname.concatenate(dns.name.root))
+        return list(dict.fromkeys(qnames))
+
+    def _query_name(self, qname, rdtype, rdclass):
+        metrics = DNSMetrics()
+        cache = self.cache
+        key = DNSCache.make_key(qname, rdtype, rdclass)
+        if cache is not None:
+            negative_answer = cache.get_negative(key)
+            if negative_answer is not None:
+                error, expiration = negative_answer
+                self._add_answer(error, expiration)
+                metrics.record_query(rdtype, qname, 0.0, self._outcome(error))
+                raise error.with_traceback(None)
+        with self._semaphore:
+            start_time = time()
+            try:
+                if self.multiplexed:
+                    answer = self._query(qname, rdtype, rdclass)
+                else:
+                    answer = self._make_resolver(max(self._deadline - start_time, 0)).query(qname, rdtype, rdclass)
+                    if getattr(answer, 'nameserver', None) is not None:
+                        metrics.record_response(answer.nameserver, time()-start_time)
+                        DNSManager().record_response(answer.nameserver, time()-start_time)
+            except (dns.resolver.NXDOMAIN, dns.resolver.NoAnswer) as e:
+                ttl = self._negative_ttl(e)
+                if cache is not None:
+                    cache.put_negative(key, e, ttl)
+                self._add_answer(e, time() + (DNSCache.default_negative_ttl if ttl is None else ttl))
+                metrics.record_query(rdtype, qname, time()-start_time, self._outcome(e))
+                raise
+            except dns.resolver.Timeout as e:
+                # only a query which had all its time to get an answer means the servers did not answer it
+                if cache is not None and time()-start_time >= self.timeout:
+                    cache.put_negative(key, e)
+                self._add_answer(e, None)
+                metrics.record_query(rdtype, qname, time()-start_time, 'timeout')
+                raise
+            except exception.DNSException:
+                metrics.record_query(rdtype, qname, time()-start_time, 'error')
+                raise
+            else:
+                self._add_answer(answer, answer.expiration)
+                metrics.record_query(rdtype, qname, time()-start_time, 'answer')
+                return answer
+
+    def _make_resolver(self, lifetime):
+        # a dnspython resolver for the queries which are not multiplexed
+        configuration = self.configuration
+        resolver = dns.resolver.Resolver(configure=False)
+        resolver.nameservers = DNSManager().sort_nameservers(configuration.nameservers)
+        resolver.search = list(configuration.search)
+        resolver.domain = configuration.domain
+        resolver.port = configuration.port
+        resolver.cache = self.cache
+        resolver.timeout = self.timeout
+        resolver.lifetime = lifetime
+        return resolver
+
+    def _query(self, qname, rdtype, rdclass):
+        # Resolve the query for the absolute name using the DNSQueryMultiplexer, trying the nameservers in turn until one of them answers or the lifetime is over
+        qname, rdtype, rdclass = key = DNSCache.make_key(qname, rdtype, rdclass)
+        if self.cache:
+            answer = self.cache.get(key)
+            if answer is not None:
+                return answer
+        multiplexer = DNSQueryMultiplexer()
+        request = dns.message.make_query(qname, rdtype, rdclass)
         dns_manager = DNSManager()
-        self.search = dns_manager.search
-        self.domain = dns_manager.domain
-        self.nameservers = dns_manager.nameservers
+        nameservers = dns_manager.sort_nameservers(self.configuration.nameservers)
+        port = self.configuration.port
+        backoff = 0.1
+        while nameservers:
+            for nameserver in nameservers[:]:
+                timeout = min(self.timeout, self._deadline - time())
+                if timeout <= 0:
+                    raise dns.resolver.Timeout()
+                start_time = time()
+                try:
+                    if ':' in nameserver:
+                        response = dns.query.udp(request, nameserver, timeout, port)
+                    else:
+                        response = multiplexer.query(request, nameserver, port, timeout)
+                    if response.flags & dns.flags.TC:
+                        response = dns.query.tcp(request, nameserver, timeout, port)
+                except exception.Timeout:
+                    DNSMetrics().record_timeout(nameserver)
+                    dns_manager.record_timeout(nameserver)
+                    continue
+                except (socket.error, EOFError):
+                    continue
+                except exception.DNSException:
+                    nameservers.remove(nameserver)
+                    continue
+                DNSMetrics().record_response(nameserver, time()-start_time)
+                dns_manager.record_response(nameserver, time()-start_time)
+                rcode = response.rcode()
+                if rcode == dns.rcode.NXDOMAIN:
+                    raise dns.resolver.NXDOMAIN(qnames=[qname], responses={qname: response})
+                elif rcode == dns.rcode.NOERROR:
+                    answer = dns.resolver.Answer(qname, rdtype, rdclass, response)
+                    if answer.rrset is None:
+                        raise dns.resolver.NoAnswer(response=response)
+                    if self.cache:
+                        self.cache.put(key, answer)
+                    return answer
+                else:
+                    # the nameserver failed to answer (SERVFAIL, REFUSED, ...), do not ask it again
+                    nameservers.remove(nameserver)
+            if nameservers:
+                api.sleep(min(backoff, max(self._deadline - time(), 0)))
+                backoff = min(2 * backoff, 2)
+        raise dns.resolver.NoNameservers()
+
+    @staticmethod
+    def _outcome(error):
+        if isinstance(error, dns.resolver.NXDOMAIN):
+            return 'nxdomain'
+        elif isinstance(error, dns.resolver.NoAnswer):
+            return 'no_answer'
+        elif isinstance(error, dns.resolver.Timeout):
+            return 'timeout'
+        else:
+            return 'error'
 
-    def query(self, *args, **kw):
-        start_time = time()
-        try:
-            return dns.resolver.Resolver.query(self, *args, **kw)
-        finally:
-            self.lifetime -= min(self.lifetime, time()-start_time)
+    def _add_answer(self, answer, expiration):
+        if isinstance(answer, dns.resolver.Timeout):
+            self.timed_out = True
+        else:
+            self.expiration = expiration if self.expiration is None else min(self.expiration, expiration)
+
+    @staticmethod
+    def _negative_ttl(error):
+        """The TTL of a negative answer as given by the SOA record in it (RFC 2308) or None if there is none"""
+        kwargs = getattr(error, 'kwargs', None) or {}
+        responses = list((kwargs.get('responses') or {}).values()) + [kwargs.get('response')]
+        ttls = [min(rrset.ttl, rrset[0].minimum) for response in responses if response is not None for rrset in response.authority if rrset.rdtype == rdatatype.SOA]
+        return min(ttls) if ttls else None
 
 
 class SRVResult(object):
@@ -172,9 +898,24 @@ class NAPTRResult(object):
 class DNSLookup(object):
 
     cache = DNSCache()
+    route_cache = SIPRouteCache()
+
+    service_lookups = SingleFlight()
+    sip_proxy_lookups = SingleFlight()
+
+    _sender = None
+    _traces = None
+
+    def _recorder(self, traces):
+        # a copy of the lookup which also keeps the queries it makes in traces, while posting them on behalf of the original
+        recorder = copy(self)
+        recorder._sender = self
+        recorder._traces = traces
+        return recorder
 
     @run_in_waitable_green_thread
     @post_dns_lookup_notifications
+    @singleflight(service_lookups)
     def lookup_service(self, uri, service, timeout=3.0, lifetime=15.0):
         """
         Performs an SRV query to determine the servers used for the specified
@@ -202,10 +943,7 @@ class DNSLookup(object):
             if re.match("^\d{1,3}\.\d{1,3}\.\d{1,3}\.\d{1,3}$", uri.host.decode()):
                 return [(uri.host.decode(), uri.port or service_port)]
 
-            resolver = DNSResolver()
-            resolver.cache = self.cache
-            resolver.timeout = timeout
-            resolver.lifetime = lifetime
+            resolver = DNSResolver(cache=self.cache, timeout=timeout, lifetime=lifetime)
 
             record_name = '%s.%s' % (service_prefix, uri.host.decode())
             services = self._lookup_srv_records(resolver, [record_name], log_context=log_context)
@@ -223,6 +961,7 @@ class DNSLookup(object):
 
     @run_in_waitable_green_thread
     @post_dns_lookup_notifications
+    @singleflight(sip_proxy_lookups)
     def lookup_sip_proxy(self, uri, supported_transports, timeout=10.0, lifetime=30.0, tls_name=None):
         """
         Performs an RFC 3263 compliant lookup of transport/ip/port combinations
@@ -231,6 +970,11 @@ class DNSLookup(object):
         application. It returns a list of Route objects that can be used in
         order of preference.
 
+        The routes found are kept in the route cache for as long as the DNS
+        records they were built from are valid. The routes with the same
+        priority are put in a weighted random order (RFC 2782) every time they
+        are returned.
+
         The DNSLookupDidSucceed notification contains a result attribute which
         is a list of Route objects. The DNSLookupDidFail notification contains
         an error attribute describing the error encountered.
@@ -238,23 +982,41 @@ class DNSLookup(object):
         Set tls_name to the Common Name the server must present
         """
 
-        naptr_service_transport_map = {"sips+d2t": "tls",
-                                       "sip+d2t": "tcp",
-                                       "sip+d2u": "udp"}
-
-        transport_service_map = {"udp": "_sip._udp",
-                                 "tcp": "_sip._tcp",
-                                 "tls": "_sips._tcp"}
-
-        log_context = dict(context='lookup_sip_proxy', uri=uri)
-
         if not supported_transports:
             raise DNSLookupError("No transports are supported")
         supported_transports = [transport.lower() for transport in supported_transports]
-        unknown_transports = set(supported_transports).difference(transport_service_map)
+        unknown_transports = set(supported_transports).difference(self._transport_service_map)
         if unknown_transports:
             raise DNSLookupError("Unknown transports: %s" % ', '.join(unknown_transports))
 
+        key = (uri.host, uri.port, uri.parameters.get('transport'), uri.secure, tuple(supported_transports), tls_name)
+        entries = self.route_cache.get(key)
+        if entries is None:
+            resolver = DNSResolver(cache=self.cache, timeout=timeout, lifetime=lifetime)
+            entries = self._lookup_sip_proxy_routes(resolver, uri, supported_transports, tls_name)
+            if resolver.expiration is not None and not resolver.timed_out:
+                self.route_cache.put(key, entries, resolver.expiration)
+        return weighted_order(entries)
+
+    _naptr_service_transport_map = {"sips+d2t": "tls",
+                                    "sip+d2t": "tcp",
+                                    "sip+d2u": "udp"}
+
+    _transport_service_map = {"udp": "_sip._udp",
+                              "tcp": "_sip._tcp",
+                              "tls": "_sips._tcp"}
+
+    def _lookup_sip_proxy_routes(self, resolver, uri, supported_transports, tls_name):
+        """
+        Returns the routes for lookup_sip_proxy as a list of (group, weight,
+        route) tuples, where group is the priority of the route.
+        """
+
+        naptr_service_transport_map = self._naptr_service_transport_map
+        transport_service_map = self._transport_service_map
+
+        log_context = dict(context='lookup_sip_proxy', uri=uri)
+
         try:
             # If the host part of the URI is an IP address, we will not do any lookup
             transport = uri.transport.decode() if isinstance(uri.transport, bytes) else uri.transport
@@ -263,13 +1025,7 @@ class DNSLookup(object):
                 if transport not in supported_transports:
                     raise DNSLookupError("IP transport %s dictated by URI is not supported" % transport)
                 port = uri.port or (5061 if transport=='tls' else 5060)
-                route = [Route(address=uri.host, port=port, transport=transport, tls_name=tls_name or uri.host)]
-                return route
-
-            resolver = DNSResolver()
-            resolver.cache = self.cache
-            resolver.timeout = timeout
-            resolver.lifetime = lifetime
+                return [((0,), 0, Route(address=uri.host, port=port, transport=transport, tls_name=tls_name or uri.host))]
 
             # If the port is specified in the URI, we will only do an A lookup
             if uri.port:
@@ -278,7 +1034,7 @@ class DNSLookup(object):
                     raise DNSLookupError("Host transport %s dictated by URI is not supported" % transport)
                 addresses = self._lookup_a_records(resolver, [uri.host.decode()], log_context=log_context)
                 if addresses[uri.host.decode()]:
-                    return [Route(address=addr, port=uri.port, transport=transport, tls_name=tls_name or uri.host) for addr in addresses[uri.host.decode()]]
+                    return [((0,), 0, Route(address=addr, port=uri.port, transport=transport, tls_name=tls_name or uri.host)) for addr in addresses[uri.host.decode()]]
 
             # If the transport was already set as a parameter on the SIP URI, only do SRV lookups
             elif 'transport' in uri.parameters:
@@ -290,13 +1046,13 @@ class DNSLookup(object):
                 record_name = '%s.%s' % (transport_service_map[transport], uri.host.decode())
                 services = self._lookup_srv_records(resolver, [record_name], log_context=log_context)
                 if services[record_name]:
-                    return [Route(address=result.address, port=result.port, transport=transport, tls_name=tls_name or uri.host) for result in services[record_name]]
+                    return [((result.priority,), result.weight, Route(address=result.address, port=result.port, transport=transport, tls_name=tls_name or uri.host)) for result in services[record_name]]
                 else:
                     # If SRV lookup fails, try A lookup
                     addresses = self._lookup_a_records(resolver, [uri.host.decode()], log_context=log_context)
                     port = 5061 if transport=='tls' else 5060
                     if addresses[uri.host.decode()]:
-                        return [Route(address=addr, port=port, transport=transport, tls_name=tls_name or uri.host) for addr in addresses[uri.host.decode()]]
+                        return [((0,), 0, Route(address=addr, port=port, transport=transport, tls_name=tls_name or uri.host)) for addr in addresses[uri.host.decode()]]
 
             # Otherwise, it means we don't have a numeric IP address, a port isn't specified and neither is a transport. So we have to do a full NAPTR lookup
             else:
@@ -312,18 +1068,20 @@ class DNSLookup(object):
                 except dns.resolver.Timeout:
                     pointers = []
                 if pointers:
-                    return [Route(address=result.address, port=result.port, transport=naptr_service_transport_map[result.service], tls_name=tls_name or uri.host) for result in pointers]
+                    return [((result.order, result.preference, result.priority), result.weight, Route(address=result.address, port=result.port, transport=naptr_service_transport_map[result.service], tls_name=tls_name or uri.host)) for result in pointers]
                 else:
                     # If that fails, try SRV lookup
                     routes = []
-                    for transport in supported_transports:
-                        record_name = '%s.%s' % (transport_service_map[transport], uri.host.decode())
-                        try:
-                            services = self._lookup_srv_records(resolver, [record_name], log_context=log_context)
-                        except dns.resolver.Timeout:
+                    record_names = ['%s.%s' % (transport_service_map[transport], uri.host.decode()) for transport in supported_transports]
+                    def srv_lookup(record_name):
+                        return self._lookup_srv_records(resolver, [record_name], log_context=log_context)[record_name]
+                    # the SRV records for all the transports are looked up concurrently
+                    for index, (transport, results) in enumerate(zip(supported_transports, concurrent_map(srv_lookup, record_names))):
+                        if isinstance(results, dns.resolver.Timeout):
                             continue
-                        if services[record_name]:
-                            routes.extend(Route(address=result.address, port=result.port, transport=transport, tls_name=tls_name or uri.host) for result in services[record_name])
+                        elif isinstance(results, Exception):
+                            raise results
+                        routes.extend(((index, result.priority), result.weight, Route(address=result.address, port=result.port, transport=transport, tls_name=tls_name or uri.host)) for result in results)
                     if routes:
                         return routes
                     else:
@@ -333,7 +1091,7 @@ class DNSLookup(object):
                             addresses = self._lookup_a_records(resolver, [uri.host.decode()], log_context=log_context)
                             port = 5061 if transport=='tls' else 5060
                             if addresses[uri.host.decode()]:
-                                return [Route(address=addr, port=port, transport=transport, tls_name=tls_name or uri.host) for addr in addresses[uri.host.decode()]]
+                                return [((0,), 0, Route(address=addr, port=port, transport=transport, tls_name=tls_name or uri.host)) for addr in addresses[uri.host.decode()]]
         except dns.resolver.Timeout:
             raise DNSLookupError("Timeout in lookup for routes for SIP URI %s" % uri)
         else:
@@ -347,29 +1105,25 @@ class DNSLookup(object):
         that look like HTTP URIs.
         """
         log_context = dict(context='lookup_xcap_server', uri=uri)
-        notification_center = NotificationCenter()
 
         try:
             # If the host part of the URI is an IP address, we cannot not do any lookup
             if re.match("^\d{1,3}\.\d{1,3}\.\d{1,3}\.\d{1,3}$", uri.host.decode()):
                 raise DNSLookupError("Cannot perform DNS query because the host is an IP address")
 
-            resolver = DNSResolver()
-            resolver.cache = self.cache
-            resolver.timeout = timeout
-            resolver.lifetime = lifetime
+            resolver = DNSResolver(cache=self.cache, timeout=timeout, lifetime=lifetime)
 
             record_name = 'xcap.%s' % uri.host.decode()
             results = []
             try:
                 answer = resolver.query(record_name, rdatatype.TXT)
             except dns.resolver.Timeout as e:
-                notification_center.post_notification('DNSLookupTrace', sender=self, data=NotificationData(query_type='TXT', query_name=str(record_name), nameservers=resolver.nameservers, answer=None, error=e, **log_context))
+                self._trace('TXT', record_name, resolver, None, e, log_context)
                 raise
             except exception.DNSException as e:
-                notification_center.post_notification('DNSLookupTrace', sender=self, data=NotificationData(query_type='TXT', query_name=str(record_name), nameservers=resolver.nameservers, answer=None, error=e, **log_context))
+                self._trace('TXT', record_name, resolver, None, e, log_context)
             else:
-                notification_center.post_notification('DNSLookupTrace', sender=self, data=NotificationData(query_type='TXT', query_name=str(record_name), nameservers=resolver.nameservers, answer=answer, error=None, **log_context))
+                self._trace('TXT', record_name, resolver, answer, None, log_context)
                 for result_uri in list(chain(*(r.strings for r in answer.rrset))):
                     parsed_uri = urlparse(result_uri.decode())
                     if parsed_uri.scheme in ('http', 'https') and parsed_uri.netloc:
@@ -381,67 +1135,96 @@ class DNSLookup(object):
             raise DNSLookupError('Timeout in lookup for XCAP servers for domain %s' % uri.host.decode())
 
 
-    def _lookup_a_records(self, resolver, hostnames, additional_records=[], log_context={}):
+    def _trace(self, query_type, query_name, resolver, answer, error, log_context):
+        # keep the queries of a lookup that others may be waiting for, so that they can be posted on their behalf as well
+        trace = (query_type, query_name, resolver.nameservers, answer, error, log_context)
+        if self._traces is not None:
+            self._traces.append(trace)
+        self._post_trace(*trace)
+
+    def _post_trace(self, query_type, query_name, nameservers, answer, error, log_context):
+        # only build the notification data for the query if something observes the DNSLookupTrace notifications
+        sender = self._sender if self._sender is not None else self
         notification_center = NotificationCenter()
+        observers = notification_center.observers
+        if any(key in observers for key in (('DNSLookupTrace', Any), ('DNSLookupTrace', sender), (Any, Any), (Any, sender))):
+            notification_center.post_notification('DNSLookupTrace', sender=sender, data=NotificationData(query_type=query_type, query_name=str(query_name), nameservers=nameservers, answer=answer, error=error, **log_context))
+
+    def _lookup_a_records(self, resolver, hostnames, additional_records=[], log_context={}):
         additional_addresses = dict((rset.name.to_text(), rset) for rset in additional_records if rset.rdtype == rdatatype.A)
         addresses = {}
+
+        def lookup(hostname):
+            try:
+                answer = resolver.query(hostname, rdatatype.A)
+            except dns.resolver.Timeout as e:
+                self._trace('A', hostname, resolver, None, e, log_context)
+                raise
+            except exception.DNSException as e:
+                self._trace('A', hostname, resolver, None, e, log_context)
+                return []
+            else:
+                self._trace('A', hostname, resolver, answer, None, log_context)
+                return [r.address for r in answer.rrset]
+
+        pending_hostnames = []
         for hostname in hostnames:
             if hostname in additional_addresses:
                 addresses[hostname] = [r.address for r in additional_addresses[hostname]]
-            else:
-                try:
-                    answer = resolver.query(hostname, rdatatype.A)
-                except dns.resolver.Timeout as e:
-                    notification_center.post_notification('DNSLookupTrace', sender=self, data=NotificationData(query_type='A', query_name=str(hostname), nameservers=resolver.nameservers, answer=None, error=e, **log_context))
-                    raise
-                except exception.DNSException as e:
-                    notification_center.post_notification('DNSLookupTrace', sender=self, data=NotificationData(query_type='A', query_name=str(hostname), nameservers=resolver.nameservers, answer=None, error=e, **log_context))
-                    addresses[hostname] = []
-                else:
-                    notification_center.post_notification('DNSLookupTrace', sender=self, data=NotificationData(query_type='A', query_name=str(hostname), nameservers=resolver.nameservers, answer=answer, error=None, **log_context))
-                    addresses[hostname] = [r.address for r in answer.rrset]
+            elif hostname not in pending_hostnames:
+                pending_hostnames.append(hostname)
+        # the hostnames which are not in the additional records are resolved concurrently
+        for hostname, result in zip(pending_hostnames, concurrent_map(lookup, pending_hostnames)):
+            if isinstance(result, Exception):
+                raise result
+            addresses[hostname] = result
         return addresses
 
 
     def _lookup_srv_records(self, resolver, srv_names, additional_records=[], log_context={}):
-        notification_center = NotificationCenter()
         additional_services = dict((rset.name.to_text(), rset) for rset in additional_records if rset.rdtype == rdatatype.SRV)
-        services = {}
-        for srv_name in srv_names:
-            services[srv_name] = []
+
+        def lookup(srv_name):
+            results = []
             if srv_name in additional_services:
                 addresses = self._lookup_a_records(resolver, [r.target.to_text() for r in additional_services[srv_name]], additional_records)
                 for record in additional_services[srv_name]:
-                    services[srv_name].extend(SRVResult(record.priority, record.weight, record.port, addr) for addr in addresses.get(record.target.to_text(), ()))
+                    results.extend(SRVResult(record.priority, record.weight, record.port, addr) for addr in addresses.get(record.target.to_text(), ()))
             else:
                 try:
                     answer = resolver.query(srv_name, rdatatype.SRV)
                 except dns.resolver.Timeout as e:
-                    notification_center.post_notification('DNSLookupTrace', sender=self, data=NotificationData(query_type='SRV', query_name=str(srv_name), nameservers=resolver.nameservers, answer=None, error=e, **log_context))
+                    self._trace('SRV', srv_name, resolver, None, e, log_context)
                     raise
                 except exception.DNSException as e:
-                    notification_center.post_notification('DNSLookupTrace', sender=self, data=NotificationData(query_type='SRV', query_name=str(srv_name), nameservers=resolver.nameservers, answer=None, error=e, **log_context))
+                    self._trace('SRV', srv_name, resolver, None, e, log_context)
                 else:
-                    notification_center.post_notification('DNSLookupTrace', sender=self, data=NotificationData(query_type='SRV', query_name=str(srv_name), nameservers=resolver.nameservers, answer=answer, error=None, **log_context))
+                    self._trace('SRV', srv_name, resolver, answer, None, log_context)
                     addresses = self._lookup_a_records(resolver, [r.target.to_text() for r in answer.rrset], answer.response.additional, log_context)
                     for record in answer.rrset:
-                        services[srv_name].extend(SRVResult(record.priority, record.weight, record.port, addr) for addr in addresses.get(record.target.to_text(), ()))
-            services[srv_name].sort(key=lambda result: (result.priority, -result.weight))
+                        results.extend(SRVResult(record.priority, record.weight, record.port, addr) for addr in addresses.get(record.target.to_text(), ()))
+            results.sort(key=lambda result: (result.priority, -result.weight))
+            return results
+
+        services = {}
+        for srv_name, result in zip(srv_names, concurrent_map(lookup, srv_names)):
+            if isinstance(result, Exception):
+                raise result
+            services[srv_name] = result
         return services
 
 
     def _lookup_naptr_record(self, resolver, domain, services, log_context={}):
-        notification_center = NotificationCenter()
         pointers = []
         try:
             answer = resolver.query(domain, rdatatype.NAPTR)
         except dns.resolver.Timeout as e:
-            notification_center.post_notification('DNSLookupTrace', sender=self, data=NotificationData(query_type='NAPTR', query_name=str(domain), nameservers=resolver.nameservers, answer=None, error=e, **log_context))
+            self._trace('NAPTR', domain, resolver, None, e, log_context)
             raise
         except exception.DNSException as e:
-            notification_center.post_notification('DNSLookupTrace', sender=self, data=NotificationData(query_type='NAPTR', query_name=str(domain), nameservers=resolver.nameservers, answer=None, error=e, **log_context))
+            self._trace('NAPTR', domain, resolver, None, e, log_context)
         else:
-            notification_center.post_notification('DNSLookupTrace', sender=self, data=NotificationData(query_type='NAPTR', query_name=str(domain), nameservers=resolver.nameservers, answer=answer, error=None, **log_context))
+            self._trace('NAPTR', domain, resolver, answer, None, log_context)
             records = [r for r in answer.rrset if r.service.decode().lower() in services]
             services = self._lookup_srv_records(resolver, [r.replacement.to_text() for r in records], answer.response.additional, log_context)
 
@@ -452,8 +1235,47 @@ class DNSLookup(object):
         return pointers
 
 
+class NameserverHealth(object):
+    __slots__ = ('rtt', 'failures', 'last_failure')
+
+    def __init__(self):
+        self.rtt = None
+        self.failures = 0
+        self.last_failure = 0
+
+
 @implementer(IObserver)
 class DNSManager(object, metaclass=Singleton):
+    """
+    Probes and keeps track of the nameservers used by the DNS lookups. If the
+    cache_filename attribute is set before it is started, the answers in the
+    DNS cache are saved to that file every cache_save_interval seconds and
+    when it is stopped, and they are loaded back into the cache when it is
+    started, so that lookups can be answered right away after a restart.
+
+    The health of each nameserver is tracked from the outcome of the queries
+    made by the lookups: a nameserver which timed out failure_threshold times
+    in a row is only used after the others for quarantine_time seconds and
+    the others are ordered by their smoothed response time. The nameservers
+    are actively probed by looking up the NAPTR and SRV records of the
+    probed_domain, which should be set to a domain the deployment can
+    resolve, or to None to disable the probes. A failed probe is retried with
+    an exponential backoff. The probes fall back to the fallback_nameservers,
+    if there are any, when the local ones do not work. SIPApplication takes
+    both from the sip.dns_probed_domain and sip.dns_fallback_nameservers
+    settings.
+
+    The port attribute is the port on which the lookups query the nameservers.
+    The nameservers, search list, domain and port are published to the lookups
+    as a single ResolverConfiguration, which is replaced whenever they change.
+    """
+
+    cache_save_interval = 300       # seconds between the saves of the DNS cache
+    failure_threshold = 3           # number of consecutive timeouts after which a nameserver is considered unhealthy
+    quarantine_time = 30            # seconds for which an unhealthy nameserver is used after the healthy ones
+    rtt_smoothing = 0.2             # weight of the latest response time in the smoothed response time of a nameserver
+    probe_interval = 15             # seconds after which a failed probe is retried for the first time
+    max_probe_interval = 3600       # maximum number of seconds between the retries of a failed probe
 
     def __init__(self):
         try:
@@ -463,17 +1285,57 @@ class DNSManager(object, metaclass=Singleton):
             
         self.search = default_resolver.search
         self.domain = default_resolver.domain
-        self.google_nameservers = ['8.8.8.8', '8.8.4.4']
+        self.fallback_nameservers = ['8.8.8.8', '8.8.4.4']
+        self.configuration = None
+        self._configuration_version = count(1)
+        self._port = 53
         self.nameservers = default_resolver.nameservers or []
         self.probed_domain = 'sip2sip.info.'
+        self.cache_filename = None
         self._channel = coros.queue()
         self._proc = None
         self._timer = None
         self._wakeup_timer = None
+        self._cache_timer = None
+        self._probe_failures = 0
+        self._health = {}
         notification_center = NotificationCenter()
         notification_center.add_observer(self, name='SystemIPAddressDidChange')
         notification_center.add_observer(self, name='SystemDidWakeUpFromSleep')
 
+    @property
+    def ordered_nameservers(self):
+        """The nameservers, healthy ones first, ordered by their smoothed response time"""
+        return self.sort_nameservers(self.nameservers)
+
+    def sort_nameservers(self, nameservers):
+        now = time()
+        def health_key(nameserver):
+            health = self._health.get(nameserver)
+            if health is None:
+                return (False, 0)
+            return (health.failures >= self.failure_threshold and now - health.last_failure < self.quarantine_time, health.rtt or 0)
+        return sorted(nameservers, key=health_key)
+
+    @property
+    def nameserver_health(self):
+        """The smoothed response time and the number of consecutive timeouts of each nameserver"""
+        return {nameserver: dict(rtt=health.rtt, failures=health.failures) for nameserver, health in self._health.items()}
+
+    def record_response(self, nameserver, latency):
+        health = self._health.setdefault(nameserver, NameserverHealth())
+        health.rtt = latency if health.rtt is None else (1 - self.rtt_smoothing) * health.rtt + self.rtt_smoothing * latency
+        health.failures = 0
+
+    def record_timeout(self, nameserver):
+        health = self._health.setdefault(nameserver, NameserverHealth())
+        health.failures += 1
+        health.last_failure = time()
+        if self._proc is not None and self._timer is None and self.probed_domain is not None and health.failures == self.failure_threshold:
+            if all(self._health.get(ns, NameserverHealth()).failures >= self.failure_threshold for ns in self.nameservers):
+                # none of the nameservers answers anymore, find out if other ones work
+                self._channel.send(Command('probe_dns'))
+
     @property
     def nameservers(self):
         return self.__dict__['nameservers']
@@ -486,12 +1348,37 @@ class DNSManager(object, metaclass=Singleton):
             NotificationCenter().post_notification('DNSResolverDidInitialize', sender=self, data=NotificationData(nameservers=value))
         elif value != old_value:
             NotificationCenter().post_notification('DNSNameserversDidChange', sender=self, data=NotificationData(nameservers=value))
+        self._update_configuration()
+
+    @property
+    def port(self):
+        return self._port
+
+    @port.setter
+    def port(self, value):
+        self._port = value
+        self._update_configuration()
+
+    def _update_configuration(self):
+        # the lookups get the whole configuration at once, so it is replaced instead of being changed
+        settings = (tuple(self.nameservers), tuple(self.search or ()), self.domain, self.port)
+        configuration = self.configuration
+        if configuration is None or settings != (configuration.nameservers, configuration.search, configuration.domain, configuration.port):
+            self.configuration = ResolverConfiguration(next(self._configuration_version), *settings)
 
     def start(self):
+        if self.cache_filename is not None:
+            DNSLookup.cache.load(self.cache_filename)
+            self._cache_timer = reactor.callLater(self.cache_save_interval, self._save_cache)
         self._proc = proc.spawn(self._run)
         self._channel.send(Command('probe_dns'))
 
     def stop(self):
+        DNSQueryMultiplexer().stop()
+        if self._cache_timer is not None and self._cache_timer.active():
+            self._cache_timer.cancel()
+            DNSLookup.cache.save(self.cache_filename)
+        self._cache_timer = None
         if self._proc is not None:
             self._proc.kill()
             self._proc = None
@@ -502,6 +1389,10 @@ class DNSManager(object, metaclass=Singleton):
             self._wakeup_timer.cancel()
         self._wakeup_timer = None
 
+    def _save_cache(self):
+        DNSLookup.cache.save(self.cache_filename)
+        self._cache_timer = reactor.callLater(self.cache_save_interval, self._save_cache)
+
     def _run(self):
         while True:
             try:
@@ -519,12 +1410,15 @@ class DNSManager(object, metaclass=Singleton):
         try:
             resolver = InternalResolver()
         except dns.resolver.NoResolverConfiguration as e:
-            self._timer = reactor.callLater(15, self._channel.send, Command('probe_dns'))
+            self._schedule_probe()
             return
         
         self.domain = resolver.domain
         self.search = resolver.search
         local_nameservers = resolver.nameservers
+        if self.probed_domain is None:
+            self.nameservers = local_nameservers
+            return
         # probe local resolver
         resolver.timeout = 1
         resolver.lifetime = 3
@@ -538,24 +1432,32 @@ class DNSManager(object, metaclass=Singleton):
         except (dns.resolver.Timeout, exception.DNSException):
             pass
         else:
+            self._probe_failures = 0
             self.nameservers = resolver.nameservers
             return
-        # local resolver failed. probe google resolver
-        resolver.nameservers = self.google_nameservers
-        resolver.timeout = 2
-        resolver.lifetime = 4
-        try:
-            answer = resolver.query(self.probed_domain, rdatatype.NAPTR)
-            if not any(record.rdtype == rdatatype.NAPTR for record in answer.rrset):
-                raise exception.DNSException("No NAPTR records found")
-        except (dns.resolver.Timeout, exception.DNSException):
-            pass
-        else:
-            self.nameservers = resolver.nameservers
-            return
-        # google resolver failed. fallback to local resolver and schedule another probe for later
+        # local resolver failed. probe the fallback resolvers
+        if self.fallback_nameservers:
+            resolver.nameservers = self.fallback_nameservers
+            resolver.timeout = 2
+            resolver.lifetime = 4
+            try:
+                answer = resolver.query(self.probed_domain, rdatatype.NAPTR)
+                if not any(record.rdtype == rdatatype.NAPTR for record in answer.rrset):
+                    raise exception.DNSException("No NAPTR records found")
+            except (dns.resolver.Timeout, exception.DNSException):
+                pass
+            else:
+                self._probe_failures = 0
+                self.nameservers = resolver.nameservers
+                return
+        # fallback resolvers failed. fallback to local resolver and schedule another probe for later
         self.nameservers = local_nameservers
-        self._timer = reactor.callLater(15, self._channel.send, Command('probe_dns'))
+        self._schedule_probe()
+
+    def _schedule_probe(self):
+        delay = min(self.probe_interval * 2**self._probe_failures, self.max_probe_interval)
+        self._probe_failures += 1
+        self._timer = reactor.callLater(delay, self._channel.send, Command('probe_dns'))
 
     @run_in_twisted_thread
     def handle_notification(self, notification):
@@ -563,12 +1465,16 @@ class DNSManager(object, metaclass=Singleton):
         handler(notification)
 
     def _NH_SystemIPAddressDidChange(self, notification):
+        self._health.clear()
+        self._probe_failures = 0
         self._proc.kill(InterruptCommand)
         self._channel.send(Command('probe_dns'))
 
     def _NH_SystemDidWakeUpFromSleep(self, notification):
         if self._wakeup_timer is None:
             def wakeup_action():
+                self._health.clear()
+                self._probe_failures = 0
                 self._proc.kill(InterruptCommand)
                 self._channel.send(Command('probe_dns'))
                 self._wakeup_timer = None
@@ -0,0 +1,182 @@
+"""Pager-mode SIP MESSAGE dispatching"""
+
+
+__all__ = ['MessageDispatcher', 'MessageDispatchError']
+
+from collections import deque
+from time import time
+
+from application.notification import IObserver, NotificationCenter
+from application.python import Null, limit
+from application.python.types import Singleton
+from application.system import host as Host
+from eventlib import api, coros
+from zope.interface import implementer
+
+from sipsimple.account import BonjourAccount
+from sipsimple.configuration.settings import SIPSimpleSettings
+from sipsimple.core import FromHeader, Message, RouteHeader, SIPCoreError, SIPURI, ToHeader
+from sipsimple.lookup import DNSLookup, DNSLookupError
+from sipsimple.threading import run_in_twisted_thread
+from sipsimple.threading.green import run_in_waitable_green_thread
+
+
+class MessageDispatchError(Exception):
+    def __init__(self, error, code=None, reason=None):
+        Exception.__init__(self, error)
+        self.error = error
+        self.code = code
+        self.reason = reason
+
+
+@implementer(IObserver)
+class MessageDispatcher(object, metaclass=Singleton):
+    """
+    Sends pager-mode MESSAGE requests on behalf of accounts. The routes for
+    a destination come from the DNSLookup route cache, which keeps them for
+    as long as the DNS records they were built from are valid. At most
+    max_in_flight MESSAGE transactions are in progress at any time and a
+    message that fails with a timeout or a server error is retried on the
+    next route.
+    """
+
+    max_in_flight = 100             # maximum number of MESSAGE transactions in progress
+    timeout = 15                    # seconds allowed for all the attempts to send a message
+    latency_samples = 1000          # number of message latencies kept for the statistics
+    throughput_window = 10          # seconds over which the throughput is computed
+
+    def __init__(self):
+        self.sent = 0
+        self.succeeded = 0
+        self.failed = 0
+        self.retried = 0
+        self._in_flight = 0
+        self._in_flight_semaphore = coros.Semaphore(self.max_in_flight)
+        self._waiters = {}
+        self._latencies = deque(maxlen=self.latency_samples)
+        self._completion_times = deque()
+        notification_center = NotificationCenter()
+        notification_center.add_observer(self, name='NetworkConditionsDidChange')
+
+    @property
+    def statistics(self):
+        """The message counters, the current throughput in messages per second and the message latency percentiles"""
+        now = time()
+        while self._completion_times and self._completion_times[0] < now - self.throughput_window:
+            self._completion_times.popleft()
+        latencies = sorted(self._latencies)
+        def percentile(fraction):
+            return latencies[min(int(len(latencies) * fraction), len(latencies) - 1)] if latencies else 0.0
+        return dict(sent=self.sent,
+                    succeeded=self.succeeded,
+                    failed=self.failed,
+                    retried=self.retried,
+                    in_flight=self._in_flight,
+                    cached_routes=DNSLookup.route_cache.statistics['size'],
+                    throughput=len(self._completion_times) / self.throughput_window,
+                    latency_p50=percentile(0.50),
+                    latency_p90=percentile(0.90),
+                    latency_p99=percentile(0.99))
+
+    def clear_routes(self):
+        """
+        Discard the cached routes. The routes are kept by the DNSLookup route
+        cache, which is shared by all the users of DNSLookup in the process,
+        so their routes are discarded as well.
+        """
+        DNSLookup.route_cache.flush()
+
+    @run_in_waitable_green_thread
+    def send(self, account, uri, content_type, body, extra_headers=None):
+        """
+        Send a MESSAGE with the given content to the SIP URI on behalf of the
+        account. Returns the data of the final response when the message was
+        accepted or raises MessageDispatchError.
+        """
+        start_time = time()
+        self.sent += 1
+        try:
+            with api.timeout(self.timeout, MessageDispatchError('Timeout')):
+                data = self._send(account, uri, content_type, body, extra_headers)
+        except MessageDispatchError:
+            self.failed += 1
+            raise
+        else:
+            self.succeeded += 1
+            return data
+        finally:
+            end_time = time()
+            self._latencies.append(end_time - start_time)
+            self._completion_times.append(end_time)
+
+    def _send(self, account, uri, content_type, body, extra_headers):
+        if Host.default_ip is None:
+            raise MessageDispatchError('No IP address')
+        routes = self._lookup_routes(account, uri)
+        from_header = FromHeader(account.uri, account.display_name)
+        to_header = ToHeader(uri)
+        error = None
+        for index, route in enumerate(routes):
+            if index > 0:
+                self.retried += 1
+            message = Message(from_header, to_header, RouteHeader(route.uri), content_type, body, credentials=getattr(account, 'credentials', None), extra_headers=extra_headers)
+            self._in_flight_semaphore.acquire()
+            self._in_flight += 1
+            waiter = self._waiters[message] = coros.event()
+            notification_center = NotificationCenter()
+            notification_center.add_observer(self, sender=message)
+            try:
+                message.send(timeout=limit(self.timeout, min=1, max=10))
+            except SIPCoreError as e:
+                del self._waiters[message]
+                self._release(message)
+                raise MessageDispatchError('Internal error: %s' % e)
+            # the slot is released when the transaction ends, even if nobody waits for it anymore
+            notification = waiter.wait()
+            if notification.name == 'SIPMessageDidSucceed':
+                return notification.data
+            code = notification.data.code
+            error = MessageDispatchError('MESSAGE failed: %d %s' % (code, notification.data.reason), code=code, reason=notification.data.reason)
+            if not (code == 408 or code >= 500):
+                raise error
+        raise error or MessageDispatchError('No routes available')
+
+    def _lookup_routes(self, account, uri):
+        settings = SIPSimpleSettings()
+        transports = list(settings.sip.transport_list)
+        if isinstance(account, BonjourAccount):
+            lookup_uri = uri
+        elif account.sip.outbound_proxy is not None and account.sip.outbound_proxy.transport in transports:
+            proxy = account.sip.outbound_proxy
+            lookup_uri = SIPURI(host=proxy.host, port=proxy.port, parameters={'transport': proxy.transport})
+        elif account.sip.always_use_my_proxy:
+            lookup_uri = SIPURI(host=account.id.domain)
+        else:
+            lookup_uri = SIPURI(host=uri.host, port=uri.port, parameters=dict(uri.parameters))
+        tls_name = getattr(account.sip, 'tls_name', None)
+        lookup = DNSLookup()
+        try:
+            return lookup.lookup_sip_proxy(lookup_uri, transports, tls_name=tls_name).wait()
+        except DNSLookupError as e:
+            raise MessageDispatchError('DNS lookup failed: %s' % e)
+
+    @run_in_twisted_thread
+    def handle_notification(self, notification):
+        handler = getattr(self, '_NH_%s' % notification.name, Null)
+        handler(notification)
+
+    def _release(self, message):
+        NotificationCenter().remove_observer(self, sender=message)
+        self._in_flight -= 1
+        self._in_flight_semaphore.release()
+
+    def _NH_SIPMessageDidSucceed(self, notification):
+        waiter = self._waiters.pop(notification.sender, None)
+        if waiter is not None:
+            self._release(notification.sender)
+            waiter.send(notification)
+
+    _NH_SIPMessageDidFail = _NH_SIPMessageDidSucceed
+
+    def _NH_NetworkConditionsDidChange(self, notification):
+        self.clear_routes()
@@ -11,6 +11,7 @@ __all__ = ['Session', 'SessionManager']
 
 import random
 
+from collections import deque
 from threading import RLock
 from time import time
 
@@ -35,7 +36,7 @@ from sipsimple.payloads import ParserError
 from sipsimple.payloads.conference import ConferenceDocument
 from sipsimple.streams import MediaStreamRegistry, InvalidStreamError, UnknownStreamError
 from sipsimple.threading import run_in_twisted_thread
-from sipsimple.threading.green import Command, run_in_green_thread
+from sipsimple.threading.green import Command, call_in_green_thread, run_in_green_thread
 from sipsimple.util import ISOTimestamp
 
 
@@ -958,6 +959,9 @@ class Session(object):
         self.transfer_info = None
         self._channel = coros.queue()
         self._hold_in_progress = False
+        self._hold_requested = False
+        self._queued_additions = []
+        self._queued_removals = []
         self._invitation = None
         self._local_identity = None
         self._remote_identity = None
@@ -1250,8 +1254,7 @@ class Session(object):
             notification_center.post_notification('SIPSessionDidStart', self, NotificationData(streams=self.streams[:]))
             for notification in unhandled_notifications:
                 self.handle_notification(notification)
-            if self._hold_in_progress:
-                self._send_hold()
+            self._process_pending_updates()
 
     def _reinvite_after_ice(self):
         # This function does not do any error checking, it's designed to be called at the end of connect and add_stream
@@ -1532,8 +1535,7 @@ class Session(object):
             notification_center.post_notification('SIPSessionDidStart', self, NotificationData(streams=self.streams[:]))
             for notification in unhandled_notifications:
                 self.handle_notification(notification)
-            if self._hold_in_progress:
-                self._send_hold()
+            self._process_pending_updates()
         finally:
             self.greenlet = None
 
@@ -1683,8 +1685,7 @@ class Session(object):
             notification_center.post_notification('SIPSessionDidRenegotiateStreams', self, NotificationData(originator='remote', added_streams=streams, removed_streams=[]))
             for notification in unhandled_notifications:
                 self.handle_notification(notification)
-            if self._hold_in_progress:
-                self._send_hold()
+            self._process_pending_updates()
         finally:
             self.greenlet = None
 
@@ -1711,28 +1712,111 @@ class Session(object):
             self.greenlet = None
             self.state = 'connected'
             notification_center.post_notification('SIPSessionProposalRejected', self, NotificationData(originator='remote', code=code, reason=sip_status_messages[code], proposed_streams=proposed_streams))
-            if self._hold_in_progress:
-                self._send_hold()
+            self._process_pending_updates()
         finally:
             self.greenlet = None
 
     def add_stream(self, stream):
         self.add_streams([stream])
 
-    @transition_state('connected', 'sending_proposal')
-    @run_in_green_thread
     def add_streams(self, streams):
-        streams = list(set(streams).difference(self.streams))
-        if not streams:
+        with self._lock:
+            if self.state in ('sending_proposal', 'cancelling_proposal'):
+                # A local offer is already in progress, the streams will be added by the next one
+                self._queue_stream_changes(added_streams=streams)
+                return
+            if self.state != 'connected':
+                raise IllegalStateError('cannot call add_streams in %s state' % self.state)
+            self.state = 'sending_proposal'
+        call_in_green_thread(self._update_streams, streams, [])
+
+    def remove_stream(self, stream):
+        self.remove_streams([stream])
+
+    def remove_streams(self, streams):
+        with self._lock:
+            if self.state in ('sending_proposal', 'cancelling_proposal'):
+                # A local offer is already in progress, the streams will be removed by the next one
+                self._queue_stream_changes(removed_streams=streams)
+                return
+            if self.state != 'connected':
+                raise IllegalStateError('cannot call remove_streams in %s state' % self.state)
+            self.state = 'sending_proposal'
+        call_in_green_thread(self._update_streams, [], streams)
+
+    def _queue_stream_changes(self, added_streams=(), removed_streams=()):
+        for stream in added_streams:
+            if stream in self._queued_removals:
+                self._queued_removals.remove(stream)
+            elif stream not in self._queued_additions:
+                self._queued_additions.append(stream)
+        for stream in removed_streams:
+            if stream in self._queued_additions:
+                self._queued_additions.remove(stream)
+            elif stream not in self._queued_removals:
+                self._queued_removals.append(stream)
+
+    def _process_pending_updates(self):
+        # Called when an offer/answer exchange finished. All the stream changes and the hold state requested while it
+        # was in progress are merged into a single re-INVITE which carries the final state.
+        with self._lock:
+            if self.state in ('terminating', 'terminated'):
+                self._queued_additions = []
+                self._queued_removals = []
+                return
+            if self.state != 'connected':
+                return
+            added_streams = [stream for stream in self._queued_additions if stream not in self.streams]
+            removed_streams = [stream for stream in self._queued_removals if stream in self.streams]
+            self._queued_additions = []
+            self._queued_removals = []
+            if added_streams or removed_streams or self._hold_requested != self.on_hold:
+                self.state = 'sending_proposal'
+            else:
+                return
+        if added_streams or removed_streams:
+            self._update_streams(added_streams, removed_streams)
+        elif self._hold_requested:
+            for stream in self.streams:
+                stream.hold()
+            self._send_hold()
+        else:
+            for stream in self.streams:
+                stream.unhold()
+            self._send_unhold()
+
+    def _update_streams(self, added_streams, removed_streams):
+        # The session must already be in the sending_proposal state
+        added_streams = [stream for stream in dict.fromkeys(added_streams) if stream not in self.streams]
+        removed_streams = [stream for stream in dict.fromkeys(removed_streams) if stream in self.streams]
+        if added_streams:
+            self._add_streams(added_streams, removed_streams)
+        elif removed_streams:
+            self._remove_streams(removed_streams)
+        else:
             self.state = 'connected'
-            return
+            self._process_pending_updates()
 
+    def _update_local_hold_state(self, on_hold):
+        # Called after an offer which included a change of the local hold state was answered
+        notification_center = NotificationCenter()
+        self.on_hold = on_hold
+        self._hold_in_progress = False
+        if on_hold:
+            hold_supported_streams = (stream for stream in self.streams if stream.hold_supported)
+            notification_center.post_notification('SIPSessionDidChangeHoldState', self, NotificationData(originator='local', on_hold=True, partial=any(not stream.on_hold_by_local for stream in hold_supported_streams)))
+        else:
+            notification_center.post_notification('SIPSessionDidChangeHoldState', self, NotificationData(originator='local', on_hold=False, partial=False))
+
+    def _add_streams(self, streams, removed_streams):
         self.greenlet = api.getcurrent()
         notification_center = NotificationCenter()
         settings = SIPSimpleSettings()
         unhandled_notifications = []
 
         self.proposed_streams = streams
+        removal_negotiated = False
+        removal_reported = False
         for stream in self.proposed_streams:
             notification_center.add_observer(self, sender=stream)
             stream.initialize(self, direction='outgoing')
@@ -1752,10 +1836,24 @@ class Session(object):
 
             local_sdp = SDPSession.new(self._invitation.sdp.active_local)
             local_sdp.version += 1
+            # Include any pending change of the hold state in this offer instead of sending another one afterwards
+            on_hold = self._hold_requested
+            if on_hold != self.on_hold:
+                for stream in self.streams:
+                    if stream not in removed_streams:
+                        local_sdp.media[stream.index] = stream.get_local_media(remote_sdp=None, index=stream.index)
+            # The removed streams are only dropped once the offer which disables them is accepted
+            for stream in removed_streams:
+                media = local_sdp.media[stream.index]
+                media.port = 0
+                media.attributes = []
+                media.bandwidth_info = []
             for stream in self.proposed_streams:
+                if on_hold:
+                    stream.hold()
                 # Try to reuse a disabled media stream to avoid an ever-growing SDP
                 try:
-                    index = next(index for index, media in enumerate(local_sdp.media) if media.port == 0)
+                    index = next(index for index, media in enumerate(local_sdp.media) if media.port == 0 and index not in {s.index for s in removed_streams})
                     reuse_media = True
                 except StopIteration:
                     index = len(local_sdp.media)
@@ -1781,7 +1879,8 @@ class Session(object):
                                 local_sdp = notification.data.local_sdp
                                 remote_sdp = notification.data.remote_sdp
                                 for s in self.streams:
-                                    s.update(local_sdp, remote_sdp, s.index)
+                                    if s not in removed_streams:
+                                        s.update(local_sdp, remote_sdp, s.index)
                             else:
                                 self._fail_proposal(originator='local', error='SDP negotiation failed: %s' % notification.data.error)
                                 return
@@ -1790,6 +1889,7 @@ class Session(object):
                                 received_invitation_state = True
                                 notification_center.post_notification('SIPSessionDidProcessTransaction', self, NotificationData(originator='local', method='INVITE', code=notification.data.code, reason=notification.data.reason))
                                 if notification.data.code >= 300:
+                                    # The hold state change carried by the offer is still pending and is sent on its own
                                     proposed_streams = self.proposed_streams
                                     for stream in proposed_streams:
                                         notification_center.remove_observer(self, sender=stream)
@@ -1806,6 +1906,12 @@ class Session(object):
                 self.cancel_proposal()
                 return
 
+            for stream in removed_streams:
+                notification_center.remove_observer(self, sender=stream)
+                stream.deactivate()
+                self.streams.remove(stream)
+            removal_negotiated = True
+
             accepted_streams = []
             for stream in self.proposed_streams:
                 try:
@@ -1851,25 +1957,26 @@ class Session(object):
             if any_stream_ice:
                 self._reinvite_after_ice()
             notification_center.post_notification('SIPSessionProposalAccepted', self, NotificationData(originator='local', accepted_streams=accepted_streams, proposed_streams=proposed_streams))
-            notification_center.post_notification('SIPSessionDidRenegotiateStreams', self, NotificationData(originator='local', added_streams=accepted_streams, removed_streams=[]))
+            notification_center.post_notification('SIPSessionDidRenegotiateStreams', self, NotificationData(originator='local', added_streams=accepted_streams, removed_streams=removed_streams))
+            removal_reported = True
+            if on_hold != self.on_hold:
+                self._update_local_hold_state(on_hold)
             for notification in unhandled_notifications:
                 self.handle_notification(notification)
-            if self._hold_in_progress:
-                self._send_hold()
         finally:
             self.greenlet = None
+            if removal_negotiated:
+                for stream in removed_streams:
+                    stream.end()
+                if removed_streams and not removal_reported:
+                    # The added streams failed after the answer, but the removed streams are gone nonetheless
+                    notification_center.post_notification('SIPSessionDidRenegotiateStreams', self, NotificationData(originator='local', added_streams=[], removed_streams=removed_streams))
+            else:
+                # The offer which disabled the removed streams was not accepted, they will be removed by the next one
+                self._queue_stream_changes(removed_streams=[stream for stream in removed_streams if stream in self.streams])
+            self._process_pending_updates()
 
-    def remove_stream(self, stream):
-        self.remove_streams([stream])
-
-    @transition_state('connected', 'sending_proposal')
-    @run_in_green_thread
-    def remove_streams(self, streams):
-        streams = list(set(streams).intersection(self.streams))
-        if not streams:
-            self.state = 'connected'
-            return
-
+    def _remove_streams(self, streams):
         self.greenlet = api.getcurrent()
         notification_center = NotificationCenter()
         unhandled_notifications = []
@@ -1877,6 +1984,12 @@ class Session(object):
         try:
             local_sdp = SDPSession.new(self._invitation.sdp.active_local)
             local_sdp.version += 1
+            # Include any pending change of the hold state in this offer instead of sending another one afterwards
+            on_hold = self._hold_requested
+            if on_hold != self.on_hold:
+                for stream in self.streams:
+                    if stream not in streams:
+                        local_sdp.media[stream.index] = stream.get_local_media(remote_sdp=None, index=stream.index)
             for stream in streams:
                 notification_center.remove_observer(self, sender=stream)
                 stream.deactivate()
@@ -1890,6 +2003,7 @@ class Session(object):
 
             received_invitation_state = False
             received_sdp_update = False
+            accepted = False
 
             with api.timeout(self.short_reinvite_timeout):
                 while not received_invitation_state or not received_sdp_update:
@@ -1905,7 +2019,8 @@ class Session(object):
                         if notification.data.state == 'connected' and notification.data.sub_state == 'normal':
                             received_invitation_state = True
                             notification_center.post_notification('SIPSessionDidProcessTransaction', self, NotificationData(originator='local', method='INVITE', code=notification.data.code, reason=notification.data.reason))
-                            if not (200 <= notification.data.code < 300):
+                            accepted = 200 <= notification.data.code < 300
+                            if not accepted:
                                 break
                         elif notification.data.state == 'disconnected':
                             raise InvitationDisconnectedError(notification.sender, notification.data)
@@ -1926,12 +2041,14 @@ class Session(object):
             self.greenlet = None
             self.state = 'connected'
             notification_center.post_notification('SIPSessionDidRenegotiateStreams', self, NotificationData(originator='local', added_streams=[], removed_streams=streams))
+            # If the offer was rejected, the hold state change it carried is still pending and is sent on its own
+            if on_hold != self.on_hold and accepted:
+                self._update_local_hold_state(on_hold)
             for notification in unhandled_notifications:
                 self.handle_notification(notification)
-            if self._hold_in_progress:
-                self._send_hold()
         finally:
             self.greenlet = None
+            self._process_pending_updates()
 
     @transition_state('sending_proposal', 'cancelling_proposal')
     @run_in_green_thread
@@ -1995,14 +2112,14 @@ class Session(object):
             self.state = 'connected'
         finally:
             self.greenlet = None
-            if self._hold_in_progress:
-                self._send_hold()
+            self._process_pending_updates()
 
     @run_in_green_thread
     def hold(self):
         if self.on_hold or self._hold_in_progress:
             return
         self._hold_in_progress = True
+        self._hold_requested = True
         streams = (self.streams or []) + (self.proposed_streams or [])
         if not streams:
             return
@@ -2016,6 +2133,7 @@ class Session(object):
         if not self.on_hold and not self._hold_in_progress:
             return
         self._hold_in_progress = False
+        self._hold_requested = False
         streams = (self.streams or []) + (self.proposed_streams or [])
         if not streams:
             return
@@ -2025,7 +2143,7 @@ class Session(object):
             self._send_unhold()
 
     @run_in_green_thread
-    def end(self):
+    def end(self, timeout=1):
         if self.state in (None, 'terminating', 'terminated'):
             return
         if self.greenlet is not None:
@@ -2068,7 +2186,7 @@ class Session(object):
                 stream.deactivate()
         cancelling = invitation_state != 'connected' and self.direction == 'outgoing'
         try:
-            self._invitation.end(timeout=1)
+            self._invitation.end(timeout=timeout)
             while True:
                 try:
                     notification = self._channel.wait()
@@ -2259,17 +2377,13 @@ class Session(object):
 
         self.greenlet = None
         self.on_hold = True
+        self._hold_in_progress = False
         self.state = 'connected'
         hold_supported_streams = (stream for stream in self.streams if stream.hold_supported)
         notification_center.post_notification('SIPSessionDidChangeHoldState', self, NotificationData(originator='local', on_hold=True, partial=any(not stream.on_hold_by_local for stream in hold_supported_streams)))
         for notification in unhandled_notifications:
             self.handle_notification(notification)
-        if self._hold_in_progress:
-            self._hold_in_progress = False
-        else:
-            for stream in self.streams:
-                stream.unhold()
-            self._send_unhold()
+        self._process_pending_updates()
 
     def _send_unhold(self):
         self.state = 'sending_proposal'
@@ -2322,10 +2436,7 @@ class Session(object):
         notification_center.post_notification('SIPSessionDidChangeHoldState', self, NotificationData(originator='local', on_hold=False, partial=False))
         for notification in unhandled_notifications:
             self.handle_notification(notification)
-        if self._hold_in_progress:
-            for stream in self.streams:
-                stream.hold()
-            self._send_hold()
+        self._process_pending_updates()
 
     def _fail(self, originator, code, reason, error, reason_header=None):
         notification_center = NotificationCenter()
@@ -2610,8 +2721,7 @@ class Session(object):
                         self.proposed_streams = None
                         self.state = 'connected'
                         notification.center.post_notification('SIPSessionProposalRejected', self, NotificationData(originator='remote', code=notification.data.code, reason=notification.data.reason, proposed_streams=proposed_streams))
-                        if self._hold_in_progress:
-                            self._send_hold()
+                        self._process_pending_updates()
                 elif notification.data.state == 'disconnected':
                     if self.state == 'incoming':
                         self.state = 'terminated'
@@ -2700,10 +2810,15 @@ class Session(object):
 @implementer(IObserver)
 class SessionManager(object, metaclass=Singleton):
 
+    teardown_concurrency = 100
+    teardown_timeout = 30
+    local_teardown_timeout = 0.1
+    local_teardown_wait = 5
+
     def __init__(self):
         self.sessions = []
         self.state = None
-        self._channel = coros.queue()
+        self._teardown_channels = []
 
     def start(self):
         self.state = 'starting'
@@ -2721,10 +2836,7 @@ class SessionManager(object, metaclass=Singleton):
         self.state = 'stopping'
         notification_center = NotificationCenter()
         notification_center.post_notification('SIPSessionManagerWillEnd', sender=self)
-        for session in self.sessions:
-            session.end()
-        while self.sessions:
-            self._channel.wait()
+        self.end_sessions()
         notification_center.remove_observer(self, 'SIPInvitationChangedState')
         notification_center.remove_observer(self, 'SIPSessionNewIncoming')
         notification_center.remove_observer(self, 'SIPSessionNewOutgoing')
@@ -2733,6 +2845,69 @@ class SessionManager(object, metaclass=Singleton):
         self.state = 'stopped'
         notification_center.post_notification('SIPSessionManagerDidEnd', sender=self)
 
+    def end_sessions(self, sessions=None, concurrency=None, timeout=None):
+        """
+        Ends the given sessions (all the sessions if None) and waits for them
+        to finish. At most concurrency sessions are being ended at any given
+        time. When timeout expires, the sessions which did not yet end are
+        torn down locally, without waiting for the answer to their BYE, and
+        they are waited for at most local_teardown_wait more seconds.
+
+        Must be called from a green thread.
+        """
+        concurrency = concurrency or self.teardown_concurrency
+        timeout = timeout if timeout is not None else self.teardown_timeout
+        notification_center = NotificationCenter()
+        sessions = [session for session in (sessions if sessions is not None else self.sessions) if session in self.sessions]
+        remaining = set(sessions)
+        queued = deque(sessions)
+        in_progress = set()
+        total = len(sessions)
+        channel = coros.queue()
+        self._teardown_channels.append(channel)
+        deadline = time() + timeout
+        try:
+            while remaining:
+                while queued and len(in_progress) < concurrency:
+                    session = queued.popleft()
+                    if session in remaining:
+                        in_progress.add(session)
+                        session.end()
+                remaining_time = deadline - time()
+                if remaining_time <= 0:
+                    break
+                try:
+                    with api.timeout(remaining_time):
+                        session = channel.wait()
+                except api.TimeoutError:
+                    break
+                if session in remaining:
+                    remaining.remove(session)
+                    in_progress.discard(session)
+                    notification_center.post_notification('SIPSessionManagerTeardownDidProgress', sender=self, data=NotificationData(total=total, ended=total-len(remaining), in_progress=len(in_progress)))
+            for session in remaining:
+                if session.state == 'terminating' and session._invitation is not None:
+                    # The session already sent its BYE, only stop waiting for the answer
+                    try:
+                        session._invitation.end(timeout=self.local_teardown_timeout)
+                    except SIPCoreError:
+                        pass
+                else:
+                    session.end(timeout=self.local_teardown_timeout)
+            torn_down_locally = 0
+            try:
+                with api.timeout(self.local_teardown_wait):
+                    while remaining:
+                        session = channel.wait()
+                        if session in remaining:
+                            remaining.remove(session)
+                            torn_down_locally += 1
+            except api.TimeoutError:
+                pass
+        finally:
+            self._teardown_channels.remove(channel)
+        notification_center.post_notification('SIPSessionManagerTeardownDidEnd', sender=self, data=NotificationData(total=total, torn_down_locally=torn_down_locally, not_ended=len(remaining)))
+
     @run_in_twisted_thread
     def handle_notification(self, notification):
         if notification.name == 'SIPInvitationChangedState' and notification.data.state == 'incoming':
@@ -2748,7 +2923,7 @@ class SessionManager(object, metaclass=Singleton):
             self.sessions.append(notification.sender)
         elif notification.name in ('SIPSessionDidFail', 'SIPSessionDidEnd'):
             self.sessions.remove(notification.sender)
-            if self.state == 'stopping':
-                self._channel.send(notification)
+            for channel in self._teardown_channels:
+                channel.send(notification.sender)
 
 